@@ -0,0 +1,875 @@
+"""Benchmarks of the learning pipeline.
+
+Sequences are read from a preprocessed data directory when given, otherwise
+random sequences with the layout of the preprocessed KITTI pickles are
+generated in a temporary directory, so that benchmarks run without the raw
+data set.
+
+    python benchmark_KITTI.py precision
+    python benchmark_KITTI.py streaming [--address results/KITTI/<date>]
+    python benchmark_KITTI.py inference [--address results/KITTI/<date>]
+    python benchmark_KITTI.py quantized [--address results/KITTI/<date>]
+    python benchmark_KITTI.py chunked --n_samples 200000
+    python benchmark_KITTI.py shared
+    python benchmark_KITTI.py models [--net_classes GyroNet SeparableGyroNet --addresses <dir> <dir>]
+    python benchmark_KITTI.py deploy [--address results/KITTI/<date>] [--before <git revision>]
+    python benchmark_KITTI.py imports [--before <git revision>]
+    python benchmark_KITTI.py loading
+    python benchmark_KITTI.py storage --n_samples 100000
+    python benchmark_KITTI.py prefetch
+    python benchmark_KITTI.py ingest --data_dir <raw KITTI> [--n_workers 8]
+    python benchmark_KITTI.py stream_test --n_seqs 1 --n_samples 100000
+    python benchmark_KITTI.py distributed --world_sizes 1 2 4 8
+    python benchmark_KITTI.py workers --n_samples 200000 --num_workers 0 1 2 4 [--start_method spawn]
+"""
+import os
+import sys
+import time
+import shutil
+import hashlib
+import argparse
+import subprocess
+import socket
+import resource
+import tempfile
+import contextlib
+import multiprocessing
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+import src.networks as sn
+import src.losses as sl
+import src.dataset as ds
+from src.utils import pdump, bmtm
+from src.lie_algebra import SO3
+from src.precision import PrecisionPolicy
+
+net_params = {
+    'in_dim': 6,
+    'out_dim': 6+6+2,
+    'c0': 16,
+    'dropout': 0.2,
+    'ks': [7, 7, 7, 7],
+    'ds': [4, 4, 4],
+    'momentum': 0.1,
+    'gyro_std': [1*np.pi/180, 2*np.pi/180, 5*np.pi/180],
+}
+loss_params = {
+    'w':  1e6,
+    'target': "all",
+    'huber': 0.004,
+    'dt': 0.01,
+}
+
+
+def make_synthetic_predata(predata_dir, sequences, n_samples, seed=0):
+    """Write random sequences in the format of KITTIDataset.read_data"""
+    rng = np.random.RandomState(seed)
+    for name in sequences:
+        t = torch.arange(n_samples).double() * 0.01
+        ang_gt = torch.from_numpy(np.cumsum(1e-3 * rng.randn(n_samples, 3), 0))
+        v_gt = torch.from_numpy(np.cumsum(1e-2 * rng.randn(n_samples, 3), 0))
+        p_gt = torch.cumsum(0.01 * v_gt, 0)
+        us = torch.from_numpy(0.1 * rng.randn(n_samples, 6))
+        us[:, 5] += 9.80665
+        Rot_gt = SO3.from_rpy(ang_gt[:, 0], ang_gt[:, 1], ang_gt[:, 2])
+        dxi_ij = SO3.log(SO3.dnormalize(bmtm(Rot_gt[:-1], Rot_gt[1:])))
+        xs = torch.cat((dxi_ij, v_gt[1:] - v_gt[:-1], p_gt[1:] - p_gt[:-1]), -1)
+        xs = torch.cat((xs, xs[-1:]), 0)  # same length as the other fields
+        mondict = {
+            't': t,
+            'xs': xs,
+            'us': us,
+            'p_gt': p_gt,
+            'ang_gt': ang_gt,
+            'v_gt': v_gt,
+            'name': name,
+            't0': 0.,
+        }
+        pdump(mondict, predata_dir, name + ".p")
+
+
+@contextlib.contextmanager
+def benchmark_setup(args, net_class=sn.GyroNet, address=None):
+    """Yield a learning process and dataset parameters in a temporary directory,
+    the network and filter are loaded from address (default args.address) if
+    given, random otherwise"""
+    import src.learning as lr
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        if args.predata_dir is None:
+            predata_dir = os.path.join(tmp_dir, 'predata')
+            os.mkdir(predata_dir)
+            seqs = ['seq_{}'.format(i) for i in range(args.n_seqs)]
+            make_synthetic_predata(predata_dir, seqs, args.n_samples)
+        else:
+            predata_dir, seqs = args.predata_dir, args.seqs
+        dataset_params = {
+            'predata_dir': predata_dir,
+            'train_seqs': seqs,
+            'val_seqs': seqs,
+            'test_seqs': seqs,
+            'N': args.N,
+        }
+        res_dir = os.path.join(tmp_dir, 'results')
+        os.mkdir(res_dir)
+        torch.manual_seed(0)
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            learning_process = lr.GyroLearningBasedProcessing(res_dir,
+                os.path.join(tmp_dir, 'runs'), net_class, net_params,
+                address or args.address, loss_params['dt'])
+        learning_process.net.eval()
+        yield learning_process, dataset_params
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+@contextlib.contextmanager
+def migrated(dataset_params, storage, **options):
+    """Yield dataset parameters of a copy of the sequences in storage, with
+    options, in a temporary directory, so that a given preprocessed data
+    directory is left untouched"""
+    from src.storage import make_store, migrate
+    predata_dir = tempfile.mkdtemp()
+    try:
+        seqs = sorted(set(dataset_params['train_seqs'] + dataset_params['val_seqs'] +
+                          dataset_params['test_seqs']))
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            migrate(make_store('pickle', dataset_params['predata_dir']),
+                    make_store(storage, predata_dir, **options), seqs)
+        path_normalize_factors = os.path.join(dataset_params['predata_dir'], 'nf.p')
+        if os.path.exists(path_normalize_factors):
+            shutil.copy(path_normalize_factors, predata_dir)
+        yield dict(dataset_params, predata_dir=predata_dir, storage=storage,
+                   storage_options=options)
+    finally:
+        shutil.rmtree(predata_dir)
+
+
+def test_sequences(dataset_params):
+    """full test sequences as batches of one sequence"""
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        dataset = ds.BaseDataset(**dataset_params, mode='test')
+    for i in range(len(dataset)):
+        t, us, xs, p_gt, v_gt, ang_gt, Rot_gt, Rot_xs, name = dataset[i]
+        yield name, us.unsqueeze(0)
+
+
+def trajectory_error(learning_process, net, dataset, i, seed=0):
+    """position RMSE (m) of the filter on a noisy test sequence"""
+    t, us, xs, p_gt, v_gt, ang_gt, Rot_gt, Rot_xs, name = dataset[i]
+    t, us, p_gt, v_gt, ang_gt = [x.unsqueeze(0) for x in (t, us, p_gt, v_gt, ang_gt)]
+    torch.manual_seed(seed)  # same noise for each network
+    us_noise = dataset.add_noise(us.clone())
+    iekf = learning_process.iekf
+    with torch.no_grad():
+        us_fix, measurements_covs = learning_process.calibrate(net(us_noise), us_noise)
+        iekf.set_Q()
+        p = iekf.run(t, us_fix, measurements_covs, v_gt, p_gt, t.shape[1],
+                     ang_gt[:, 0, :])[2]
+    return (p - p_gt.to(p.dtype)).norm(dim=-1).pow(2).mean().sqrt().item()
+
+
+def count_flops(net, n_samples=1000):
+    """floating point operations of convolutions and linear layers for n_samples outputs"""
+    flops = 0
+    for module in net.modules():
+        if isinstance(module, (torch.nn.Conv1d, torch.nn.Linear)):
+            flops += 2 * module.weight.numel() * n_samples  # one multiply-add per weight
+    return flops
+
+
+def latency(net, us, n_repeats):
+    """mean time of a forward pass (s)"""
+    net(us)  # warm-up
+    start = time.perf_counter()
+    for _ in range(n_repeats):
+        net(us)
+    return (time.perf_counter() - start) / n_repeats
+
+
+def max_rss():
+    """peak resident memory of the process (MB)"""
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+
+
+def time_epochs(loop, n_epochs):
+    """mean time per epoch and peak memory increase (MB) of a training loop"""
+    # the training loops print each batch
+    with contextlib.redirect_stdout(open(os.devnull, 'w')):
+        loop()  # warm-up
+        rss0 = max_rss()
+        start = time.perf_counter()
+        for _ in range(n_epochs):
+            loop()
+    return (time.perf_counter() - start) / n_epochs, max_rss() - rss0
+
+
+def bench_precision_policy(policy, args):
+    torch.manual_seed(0)
+    with benchmark_setup(args) as (learning_process, dataset_params):
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            dataset = ds.BaseDataset(**dataset_params, mode='train')
+        dataset.init_train()
+        learning_process.set_precision(policy)
+        learning_process.net.set_normalized_factors(dataset.mean_u, dataset.std_u)
+        dataloader = DataLoader(dataset, batch_size=args.batch_size)
+        optimizer = torch.optim.Adam(learning_process.net.parameters(), lr=1e-4)
+        criterion = sl.GyroLoss(**loss_params)
+        criterion.set_precision(learning_process.precision)
+        iekf = learning_process.iekf
+
+        def pre_loop():
+            learning_process.pre_loop_train(dataloader, optimizer, criterion)
+
+        def loop():
+            learning_process.loop_train(dataloader, optimizer, criterion, iekf)
+
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            time_pre, mem_pre = time_epochs(pre_loop, args.n_epochs)
+            time_filter, mem_filter = time_epochs(loop, args.n_epochs)
+    return time_pre, mem_pre, time_filter, mem_filter
+
+
+def precision(args):
+    """time and memory per epoch under each precision policy"""
+    print("{:>8} | {:>14} {:>12} | {:>14} {:>12}".format(
+        'policy', 'pre-train (s)', 'memory (MB)', 'train (s)', 'memory (MB)'))
+    # one process per policy so that peak memory is not shared between policies
+    ctx = multiprocessing.get_context('spawn')
+    for policy in PrecisionPolicy.POLICIES:
+        with ctx.Pool(1) as pool:
+            res = pool.apply(bench_precision_policy, (policy, args))
+        print("{:>8} | {:>14.3f} {:>12.1f} | {:>14.3f} {:>12.1f}".format(policy, *res))
+
+
+def streaming(args):
+    """streaming network against batch forward on full sequences"""
+    print("{:>32} | {:>8} {:>16} {:>18} {:>12}".format('sequence', 'samples',
+        'batch (s/seq)', 'stream (ms/sample)', 'max |diff|'))
+    with benchmark_setup(args) as (learning_process, dataset_params), torch.no_grad():
+        net = learning_process.net
+        for name, us in test_sequences(dataset_params):
+            start = time.perf_counter()
+            ys = net(us)
+            time_batch = time.perf_counter() - start
+            streaming_net = sn.StreamingNet(net)
+            start = time.perf_counter()
+            ys_stream = streaming_net.forward(us)
+            time_stream = (time.perf_counter() - start) / us.shape[1]
+            print("{:>32} | {:>8} {:>16.3f} {:>18.3f} {:>12.2e}".format(name,
+                us.shape[1], time_batch, 1e3 * time_stream,
+                (ys - ys_stream).abs().max().item()))
+
+
+def inference(args):
+    """CPU latency and equivalence of the inference network on full sequences"""
+    with benchmark_setup(args) as (learning_process, dataset_params), torch.no_grad():
+        net = learning_process.net
+        inference_net = net.export_for_inference()
+        scripted_net = torch.jit.script(inference_net)
+        ys = torch.randn(1, 1000, net.out_dim)
+        print("head max |diff|:", (net.head(ys) - inference_net.head(ys)).abs().max().item())
+        print("{:>32} | {:>8} {:>12} {:>12} {:>12} {:>12} {:>12}".format('sequence',
+            'samples', 'net (s)', 'fused (s)', 'script (s)', 'max |diff|', 'script diff'))
+        for name, us in test_sequences(dataset_params):
+            ys = net(us)
+            ys_inference = inference_net(us)
+            ys_scripted = scripted_net(us)
+            print("{:>32} | {:>8} {:>12.4f} {:>12.4f} {:>12.4f} {:>12.2e} {:>12.2e}".format(
+                name, us.shape[1], latency(net, us, args.n_repeats),
+                latency(inference_net, us, args.n_repeats),
+                latency(scripted_net, us, args.n_repeats),
+                (ys - ys_inference).abs().max().item(),
+                (ys_inference - ys_scripted).abs().max().item()))
+
+
+def quantized(args):
+    """CPU latency and trajectory error of the int8 network against float"""
+    with benchmark_setup(args) as (learning_process, dataset_params):
+        net = learning_process.net
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            calibration_us = learning_process.calibration_inputs(ds.BaseDataset,
+                                                                 dataset_params)
+            dataset = ds.BaseDataset(**dataset_params, mode='test')
+        quantized_net = net.export_quantized(calibration_us, args.backend)
+        print("{:>32} | {:>8} {:>12} {:>12} {:>12} | {:>12} {:>12}".format(
+            'sequence', 'samples', 'float (s)', 'int8 (s)', 'max |diff|',
+            'float p (m)', 'int8 p (m)'))
+        for i, (name, us) in enumerate(test_sequences(dataset_params)):
+            with torch.no_grad():
+                diff = (net(us) - quantized_net(us)).abs().max().item()
+                time_float = latency(net, us, args.n_repeats)
+                time_int8 = latency(quantized_net, us, args.n_repeats)
+            print("{:>32} | {:>8} {:>12.4f} {:>12.4f} {:>12.2e} | {:>12.3f} {:>12.3f}".format(
+                name, us.shape[1], time_float, time_int8, diff,
+                trajectory_error(learning_process, net, dataset, i),
+                trajectory_error(learning_process, quantized_net, dataset, i)))
+
+
+def bench_chunk_size(chunk_size, args):
+    with benchmark_setup(args) as (learning_process, dataset_params), torch.no_grad():
+        net = learning_process.net
+        name, us = next(test_sequences(dataset_params))
+        rss0 = max_rss()
+        start = time.perf_counter()
+        if chunk_size is None:
+            ys = net(us)
+        else:
+            ys = sn.chunked_forward(net, us, chunk_size)
+        elapsed = time.perf_counter() - start
+        mem = max_rss() - rss0
+        diff = 0. if chunk_size is None else (net(us) - ys).abs().max().item()
+    return elapsed, mem, diff
+
+
+def chunked(args):
+    """time and memory of chunked network evaluation on a full sequence"""
+    print("{:>10} | {:>10} {:>12} {:>12}".format('chunk', 'time (s)', 'memory (MB)',
+                                                 'max |diff|'))
+    # one process per chunk size so that peak memory is not shared
+    ctx = multiprocessing.get_context('spawn')
+    for chunk_size in [None] + args.chunk_sizes:
+        with ctx.Pool(1) as pool:
+            res = pool.apply(bench_chunk_size, (chunk_size, args))
+        print("{:>10} | {:>10.3f} {:>12.1f} {:>12.2e}".format(
+            'full' if chunk_size is None else chunk_size, *res))
+
+
+def shared(args):
+    """time per epoch of training with a shared network pass per sequence"""
+    with benchmark_setup(args) as (learning_process, dataset_params):
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            dataset = ds.BaseDataset(**dataset_params, mode='train')
+        dataset.init_train()
+        learning_process.net.set_normalized_factors(dataset.mean_u, dataset.std_u)
+        learning_process.net.train()
+        optimizer = torch.optim.Adam(learning_process.net.parameters(), lr=1e-4)
+        criterion = sl.GyroLoss(**loss_params)
+        criterion.set_precision(learning_process.precision)
+        iekf = learning_process.iekf
+        print("{:>10} | {:>14} {:>14}".format('windows', 'windows (s)', 'shared (s)'))
+        for n_windows in (1, 4, 16):
+            # same number of windows per sequence with both loops
+            dataloader = DataLoader(dataset, batch_size=n_windows * len(dataset),
+                                    sampler=list(range(len(dataset))) * n_windows)
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                time_windows = time_epochs(lambda: learning_process.loop_train(
+                    dataloader, optimizer, criterion, iekf), args.n_epochs)[0]
+                time_shared = time_epochs(lambda: learning_process.loop_train_shared(
+                    dataset, optimizer, criterion, iekf, n_windows), args.n_epochs)[0]
+            print("{:>10} | {:>14.3f} {:>14.3f}".format(n_windows * len(dataset),
+                                                       time_windows, time_shared))
+
+
+def models(args):
+    """size, cost, CPU latency and trajectory error of network classes"""
+    addresses = args.addresses or [None] * len(args.net_classes)
+    print("{:>18} | {:>10} {:>14} {:>18} {:>14}".format('net', 'parameters',
+        'MFLOP/1000', 'latency (ms/1000)', 'p RMSE (m)'))
+    for net_class, address in zip(args.net_classes, addresses):
+        with benchmark_setup(args, getattr(sn, net_class), address) as \
+                (learning_process, dataset_params):
+            net = learning_process.net
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                dataset = ds.BaseDataset(**dataset_params, mode='test')
+            times, errors = [], []
+            for i, (name, us) in enumerate(test_sequences(dataset_params)):
+                with torch.no_grad():
+                    times.append(1e3 * latency(net, us, args.n_repeats) / us.shape[1])
+                errors.append(trajectory_error(learning_process, net, dataset, i))
+            print("{:>18} | {:>10} {:>14.2f} {:>18.3f} {:>14.3f}".format(net_class,
+                sum(p.numel() for p in net.parameters()), count_flops(net) / 1e6,
+                1e3 * np.mean(times), np.mean(errors)))
+
+
+COLD_START = {
+    'learning': """
+import src.learning as lr
+import src.networks as sn
+learning_process = lr.GyroLearningBasedProcessing('', '', sn.GyroNet, None, {address!r}, 0.01)
+learning_process.net.eval()
+with torch.no_grad():
+    ys = learning_process.net(us)
+    us_fix, measurements_covs = learning_process.calibrate(ys, us)
+    learning_process.iekf.set_Q()
+    p = learning_process.iekf.run(t, us_fix, measurements_covs, v0.unsqueeze(1), None,
+                                  t.shape[1], ang0)[2]
+""",
+    'deployed': """
+from src.deploy import Pipeline
+p = Pipeline({path!r}).run(t, us, v0, ang0)[2]
+""",
+}
+"""code loading the network and filter, then filtering one sequence"""
+
+COLD_START_BEFORE = """
+import src.learning as lr
+import src.networks as sn
+learning_process = lr.GyroLearningBasedProcessing('', '', sn.GyroNet, None, {address!r}, 0.01)
+learning_process.net.eval()
+with torch.no_grad():
+    ys = learning_process.net(us).double()
+    us_fix = ys[:, :, :6] * us[:, :, :6] - ys[:, :, 6:12]
+    learning_process.iekf.set_Q()
+    p = learning_process.iekf.run(t, us_fix, ys[:, :, 12:14], v0.unsqueeze(1), None,
+                                  t.shape[1], ang0)[2]
+"""
+"""COLD_START['learning'] for the training code of an earlier revision, from
+before the calibration helpers"""
+
+
+def source_tree(revision, tmp_dir):
+    """extract the source tree of a git revision in tmp_dir"""
+    archive = subprocess.run(['git', 'archive', revision], check=True,
+                             cwd=os.path.dirname(os.path.realpath(__file__)),
+                             stdout=subprocess.PIPE).stdout
+    subprocess.run(['tar', '-x', '-C', tmp_dir], input=archive, check=True)
+    return tmp_dir
+
+
+def cold_start(code, cwd=None, **kwargs):
+    """time to first filter output, peak memory (MB) and positions of a new process"""
+    output = tempfile.mktemp()
+    script = """
+import time
+start = time.perf_counter()
+import resource
+import torch
+torch.manual_seed(0)
+t = 0.01 * torch.arange(200).double().unsqueeze(0)
+us = 0.1 * torch.randn(1, 200, 6).double()
+v0 = torch.zeros(1, 3).double()
+ang0 = torch.zeros(1, 3).double()
+{code}
+elapsed = time.perf_counter() - start
+torch.save((elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, p), {output!r})
+""".format(code=code.format(**kwargs), output=output)
+    subprocess.run([sys.executable, '-c', script], check=True, stdout=subprocess.DEVNULL,
+                   cwd=os.path.dirname(os.path.realpath(__file__)) if cwd is None else cwd)
+    res = torch.load(output)
+    os.remove(output)
+    return res
+
+
+def deploy(args):
+    """cold start of the exported pipeline against the training code, also
+    of an earlier revision with --before"""
+    from src.deploy import export_pipeline
+    tmp_dir = tempfile.mkdtemp()
+    with benchmark_setup(args) as (learning_process, dataset_params):
+        if args.address is None:  # results directory of the random network
+            learning_process.save_net(learning_process.iekf)
+            pdump(learning_process.train_params, learning_process.address, 'train_params.p')
+        path = os.path.join(learning_process.address, 'gyro_iekf.pt')
+        export_pipeline(learning_process, path)
+        print("{:>20} | {:>10} {:>12}".format('', 'start (s)', 'memory (MB)'))
+        ps = {}
+        runs = [(name, code, None) for name, code in COLD_START.items()]
+        if args.before is not None:
+            runs.insert(0, ('learning ' + args.before, COLD_START_BEFORE,
+                            source_tree(args.before, tmp_dir)))
+        try:
+            for name, code, cwd in runs:
+                elapsed, memory, ps[name] = cold_start(code, cwd,
+                    address=learning_process.address, path=path)
+                print("{:>20} | {:>10.2f} {:>12.1f}".format(name, elapsed, memory))
+        finally:
+            shutil.rmtree(tmp_dir)
+        for name in ps:
+            if name != 'deployed':
+                print("max |diff| of positions, {} against deployed: {:.2e}".format(
+                    name, (ps[name] - ps['deployed']).abs().max().item()))
+
+
+IMPORT = """
+import sys
+import time
+import resource
+start = time.perf_counter()
+import {module}
+elapsed = time.perf_counter() - start
+heavy = [name for name in ('matplotlib', 'tensorboard', 'navpy', 'yaml', 'termcolor')
+         if name in sys.modules]
+print(elapsed, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024, ','.join(heavy) or '-')
+"""
+"""import time (s), peak memory (MB) and optional dependencies of a module"""
+
+
+def import_cost(module, cwd):
+    res = subprocess.run([sys.executable, '-c', IMPORT.format(module=module)], check=True,
+                         cwd=cwd, stdout=subprocess.PIPE, stderr=subprocess.DEVNULL)
+    elapsed, memory, heavy = res.stdout.decode().split()
+    return float(elapsed), float(memory), heavy
+
+
+def imports(args):
+    """startup cost of the inference and training modules, in a new process each"""
+    modules = ['torch', 'src.deploy', 'src.networks', 'src.utils_IEKF', 'src.dataset',
+               'src.learning']
+    trees = {'current': os.path.dirname(os.path.realpath(__file__))}
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        if args.before is not None:  # source tree of an earlier revision
+            trees = {args.before: source_tree(args.before, tmp_dir), **trees}
+        print("{:>10} {:>16} | {:>10} {:>12}  {}".format('tree', 'module', 'import (s)',
+                                                      'memory (MB)', 'optional imports'))
+        for tree, cwd in trees.items():
+            for module in modules:
+                try:
+                    res = import_cost(module, cwd)
+                except subprocess.CalledProcessError:  # module not in this tree
+                    continue
+                print("{:>10} {:>16} | {:>10.2f} {:>12.1f}  {}".format(tree, module, *res))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def time_loading(dataset, batch_size, n_epochs):
+    """mean time of reading the batches of an epoch"""
+    dataloader = DataLoader(dataset, batch_size=batch_size)
+    start = time.perf_counter()
+    for _ in range(n_epochs):
+        for batch in dataloader:
+            pass
+    return (time.perf_counter() - start) / n_epochs
+
+
+def loading(args):
+    """data loading time per training epoch with and without the sequence cache"""
+    with benchmark_setup(args) as (_, dataset_params), \
+            migrated(dataset_params, 'columnar') as columnar_params:
+        print("{:>10} {:>24} | {:>14}".format('storage', '', 'epoch (ms)'))
+        for storage, params in (('pickle', dataset_params), ('columnar', columnar_params)):
+            for name, cache_size, preload, n_epochs in (
+                    ('no cache', 0, False, args.n_epochs),
+                    ('cache, first epoch', 4096, False, 1),
+                    ('cache, warm', 4096, False, args.n_epochs),
+                    ('preload', 4096, True, args.n_epochs)):
+                if name != 'cache, warm':
+                    ds.BaseDataset.sequence_cache.clear()
+                with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                    dataset = ds.BaseDataset(**dict(params, storage=storage), mode='train',
+                        cache_size=cache_size, preload=preload)
+                dataset.init_train()
+                print("{:>10} {:>24} | {:>14.2f}".format(storage, name, 1e3 * time_loading(
+                    dataset, args.batch_size, n_epochs)))
+
+
+def prefetch(args):
+    """time per training epoch and time waiting for batches, with batches read
+    in the loop or ahead by a background thread"""
+    with benchmark_setup(args) as (learning_process, dataset_params):
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            # without cache, sequences are read from disk at each epoch
+            dataset = ds.BaseDataset(**dataset_params, mode='train', cache_size=0)
+        dataset.init_train()
+        learning_process.net.set_normalized_factors(dataset.mean_u, dataset.std_u)
+        learning_process.net.train()
+        dataloader = DataLoader(dataset, batch_size=args.batch_size)
+        optimizer = torch.optim.Adam(learning_process.net.parameters(), lr=1e-4)
+        criterion = sl.GyroLoss(**loss_params)
+        criterion.set_precision(learning_process.precision)
+        iekf = learning_process.iekf
+        print("{:>10} | {:>10} {:>10}".format('prefetch', 'epoch (s)', 'idle (s)'))
+        for depth in (0, 2):
+            learning_process.prefetch = depth
+            epoch_time, _ = time_epochs(lambda: learning_process.loop_train(
+                dataloader, optimizer, criterion, iekf), args.n_epochs)
+            print("{:>10} | {:>10.3f} {:>10.3f}".format(depth, epoch_time,
+                                                        learning_process.idle_time))
+
+
+def store_files(store):
+    """files of the stored sequences"""
+    paths = []
+    for name in store.names():
+        path = store.path(name)
+        paths += [path] if os.path.isfile(path) else \
+            [os.path.join(path, f) for f in os.listdir(path)]
+    return paths
+
+
+def disk_size(store):
+    """bytes of the stored sequences"""
+    return sum(os.path.getsize(path) for path in store_files(store))
+
+
+def drop_page_cache(paths):
+    """evict files from the page cache (Linux), so that they are read from disk"""
+    os.sync()  # dirty pages are not evicted
+    for path in paths:
+        fd = os.open(path, os.O_RDONLY)
+        try:
+            os.posix_fadvise(fd, 0, 0, os.POSIX_FADV_DONTNEED)
+        finally:
+            os.close(fd)
+
+
+def time_load(store):
+    """time (s) to load all the sequences of a store and read their fields,
+    which memory-mapped fields only read from disk when accessed"""
+    start = time.perf_counter()
+    mondicts = [store.load(seq) for seq in store.names()]
+    for mondict in mondicts:
+        for x in mondict.values():
+            if isinstance(x, torch.Tensor):
+                x.sum()
+    return time.perf_counter() - start, mondicts
+
+
+def storage(args):
+    """disk footprint and loading time of the storage formats, from the page
+    cache (warm) and from disk (cold)"""
+    from src.storage import make_store
+    with benchmark_setup(args) as (_, dataset_params):
+        source = make_store('pickle', dataset_params['predata_dir'])
+        print("{:>22} | {:>10} {:>10} {:>10} {:>14}".format('storage', 'disk (MB)',
+            'warm (ms)', 'cold (ms)', 'max |diff|'))
+        for label, name, options in (
+                ('pickle', 'pickle', {}),
+                ('columnar', 'columnar', {}),
+                ('compressed', 'compressed', {}),
+                ('compressed, us float32', 'compressed', {'dtypes': {'us': 'float32'}})):
+            with migrated(dataset_params, name, **options) as params:
+                store = make_store(name, params['predata_dir'], **options)
+                warm, cold = 0, 0
+                for _ in range(args.n_repeats):
+                    warm += time_load(store)[0] / args.n_repeats
+                for _ in range(args.n_repeats):
+                    drop_page_cache(store_files(store))
+                    elapsed, mondicts = time_load(store)
+                    cold += elapsed / args.n_repeats
+                diff = max((mondict[key] - source.load(mondict['name'])[key]).abs().max().item()
+                           for mondict in mondicts for key in ('t', 'us', 'xs', 'p_gt'))
+                print("{:>22} | {:>10.2f} {:>10.2f} {:>10.2f} {:>14.2e}".format(
+                    label, disk_size(store) / 2**20, 1e3 * warm, 1e3 * cold, diff))
+
+
+def same_sequences(store, other):
+    """whether two stores hold the same sequences with equal fields"""
+    if store.names() != other.names():
+        return False
+    for name in store.names():
+        mondict, other_dict = store.load(name), other.load(name)
+        for key, x in mondict.items():
+            if isinstance(x, torch.Tensor):
+                if not torch.equal(x, other_dict[key]):
+                    return False
+            elif x != other_dict[key]:
+                return False
+    return True
+
+
+def ingest(args):
+    """serial against parallel preprocessing of raw KITTI drives"""
+    from src.storage import make_store
+    tmp_dir = tempfile.mkdtemp()
+    try:
+        stores, times = {}, {}
+        for n_workers in (1, args.n_workers):
+            stores[n_workers] = make_store('pickle', os.path.join(tmp_dir, str(n_workers)))
+            start = time.perf_counter()
+            with contextlib.redirect_stdout(open(os.devnull, 'w')):
+                ds.KITTIDataset.ingest(args.data_dir, stores[n_workers], n_workers)
+            times[n_workers] = time.perf_counter() - start
+            print("{:>3} workers: {:.1f} s".format(n_workers, times[n_workers]))
+        print("same output:", same_sequences(stores[1], stores[args.n_workers]))
+    finally:
+        shutil.rmtree(tmp_dir)
+
+
+def bench_stream_size(stream_size, args):
+    with benchmark_setup(args) as (learning_process, dataset_params), \
+            migrated(dataset_params, 'columnar') as dataset_params:
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            dataset = ds.BaseDataset(**dataset_params, mode='test', cache_size=0)
+        learning_process.net.set_normalized_factors(dataset.mean_u, dataset.std_u)
+        criterion = sl.GyroLoss(**loss_params)
+        criterion.set_precision(learning_process.precision)
+        iekf = learning_process.iekf
+        rss0 = max_rss()
+        start = time.perf_counter()
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            if stream_size is None:
+                learning_process.loop_test(dataset, criterion, iekf)
+            else:
+                learning_process.loop_test_streaming(dataset, criterion, iekf,
+                                                     learning_process.net, stream_size)
+        elapsed = time.perf_counter() - start
+        mem = max_rss() - rss0
+        loss = learning_process.load_test_result(dataset.sequences[0])['loss']
+    return elapsed, mem, loss
+
+
+def stream_test(args):
+    """time and memory of testing on full sequences against chunk by chunk"""
+    print("{:>10} | {:>10} {:>12} {:>12}".format('chunk', 'time (s)', 'memory (MB)',
+                                                 'loss'))
+    # one process per chunk size so that peak memory is not shared
+    ctx = multiprocessing.get_context('spawn')
+    for stream_size in [None] + args.stream_sizes:
+        with ctx.Pool(1) as pool:
+            res = pool.apply(bench_stream_size, (stream_size, args))
+        print("{:>10} | {:>10.3f} {:>12.1f} {:>12.3f}".format(
+            'full' if stream_size is None else stream_size, *res))
+
+
+def free_port():
+    """a free TCP port of localhost"""
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def bench_world_size(rank, world_size, port, args, results):
+    import torch.distributed as dist
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(port),
+                            rank=rank, world_size=world_size)
+    torch.set_num_threads(1)
+    with benchmark_setup(args) as (learning_process, dataset_params):
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            dataset = ds.BaseDataset(**dataset_params, mode='train')
+        dataset.init_train()
+        learning_process.net.set_normalized_factors(dataset.mean_u, dataset.std_u)
+        learning_process.net.train()
+        # the same windows per epoch, split between the processes
+        sampler = ds.WindowSampler(dataset, windows_per_epoch=args.n_windows,
+                                   num_replicas=world_size, rank=rank)
+        dataloader = DataLoader(dataset, batch_size=args.batch_size, sampler=sampler)
+        optimizer = torch.optim.Adam(learning_process.net.parameters(), lr=1e-4)
+        criterion = sl.GyroLoss(**loss_params)
+        criterion.set_precision(learning_process.precision)
+        iekf = learning_process.iekf
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            epoch_time, _ = time_epochs(lambda: learning_process.loop_train(
+                dataloader, optimizer, criterion, iekf), args.n_epochs)
+        learning_process.average_buffers()
+        weights = torch.cat([x.detach().double().flatten()
+                             for x in learning_process.net.state_dict().values()])
+        results.put((epoch_time, hashlib.sha1(weights.numpy().tobytes()).hexdigest()))
+    dist.destroy_process_group()
+
+
+def distributed(args):
+    """time per training epoch of data-parallel training in processes of one
+    thread, which must end with the same weights"""
+    ctx = multiprocessing.get_context('spawn')
+    print("{:>10} | {:>10} {:>12} {:>10} {:>12}".format('processes', 'epoch (s)',
+                                                       'windows/s', 'speedup', 'same weights'))
+    time_1 = None
+    for world_size in args.world_sizes:
+        results = ctx.SimpleQueue()
+        torch.multiprocessing.spawn(bench_world_size, nprocs=world_size,
+                                    args=(world_size, free_port(), args, results))
+        epoch_times, weights = zip(*[results.get() for _ in range(world_size)])
+        epoch_time = max(epoch_times)  # an epoch ends with the slowest process
+        time_1 = time_1 or epoch_time * world_size  # of one process
+        print("{:>10} | {:>10.3f} {:>12.1f} {:>10.2f} {:>12}".format(
+            world_size, epoch_time, args.n_windows / epoch_time, time_1 / epoch_time,
+            str(len(set(weights)) == 1)))
+
+
+def pss(pid):
+    """proportional set size of a process (MB), pages shared by processes being
+    divided between them (Linux)"""
+    with open('/proc/{}/smaps_rollup'.format(pid)) as f:
+        for line in f:
+            if line.startswith('Pss:'):
+                return int(line.split()[1]) / 1024
+
+
+def children(pid):
+    """pids of the child processes of a process (Linux)"""
+    pids = []
+    for tid in os.listdir('/proc/{}/task'.format(pid)):
+        with open('/proc/{}/task/{}/children'.format(pid, tid)) as f:
+            pids += [int(child) for child in f.read().split()]
+    return pids
+
+
+def bench_num_workers(_, num_workers, shared_memory, args, results):
+    with benchmark_setup(args) as (_, dataset_params):
+        with contextlib.redirect_stdout(open(os.devnull, 'w')):
+            dataset = ds.BaseDataset(**dataset_params, mode='train',
+                                     shared_memory=shared_memory)
+        # each worker reads a window of every sequence
+        sampler = [(i, 0) for i in range(len(dataset.sequences))
+                   for _ in range(max(num_workers, 1))]
+        dataloader = DataLoader(dataset, sampler=sampler, num_workers=num_workers,
+            persistent_workers=num_workers > 0,
+            multiprocessing_context=args.start_method if num_workers > 0 else None)
+        for batch in dataloader:
+            pass
+        # workers are still alive
+        pid = os.getpid()
+        results.put(pss(pid) + sum(pss(child) for child in children(pid)))
+        del dataloader
+
+
+def workers(args):
+    """memory of the training process and its DataLoader workers, with a
+    copy of the sequences per worker or the sequences in shared memory"""
+    print("{:>10} | {:>12} {:>12}".format('workers', 'copies (MB)', 'shared (MB)'))
+    ctx = multiprocessing.get_context('spawn')
+    for num_workers in args.num_workers:
+        mems = []
+        for shared_memory in (False, True):
+            # a process per measure, which may have workers
+            results = ctx.SimpleQueue()
+            torch.multiprocessing.spawn(bench_num_workers,
+                                        args=(num_workers, shared_memory, args, results))
+            mems.append(results.get())
+        print("{:>10} | {:>12.1f} {:>12.1f}".format(num_workers, *mems))
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('benchmark', choices=['precision', 'streaming', 'inference',
+                                              'quantized', 'chunked', 'shared',
+                                              'models', 'deploy', 'imports',
+                                              'loading', 'ingest', 'stream_test',
+                                              'storage', 'prefetch', 'distributed',
+                                              'workers'])
+    parser.add_argument('--address', default=None,
+                        help='results directory of a trained network, random network if not given')
+    parser.add_argument('--predata_dir', default=None,
+                        help='preprocessed data, random sequences if not given')
+    parser.add_argument('--seqs', nargs='+', default=[],
+                        help='sequences of predata_dir')
+    parser.add_argument('--n_seqs', type=int, default=4,
+                        help='number of random sequences')
+    parser.add_argument('--n_samples', type=int, default=2000,
+                        help='length of random sequences')
+    parser.add_argument('--N', type=int, default=400, help='training window size')
+    parser.add_argument('--batch_size', type=int, default=4)
+    parser.add_argument('--n_epochs', type=int, default=3)
+    parser.add_argument('--n_repeats', type=int, default=10,
+                        help='number of timed forward passes')
+    parser.add_argument('--backend', default='x86', choices=['x86', 'qnnpack'],
+                        help='quantized engine, qnnpack on ARM boards')
+    parser.add_argument('--chunk_sizes', type=int, nargs='+', default=[1000, 4096, 16384],
+                        help='chunk sizes of chunked network evaluation')
+    parser.add_argument('--stream_sizes', type=int, nargs='+', default=[1000, 10000],
+                        help='chunk sizes of the streaming test loop')
+    parser.add_argument('--net_classes', nargs='+', default=['GyroNet', 'SeparableGyroNet'],
+                        help='network classes of src/networks.py')
+    parser.add_argument('--addresses', nargs='+', default=None,
+                        help='results directories of trained networks, one per class')
+    parser.add_argument('--before', default=None,
+                        help='git revision whose import costs and cold start are also measured')
+    parser.add_argument('--data_dir', default=None, help='raw KITTI data')
+    parser.add_argument('--n_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--world_sizes', type=int, nargs='+', default=[1, 2, 4],
+                        help='numbers of processes of distributed training')
+    parser.add_argument('--n_windows', type=int, default=16,
+                        help='training windows per epoch')
+    parser.add_argument('--num_workers', type=int, nargs='+', default=[0, 1, 2, 4],
+                        help='numbers of DataLoader workers')
+    parser.add_argument('--start_method', default=multiprocessing.get_all_start_methods()[0],
+                        choices=multiprocessing.get_all_start_methods(),
+                        help='start method of DataLoader workers, spawn on Windows and macOS')
+    args = parser.parse_args()
+    getattr(sys.modules[__name__], args.benchmark)(args)
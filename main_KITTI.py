@@ -18,7 +18,7 @@ address = "last"
 ################################################################################
 # Network parameters
 ################################################################################
-net_class = sn.GyroNet
+net_class = sn.GyroNet  # or sn.SeparableGyroNet for on-board CPUs
 net_params = {
     'in_dim': 6,
     'out_dim': 6+6+2,
@@ -81,6 +81,21 @@ dataset_params = {
         ],
     # size of trajectory during training
     'N': 40 * 100,
+    # memory budget (MB) of the sequence cache shared by the datasets, and
+    # whether all sequences are loaded at dataset creation
+    'cache_size': 4096,
+    'preload': False,
+    # load the sequences once in shared memory, read by all DataLoader
+    # workers (see 'num_workers') instead of a copy per worker
+    'shared_memory': False,
+    # 'pickle', 'columnar' (memory-mapped, fastest to load) or 'compressed'
+    # (zlib chunks, smaller but slower to load), see tools_KITTI.py migrate
+    'storage': 'pickle',
+    # options of the storage, e.g. {'dtypes': {'us': 'float32'}} stores the
+    # compressed IMU samples in float32
+    'storage_options': {},
+    # processes converting the new or changed raw drives, see tools_KITTI.py ingest
+    'ingest_workers': 1,
 
 }
 ################################################################################
@@ -113,6 +128,29 @@ train_params = {
         'num_workers': 0,
         'shuffle': False,
     },
+    # dtype of network, calibration head, loss, filter and Lie group stages,
+    # see src/precision.py ('mixed', 'float64', 'float32' or a dict of stages)
+    'precision': 'mixed',
+    # if set, batches are windows drawn over all training sequences instead
+    # of one window per sequence, e.g. {'stride': 10, 'windows_per_epoch':
+    # 1024, 'weighting': 'length'}, see src/dataset.py WindowSampler
+    'sampler': None,
+    # add the input noise in the DataLoader workers (see 'num_workers'), or
+    # in the prefetch thread from its own generator, instead of the main process
+    'worker_noise': False,
+    # number of batches (test sequences) read ahead by a background thread
+    # while the filter runs, idle time is logged at each epoch
+    'prefetch': 2,
+    # if set, data-parallel training in world_size CPU processes, which
+    # average their gradients at each step, e.g. {'world_size': 4, 'port':
+    # 29500, 'threads': 1, 'seed': 0}, see src/learning.py train_process
+    'distributed': None,
+    # if set, the network is run once per training sequence and this number
+    # of windows is sliced from its output for the filter at each epoch
+    'shared_windows': None,
+    # fine-tune only the filter factors on cached outputs of the loaded
+    # network, e.g. {'max_items': 64, 'directory': None, 'noise_seeds': 8}
+    'output_cache': None,
     # frequency of validation step
     'freq_val': 50,
     # total number of epochs
@@ -126,22 +164,24 @@ train_params = {
 
 
 
-################################################################################
-# Train on training data set
-################################################################################
+# processes of distributed training import this file again
+if __name__ == '__main__':
+    ############################################################################
+    # Train on training data set
+    ############################################################################
 
-learning_process = lr.GyroLearningBasedProcessing(train_params['res_dir'],
-   train_params['tb_dir'], net_class, net_params, None,
-   train_params['loss']['dt'])
-learning_process.train(dataset_class, dataset_params, train_params)
+    learning_process = lr.GyroLearningBasedProcessing(train_params['res_dir'],
+       train_params['tb_dir'], net_class, net_params, None,
+       train_params['loss']['dt'])
+    learning_process.train(dataset_class, dataset_params, train_params)
 
-print("finish training")
+    print("finish training")
 
-################################################################################
-# Test on full data set
-################################################################################
-learning_process = lr.GyroLearningBasedProcessing(train_params['res_dir'],
-    train_params['tb_dir'], net_class, net_params, address=address,
-    dt=train_params['loss']['dt'])
-learning_process.test(dataset_class, dataset_params, ['test'],display_only=display_only)
-print("finish testing")
+    ############################################################################
+    # Test on full data set
+    ############################################################################
+    learning_process = lr.GyroLearningBasedProcessing(train_params['res_dir'],
+        train_params['tb_dir'], net_class, net_params, address=address,
+        dt=train_params['loss']['dt'])
+    learning_process.test(dataset_class, dataset_params, ['test'],display_only=display_only)
+    print("finish testing")
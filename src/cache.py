@@ -0,0 +1,156 @@
+import os
+import glob
+import shutil
+import hashlib
+from collections import OrderedDict
+import torch
+
+
+class OutputCache:
+    """Least recently used cache of network outputs on full sequences.
+
+    Entries are keyed by (weights hash, sequence, noise seed) and kept in
+    memory, or in a subdirectory of ``directory`` per weights hash if given,
+    up to ``max_items`` entries. Weights are hashed again after invalidate,
+    e.g. at each optimizer step. As soon as they change, entries of the
+    previous weights are dropped, leaving the subdirectories of other
+    networks sharing the directory.
+    """
+
+    def __init__(self, max_items=32, directory=None):
+        self.max_items = max_items
+        self.directory = directory
+        self.items = OrderedDict()
+        self.net_hash = None
+        self.stale = True  # whether the weights may have changed
+        if directory is not None:
+            os.makedirs(directory, exist_ok=True)
+
+    @staticmethod
+    def weights_hash(net):
+        """hash of the parameters and buffers of a network"""
+        h = hashlib.sha1()
+        for name, x in net.state_dict().items():
+            h.update(name.encode())
+            h.update(x.detach().cpu().contiguous().numpy().tobytes())
+        return h.hexdigest()[:16]
+
+    def path(self, key):
+        return os.path.join(self.directory, key[0], "{}_{}.pt".format(*key[1:]))
+
+    def invalidate(self):
+        """hash the weights again at the next access"""
+        self.stale = True
+
+    def validate(self, net):
+        """key prefix of the current weights, dropping entries of previous ones"""
+        if not self.stale:
+            return self.net_hash
+        net_hash = self.weights_hash(net)
+        self.stale = False
+        if net_hash != self.net_hash:
+            for key in [key for key in self.items if key[0] != net_hash]:
+                del self.items[key]
+            if self.directory is not None:
+                if self.net_hash is not None:
+                    shutil.rmtree(os.path.join(self.directory, self.net_hash),
+                                  ignore_errors=True)
+                os.makedirs(os.path.join(self.directory, net_hash), exist_ok=True)
+            self.net_hash = net_hash
+        return net_hash
+
+    def get(self, net, sequence, seed):
+        key = (self.validate(net), sequence, seed)
+        if self.directory is None:
+            if key not in self.items:
+                return None
+            self.items.move_to_end(key)
+            return self.items[key]
+        path = self.path(key)
+        if not os.path.exists(path):
+            return None
+        os.utime(path)  # most recently used
+        return torch.load(path)
+
+    def put(self, net, sequence, seed, ys):
+        key = (self.validate(net), sequence, seed)
+        ys = ys.detach()
+        if self.directory is None:
+            self.items[key] = ys
+            self.items.move_to_end(key)
+            while len(self.items) > self.max_items:
+                self.items.popitem(last=False)
+            return
+        torch.save(ys, self.path(key))
+        paths = sorted(glob.glob(os.path.join(self.directory, key[0], '*.pt')),
+                       key=os.path.getmtime)
+        for path in paths[:max(len(paths) - self.max_items, 0)]:
+            os.remove(path)
+
+    def clear(self):
+        self.items.clear()
+        if self.directory is not None and self.net_hash is not None:
+            shutil.rmtree(os.path.join(self.directory, self.net_hash), ignore_errors=True)
+        self.net_hash = None
+        self.stale = True
+
+
+class SequenceCache:
+    """Least recently used cache of loaded sequences within a memory budget.
+
+    Datasets share one cache, so train and val datasets reading the same
+    sequence files load each of them once. Its budget is the largest one
+    reserved by the datasets. An entry larger than the budget is not kept.
+    """
+
+    def __init__(self, max_bytes=4 * 2**30):
+        self.max_bytes = max_bytes
+        self.items = OrderedDict()
+        self.n_bytes = 0
+
+    @staticmethod
+    def size(mondict):
+        """bytes of the tensors and arrays of a sequence"""
+        n_bytes = 0
+        for x in mondict.values():
+            if isinstance(x, torch.Tensor):
+                n_bytes += x.numel() * x.element_size()
+            elif hasattr(x, 'nbytes'):
+                n_bytes += x.nbytes
+        return n_bytes
+
+    def reserve(self, max_bytes):
+        """raise the budget to at least max_bytes"""
+        self.max_bytes = max(self.max_bytes, max_bytes)
+
+    def resize(self, max_bytes):
+        """set the budget, evicting the least recently used entries above it"""
+        self.max_bytes = max_bytes
+        self.evict()
+
+    def remove(self, key):
+        _, n_bytes = self.items.pop(key)
+        self.n_bytes -= n_bytes
+
+    def evict(self):
+        while self.n_bytes > self.max_bytes:
+            _, (_, n_bytes) = self.items.popitem(last=False)
+            self.n_bytes -= n_bytes
+
+    def get(self, key, load, size=None):
+        """cached value of key, computed by load() if missing. size(value) is
+        the number of bytes it counts in the budget, self.size by default"""
+        if key in self.items:
+            self.items.move_to_end(key)
+            return self.items[key][0]
+        value = load()
+        n_bytes = (self.size if size is None else size)(value)
+        if n_bytes <= self.max_bytes:
+            self.items[key] = (value, n_bytes)
+            self.n_bytes += n_bytes
+            self.evict()
+        return value
+
+    def clear(self):
+        self.items.clear()
+        self.n_bytes = 0
@@ -1,7 +1,10 @@
 from src.utils import pdump, pload, bmtm
 from src.lie_algebra import SO3
+from src.cache import SequenceCache
+from src.storage import make_store
 from termcolor import cprint
 from torch.utils.data.dataset import Dataset
+from torch.utils.data.sampler import Sampler
 # from scipy.interpolate import interp1d
 import numpy as np
 # import matplotlib.pyplot as plt
@@ -10,17 +13,33 @@ import os
 import torch
 # import sys
 import glob
+import json
+import hashlib
 from collections import OrderedDict
 from collections import namedtuple
-from navpy import lla2ned
-import datetime
+import time
+import queue
+import threading
+from concurrent.futures import ProcessPoolExecutor, as_completed
 
 class BaseDataset(Dataset):
+    # loaded sequences, shared by all datasets of the process
+    sequence_cache = SequenceCache(max_bytes=0)
 
-    def __init__(self, predata_dir, train_seqs, val_seqs, test_seqs, mode, N,  dt=0.01):
+    def __init__(self, predata_dir, train_seqs, val_seqs, test_seqs, mode, N,  dt=0.01,
+                 cache_size=4096, preload=False, storage='pickle', shared_memory=False,
+                 storage_options=None):
         super().__init__()
         # where record pre loaded data
         self.predata_dir = predata_dir
+        # format of pre loaded data and its options, see src/storage.py
+        self.store = make_store(storage, predata_dir, **(storage_options or {}))
+        # memory budget of the sequence cache (MB), 0 reads files at each access
+        self.cache_size = cache_size * 2**20
+        self.sequence_cache.reserve(self.cache_size)
+        # sequences loaded once in shared memory, see preload
+        self.shared_memory = shared_memory
+        self.shared = {}
         self.path_normalize_factors = os.path.join(predata_dir, 'nf.p')
         self.mode = mode  # train, val or test
         # choose between training, validation or test sequences
@@ -35,11 +54,27 @@ class BaseDataset(Dataset):
         self.imu_std = torch.Tensor([8e-5, 1e-3]).double()
         # bias repeatability (without in-run bias stability)
         self.imu_b0 = torch.Tensor([1e-3, 1e-3]).double()
+        # noise added to the inputs during training, per channel (gyro, acc):
+        # noise density, in run bias stability, and bias repeatability as a
+        # uniform range around an offset
+        self.noise_std = torch.Tensor([1e-3] * 3 + [1e-2] * 3).double()
+        self.noise_bias = torch.Tensor([1e-5] * 3 + [1e-4] * 3).double()
+        self.noise_b0 = torch.Tensor([1e-5] * 3 + [1e-5] * 3).unsqueeze(1)
+        self.noise_b0_offset = torch.Tensor([2e-2] * 3 + [5e-1] * 3).unsqueeze(1)
+        # imu_b0 = [[5e-3, 5e-2], [2e-2, 5e-1]] #random bias between 0.015-0.025 for gyro & 0.45-0.55 for acc
+        # whether __getitem__ returns noisy inputs, so that DataLoader workers
+        # add noise in parallel
+        self.augment = False
+        # generator of the noise of __getitem__, None for the global one
+        self.noise_generator = None
         # IMU sampling time
         self.dt = dt # (s)
         # sequence size during training
         self.N = N # power of 2
 
+        if preload or shared_memory:
+            self.preload()
+
         self.uni = torch.distributions.uniform.Uniform(-torch.ones(1), torch.ones(1))
         self.normal = torch.distributions.normal.Normal(torch.Tensor([0.0]), torch.Tensor([1.0]))
         self.gamma = torch.distributions.gamma.Gamma(torch.tensor([1.0]), torch.tensor([1.0]))
@@ -54,12 +89,32 @@ class BaseDataset(Dataset):
         return sequences_dict['train'], sequences_dict[self.mode]
 
     def __getitem__(self, i):
-        mondict = self.load_seq(i)
-        N_max = mondict['xs'].shape[0]
+        if isinstance(i, tuple):  # (sequence, start) of a window, see WindowSampler
+            i, n0 = i
+            mondict = self.load_seq(i)
+            nend = n0 + self.N
+        else:
+            mondict = self.load_seq(i)
+            n0, nend = self.window(mondict['xs'].shape[0])
+        t = mondict['t'][n0: nend]
+        u = mondict['us'][n0: nend]
+        x = mondict['xs'][n0: nend]
+        p_gt = mondict['p_gt'][n0: nend]
+        v_gt = mondict['v_gt'][n0: nend]
+        ang_gt = mondict['ang_gt'][n0: nend]
+        Rot_gt = mondict['Rot_gt'][n0: nend]
+        Rot_xs = mondict['Rot_xs'][n0: nend]
+        name = mondict['name']
+        if self.augment:
+            u = self.add_noise(u, generator=self.noise_generator)
+        return t, u, x, p_gt, v_gt, ang_gt, Rot_gt, Rot_xs, name
+
+    def window(self, N_max):
+        """start and end of the window of a sequence depending on mode"""
         if self._train: # random start
             # n0 = torch.randint(0, 40*100, (1, ))
             # nend = n0 + self.N
-            n0 = 10 * int(np.random.randint(0, (N_max - self.N)/10))
+            n0 = self.random_start(N_max)
             nend = n0 + self.N
         elif self._val: # end sequence
             n0 = 0
@@ -71,47 +126,47 @@ class BaseDataset(Dataset):
             # nend = n0 + 3*self.N+100
             nend = N_max
             # nend = 25*100
-        t = mondict['t'][n0: nend]
-        u = mondict['us'][n0: nend]
-        x = mondict['xs'][n0: nend]
-        p_gt = mondict['p_gt'][n0: nend]
-        v_gt = mondict['v_gt'][n0: nend]
-        ang_gt = mondict['ang_gt'][n0: nend]
-        name = mondict['name']
-        return t, u, x, p_gt, v_gt, ang_gt, name
+        return n0, nend
 
     def __len__(self):
         return len(self.sequences)
 
-    def add_noise(self, u):
-        """Add Gaussian noise and bias to input"""
-
-        # noise density
-        imu_std = torch.Tensor([1e-3, 1e-2]).double()
-        #in run bias stability
-        imu_bias = torch.Tensor([1e-5, 1e-4]).double()
-        # bias repeatability (without in-run bias stability)
-        imu_b0 = torch.Tensor([[1e-5, 1e-5], [2e-2, 5e-1]]).double()
-        # imu_b0 = torch.Tensor([[5e-3, 5e-2], [2e-2, 5e-1]]).double() #random bias between 0.015-0.025 for gyro & 0.45-0.55 for acc
-
-
-        noise = torch.randn_like(u)
-        bias = torch.randn_like(u)    
-
-        noise[:, :, :3] = noise[:, :, :3] * imu_std[0]
-        noise[:, :, 3:6] = noise[:, :, 3:6] * imu_std[1]
-
-        bias[:, :, :3] = bias[:, :, :3] * imu_bias[0]
-        bias[:, :, 3:6] = bias[:, :, 3:6] * imu_bias[1]
-
-        b0 = self.uni.sample(u[:, 0].shape)
-        b0[:, :3, :] = b0[:, :3, :] * imu_b0[0, 0] + imu_b0[1, 0]
-        b0[:, 3:6, :] = b0[:, 3:6, :] * imu_b0[0, 1] + imu_b0[1, 1]
+    def seq_lengths(self):
+        """number of samples of each sequence"""
+        return [self.load_seq(i)['xs'].shape[0] for i in range(len(self.sequences))]
+
+    def random_start(self, N_max):
+        """random start of a training window, multiple of 10 samples"""
+        return 10 * int(np.random.randint(0, (N_max - self.N)/10))
+
+    def add_noise(self, u, b0=None, generator=None):
+        """Add Gaussian noise and bias to input, a window (N x 6) or a batch
+        of windows (batch x N x 6). The constant bias b0 of each window is
+        drawn if not given, see sample_b0. Draws are from generator, the
+        global one by default"""
+        # constants in the dtype of u, which is kept
+        noise = torch.randn(u.shape, generator=generator, dtype=u.dtype,
+                            device=u.device) * self.noise_std.to(u)
+        bias = torch.randn(u.shape, generator=generator, dtype=u.dtype,
+                           device=u.device) * self.noise_bias.to(u)
+        if b0 is None:
+            b0 = self.sample_b0(u[..., 0, :].shape, generator)
+        u = u + noise + b0.to(u) + bias
+        return u
 
+    def sample_b0(self, shape, generator=None):
+        """constant biases (shape[:-1] x 1 x 6) of windows of samples of shape"""
+        # as self.uni.sample(shape), which takes no generator
+        uni = self.uni.low + torch.rand(shape + self.uni.batch_shape, generator=generator) * \
+            (self.uni.high - self.uni.low)
+        b0 = uni * self.noise_b0 + self.noise_b0_offset
+        return b0.transpose(-1, -2)
 
-        u = u + noise + b0.transpose(1, 2) + bias 
-        # u = u + noise + b0[:, :, :, 0]
-        return u
+    @staticmethod
+    def seed_worker(worker_id):
+        """worker_init_fn of DataLoader: numpy draws (window starts) of each
+        worker from the seed given by torch to the worker (noise)"""
+        np.random.seed(torch.initial_seed() % 2**32)
 
     def init_train(self):
         self._train = True
@@ -125,54 +180,108 @@ class BaseDataset(Dataset):
         return self._length
 
     def load_seq(self, i):
-        return pload(self.predata_dir, self.sequences[i] + '.p')
+        """sequence dict, read-only as it is shared through the sequence cache"""
+        if i in self.shared:
+            return self.shared[i]
+        name = self.sequences[i]
+        if self.cache_size == 0:
+            return self.add_rotations(self.store.load(name))
+        # a sequence saved again, e.g. by ingest, is loaded again
+        key = (self.store.path(name), self.store.stamp(name))
+        if key not in self.sequence_cache.items:
+            for old_key in [k for k in self.sequence_cache.items if k[0] == key[0]]:
+                self.sequence_cache.remove(old_key)
+        mapped = []
+
+        def load():
+            mondict = self.store.load(name)
+            # memory-mapped fields take no memory of their own, the OS reads
+            # and evicts their pages, only the fields added at loading count
+            if self.store.mapped:
+                mapped.extend(mondict)
+            return self.add_rotations(mondict)
+        return self.sequence_cache.get(key, load, lambda mondict: self.sequence_cache.size(
+            {field: x for field, x in mondict.items() if field not in mapped}))
+
+    @staticmethod
+    def add_rotations(mondict):
+        """Add to a sequence its ground truth orientations Rot_gt and the
+        rotations Rot_xs of its ground truth increments xs, so that they are
+        not recomputed at each epoch. Sequences preprocessed before they were
+        stored get them at loading"""
+        if 'Rot_gt' not in mondict:
+            ang_gt = mondict['ang_gt']
+            mondict['Rot_gt'] = SO3.from_rpy(ang_gt[:, 0], ang_gt[:, 1], ang_gt[:, 2])
+        if 'Rot_xs' not in mondict:
+            mondict['Rot_xs'] = SO3.exp(mondict['xs'][:, :3])
+        return mondict
+
+    def iter_chunks(self, i, chunk_size):
+        """Yield (n0, chunk) with the fields of the samples n0 to n0 +
+        chunk_size of a sequence, read from the store without the sequence
+        cache. With the columnar and compressed stores, only a chunk is read,
+        so that memory does not grow with the length of the sequence"""
+        # sequences are as long as xs, as in __getitem__
+        for n0, chunk in self.store.chunks(self.sequences[i], chunk_size, 'xs'):
+            yield n0, self.add_rotations(chunk)
+
+    def preload(self):
+        """Load all the sequences of the dataset in the sequence cache.
+
+        With shared_memory, their tensors are moved to shared memory and kept
+        by the dataset, so that DataLoader workers, forked or sent the pickled
+        dataset, read them without a copy of their own. Workers only slice
+        them, as sequences are read-only.
+        """
+        for i in range(len(self.sequences)):
+            mondict = self.load_seq(i)
+            if self.shared_memory:
+                for x in mondict.values():
+                    if isinstance(x, torch.Tensor):
+                        x.share_memory_()
+                self.shared[i] = mondict
 
     def load_gt(self, i):
         return pload(self.predata_dir, self.sequences[i] + '_gt.p')
 
     def init_normalize_factors(self, train_seqs):
-        if os.path.exists(self.path_normalize_factors):
-            mondict = pload(self.path_normalize_factors)
-            return mondict['mean_u'], mondict['std_u']
+        """Mean and standard deviation of the inputs of the training sequences.
 
-        path = os.path.join(self.predata_dir, train_seqs[0] + '.p')
-        if not os.path.exists(path):
+        Each sequence is loaded once for its count, mean and sum of squared
+        deviations, which are kept in nf.p and merged (Chan et al.), so that
+        another list of training sequences only loads its new sequences.
+        """
+        normalize_factors = {'train_seqs': None, 'partials': {}}
+        if os.path.exists(self.path_normalize_factors):
+            normalize_factors = pload(self.path_normalize_factors)
+            if 'partials' not in normalize_factors:  # from a previous version
+                normalize_factors = {'train_seqs': None, 'partials': {}}
+            if normalize_factors['train_seqs'] == list(train_seqs):
+                return normalize_factors['mean_u'], normalize_factors['std_u']
+
+        partials = normalize_factors['partials']
+        missing = [sequence for sequence in train_seqs if sequence not in partials]
+        if missing and not self.store.exists(missing[0]):
             print("init_normalize_factors not computed")
             return 0, 0
 
         print('Start computing normalizing factors ...')
         cprint("Do it only on training sequences, it is vital!", 'yellow')
-        # first compute mean
-        num_data = 0
-
-        for i, sequence in enumerate(train_seqs):
-            pickle_dict = pload(self.predata_dir, sequence + '.p')
-            us = pickle_dict['us']
-            sms = pickle_dict['xs']
-            if i == 0:
-                mean_u = us.sum(dim=0)
-                num_positive = sms.sum(dim=0)
-                num_negative = sms.shape[0] - sms.sum(dim=0)
-            else:
-                mean_u += us.sum(dim=0)
-                num_positive += sms.sum(dim=0)
-                num_negative += sms.shape[0] - sms.sum(dim=0)
-            num_data += us.shape[0]
-        mean_u = mean_u / num_data
-        pos_weight = num_negative / num_positive
-
-        # second compute standard deviation
-        for i, sequence in enumerate(train_seqs):
-            pickle_dict = pload(self.predata_dir, sequence + '.p')
-            us = pickle_dict['us']
-            if i == 0:
-                std_u = ((us - mean_u) ** 2).sum(dim=0)
-            else:
-                std_u += ((us - mean_u) ** 2).sum(dim=0)
-        std_u = (std_u / num_data).sqrt()
+        for sequence in missing:
+            pickle_dict = self.store.load(sequence)
+            partials[sequence] = self.partial_stats(pickle_dict['us'], pickle_dict['xs'])
+        stats = partials[train_seqs[0]]
+        for sequence in train_seqs[1:]:
+            stats = self.merge_stats(stats, partials[sequence])
+        num_data = stats['n']
+        mean_u = stats['mean']
+        std_u = (stats['m2'] / num_data).sqrt()
+        pos_weight = (num_data - stats['n_positive']) / stats['n_positive']
         normalize_factors = {
             'mean_u': mean_u,
             'std_u': std_u,
+            'train_seqs': list(train_seqs),
+            'partials': partials,
         }
         print('... ended computing normalizing factors')
         print('pos_weight:', pos_weight)
@@ -180,9 +289,40 @@ class BaseDataset(Dataset):
         print('mean_u    :', mean_u)
         print('std_u     :', std_u)
         print('num_data  :', num_data)
-        pdump(normalize_factors, self.path_normalize_factors)
+        self.save_normalize_factors(normalize_factors, self.path_normalize_factors)
         return mean_u, std_u
 
+    @staticmethod
+    def save_normalize_factors(normalize_factors, path):
+        # a temporary file per process, never leave a truncated file
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        pdump(normalize_factors, tmp_path)
+        os.replace(tmp_path, path)
+
+    @staticmethod
+    def partial_stats(us, xs):
+        """count, mean and sum of squared deviations of the inputs us, and
+        count of positive xs, of one sequence"""
+        mean = us.mean(dim=0)
+        return {
+            'n': us.shape[0],
+            'mean': mean,
+            'm2': ((us - mean) ** 2).sum(dim=0),
+            'n_positive': xs.sum(dim=0),
+        }
+
+    @staticmethod
+    def merge_stats(a, b):
+        """statistics of the union of two sets from their partial_stats"""
+        n = a['n'] + b['n']
+        delta = b['mean'] - a['mean']
+        return {
+            'n': n,
+            'mean': a['mean'] + delta * b['n'] / n,
+            'm2': a['m2'] + b['m2'] + delta ** 2 * a['n'] * b['n'] / n,
+            'n_positive': a['n_positive'] + b['n_positive'],
+        }
+
     def read_data(self, data_dir):
         raise NotImplementedError
 
@@ -206,6 +346,134 @@ class BaseDataset(Dataset):
             return x_int
 
 
+class WindowSampler(Sampler):
+    """Training windows (sequence, start) of a dataset, drawn with
+    replacement from the starts every stride samples of all its sequences.
+
+    An epoch is windows_per_epoch windows, by default the number of
+    sequences. With weighting 'length', every window is equally likely, so
+    long sequences are seen more often. With 'sequence', a sequence is drawn
+    uniformly and then one of its windows, as done by the dataset without
+    sampler.
+
+    In distributed training, the num_replicas processes draw the same windows
+    from seed and the epoch given by set_epoch, and process rank takes every
+    num_replicas-th of them.
+    """
+
+    def __init__(self, dataset, stride=10, windows_per_epoch=None, weighting='length',
+                 num_replicas=1, rank=0, seed=0):
+        if weighting not in ('length', 'sequence'):
+            raise ValueError("unknown weighting: {}".format(weighting))
+        self.dataset = dataset
+        self.stride = stride
+        self.windows_per_epoch = windows_per_epoch or len(dataset.sequences)
+        self.weighting = weighting
+        self.num_replicas = num_replicas
+        self.rank = rank
+        self.seed = seed
+        self.epoch = 0
+        # starts of all the windows, sequence after sequence
+        self.n_starts = [max((N_max - dataset.N - 1) // stride + 1, 0)
+                         for N_max in dataset.seq_lengths()]
+        self.offsets = np.cumsum([0] + self.n_starts)
+        if self.offsets[-1] == 0:
+            raise ValueError("sequences are shorter than the windows")
+
+    def set_epoch(self, epoch):
+        self.epoch = epoch
+
+    def __iter__(self):
+        if self.num_replicas == 1:
+            random = np.random
+        else:  # the same windows in all processes
+            random = np.random.RandomState(self.seed + self.epoch)
+        if self.weighting == 'length':
+            k = random.randint(0, self.offsets[-1], self.windows_per_epoch)
+        else:
+            valid = np.flatnonzero(self.n_starts)
+            i = valid[random.randint(0, len(valid), self.windows_per_epoch)]
+            k = self.offsets[i] + (random.rand(self.windows_per_epoch) *
+                                   np.asarray(self.n_starts)[i]).astype(np.int64)
+        k = k[self.rank::self.num_replicas]
+        i_seqs = np.searchsorted(self.offsets, k, side='right') - 1
+        for i, k_i in zip(i_seqs.tolist(), k.tolist()):
+            yield i, self.stride * (k_i - int(self.offsets[i]))
+
+    def __len__(self):
+        return len(range(self.rank, self.windows_per_epoch, self.num_replicas))
+
+
+class Prefetcher:
+    """Iterate over an iterable, e.g. a DataLoader, while a background thread
+    prepares its next depth items in a bounded queue, so that loading, slicing
+    and noise of the next batches or sequences overlap the filter.
+
+    idle_time is the time (s) the last iteration waited for items. With depth
+    0, items are read in the calling thread, and idle_time is their loading
+    time.
+    """
+    _end = object()
+
+    def __init__(self, iterable, depth=2):
+        self.iterable = iterable
+        self.depth = depth
+        self.idle_time = 0
+
+    def __len__(self):
+        return len(self.iterable)
+
+    def __iter__(self):
+        self.idle_time = 0
+        if self.depth == 0:
+            iterator = iter(self.iterable)
+            while True:
+                start = time.perf_counter()
+                item = next(iterator, self._end)
+                self.idle_time += time.perf_counter() - start
+                if item is self._end:
+                    return
+                yield item
+
+        items = queue.Queue(self.depth)
+        stop = threading.Event()
+
+        def put(item):
+            """put unless the iteration stopped"""
+            while not stop.is_set():
+                try:
+                    items.put(item, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def produce():
+            try:
+                for item in self.iterable:
+                    if not put((item, None)):
+                        return
+                put((self._end, None))
+            except Exception as error:
+                put((self._end, error))
+
+        thread = threading.Thread(target=produce, daemon=True)
+        thread.start()
+        try:
+            while True:
+                start = time.perf_counter()
+                item, error = items.get()
+                self.idle_time += time.perf_counter() - start
+                if item is self._end:
+                    if error is not None:
+                        raise error
+                    return
+                yield item
+        finally:  # also when the loop is left early
+            stop.set()
+            thread.join()
+
+
 class KITTIDataset(BaseDataset):
     """
         Dataloader for the KITTI Data Set.
@@ -220,24 +488,34 @@ class KITTIDataset(BaseDataset):
                                                                                   'velmode, '
                                                                                   'orimode')
 
-    # Bundle into an easy-to-access structure
-    OxtsData = namedtuple('OxtsData', 'packet, T_w_imu')
     min_seq_dim = 80 * 100  # 25 s
+    # increment when read_drive output changes, to reprocess all drives
+    preprocessing_version = 4
+    # record of the preprocessed drives, in predata_dir
+    ingest_manifest = 'ingest.json'
 
     def __init__(self, data_dir, predata_dir, train_seqs, val_seqs,
-                test_seqs, mode, N,  dt=0.01):
-        super().__init__(predata_dir, train_seqs, val_seqs, test_seqs, mode, N,  dt)
+                test_seqs, mode, N,  dt=0.01, cache_size=4096, preload=False,
+                storage='pickle', ingest_workers=1, shared_memory=False, storage_options=None):
+        super().__init__(predata_dir, train_seqs, val_seqs, test_seqs, mode, N,  dt,
+                         cache_size, storage=storage, storage_options=storage_options)
         # convert raw data to pre loaded data
-        self.read_data(data_dir)
-
-    def read_data(self, data_dir):
+        self.read_data(data_dir, ingest_workers)
+        # factors computed before may be of the drives converted since
+        self.mean_u, self.std_u = self.init_normalize_factors(train_seqs)
+        self.shared_memory = shared_memory
+        if preload or shared_memory:
+            self.preload()
 
-        f = os.path.join(self.predata_dir, '2011_09_26_drive_0022_extract.p')
-        if True and os.path.exists(f):
+    def read_data(self, data_dir, n_workers=1):
+        if not os.path.isdir(data_dir):  # only pre loaded data is available
             return
+        self.ingest(data_dir, self.store, n_workers)
 
-        print("Start read_data")
-        t_tot = 0  # sum of times for the all dataset
+    @staticmethod
+    def list_drives(data_dir):
+        """(path, name) of the drive directories of the raw data set"""
+        drives = []
         date_dirs = os.listdir(data_dir)
         for n_iter, date_dir in enumerate(date_dirs):
             # get access to each sequence
@@ -250,240 +528,298 @@ class KITTIDataset(BaseDataset):
                 path2 = os.path.join(path1, date_dir2)
                 if not os.path.isdir(path2):
                     continue
-                # read data
-                oxts_files = sorted(glob.glob(os.path.join(path2, 'oxts', 'data', '*.txt')))
-                oxts = self.load_oxts_packets_and_poses(oxts_files)
-
-                print("\n Sequence name : " + date_dir2)
-                if len(oxts) < KITTIDataset.min_seq_dim:  #  sequence shorter than 30 s are rejected
-                    cprint("Dataset is too short ({:.2f} s)".format(len(oxts) / 100), 'yellow')
-                    continue
-                lat_oxts = np.zeros(len(oxts))
-                lon_oxts = np.zeros(len(oxts))
-                alt_oxts = np.zeros(len(oxts))
-                roll_oxts = np.zeros(len(oxts))
-                pitch_oxts = np.zeros(len(oxts))
-                yaw_oxts = np.zeros(len(oxts))
-                roll_gt = np.zeros(len(oxts))
-                pitch_gt = np.zeros(len(oxts))
-                yaw_gt = np.zeros(len(oxts))
-                t = self.load_timestamps(path2)
-                acc = np.zeros((len(oxts), 3))
-                acc_bis = np.zeros((len(oxts), 3))
-                gyro = np.zeros((len(oxts), 3))
-                gyro_bis = np.zeros((len(oxts), 3))
-                p_gt = np.zeros((len(oxts), 3))
-                v_gt = np.zeros((len(oxts), 3))
-                v_rob_gt = np.zeros((len(oxts), 3))
-
-                k_max = len(oxts)
-                for k in range(k_max):
-                    oxts_k = oxts[k]
-                    t[k] = 3600 * t[k].hour + 60 * t[k].minute + t[k].second + t[k].microsecond / 1e6
-                    lat_oxts[k] = oxts_k[0].lat
-                    lon_oxts[k] = oxts_k[0].lon
-                    alt_oxts[k] = oxts_k[0].alt
-                    acc[k, 0] = oxts_k[0].af
-                    acc[k, 1] = oxts_k[0].al
-                    acc[k, 2] = oxts_k[0].au
-                    acc_bis[k, 0] = oxts_k[0].ax
-                    acc_bis[k, 1] = oxts_k[0].ay
-                    acc_bis[k, 2] = oxts_k[0].az
-                    gyro[k, 0] = oxts_k[0].wf
-                    gyro[k, 1] = oxts_k[0].wl
-                    gyro[k, 2] = oxts_k[0].wu
-                    gyro_bis[k, 0] = oxts_k[0].wx
-                    gyro_bis[k, 1] = oxts_k[0].wy
-                    gyro_bis[k, 2] = oxts_k[0].wz
-                    roll_oxts[k] = oxts_k[0].roll
-                    pitch_oxts[k] = oxts_k[0].pitch
-                    yaw_oxts[k] = oxts_k[0].yaw
-                    v_gt[k, 0] = oxts_k[0].ve
-                    v_gt[k, 1] = oxts_k[0].vn
-                    v_gt[k, 2] = oxts_k[0].vu
-                    v_rob_gt[k, 0] = oxts_k[0].vf
-                    v_rob_gt[k, 1] = oxts_k[0].vl
-                    v_rob_gt[k, 2] = oxts_k[0].vu
-                    p_gt[k] = oxts_k[1][:3, 3]
-                    Rot_gt_k = oxts_k[1][:3, :3]
-                    roll_gt[k], pitch_gt[k], yaw_gt[k] = KITTIDataset.to_rpy(Rot_gt_k)
-
-                t0 = t[0]
-                np_array_t = np.array(t)
-                t = np_array_t - t0
-                if np.max(t[:-1] - t[1:]) > 0.1:
-                    cprint(date_dir2 + " has time problem", 'yellow')
-                ang_gt = np.zeros((roll_gt.shape[0], 3))
-                ang_gt[:, 0] = roll_gt
-                ang_gt[:, 1] = pitch_gt
-                ang_gt[:, 2] = yaw_gt
-
-                p_oxts = lla2ned(lat_oxts, lon_oxts, alt_oxts, lat_oxts[0], lon_oxts[0],
-                                 alt_oxts[0], latlon_unit='deg', alt_unit='m', model='wgs84')
-                p_oxts[:, [0, 1]] = p_oxts[:, [1, 0]]  # see note
-
-                imu = np.concatenate((gyro_bis, acc_bis), -1)
-
-                t = torch.from_numpy(t)
-                p_gt = torch.from_numpy(p_gt)
-                v_gt = torch.from_numpy(v_gt)
-                ang_gt = torch.from_numpy(ang_gt)
-                imu = torch.from_numpy(imu)
-
-
-                Rot_gt = SO3.from_rpy(ang_gt[:, 0], ang_gt[:, 1], ang_gt[:, 2])
-                dRot_ij = bmtm(Rot_gt[:-1], Rot_gt[1:])
-                dRot_ij = SO3.dnormalize(dRot_ij.cuda())
-                dxi_ij = SO3.log(dRot_ij).cpu()
-
-                dv_ij = v_gt[1:] - v_gt[:-1]
-                dp_ij = p_gt[1:] - p_gt[:-1]
-
-                xs = np.concatenate((dxi_ij, dv_ij, dp_ij), -1)
-
-                xs = torch.from_numpy(xs)
-
-
-                xs = xs
-
-
-                mondict = {
-                    't': t,
-                    'xs': xs,
-                    'us': imu,
-                    'p_gt': p_gt,
-                    'ang_gt': ang_gt,
-                    'v_gt': v_gt,
-                    'name': date_dir2,
-                    't0': t0
-                    }
-
-                t_tot += t[-1] - t[0]
-                pdump(mondict, self.predata_dir, date_dir2 + ".p")
-
-        print("\n Total dataset duration : {:.2f} s".format(t_tot))
-
+                drives.append((path2, date_dir2))
+        return drives
 
     @staticmethod
-    def pose_from_oxts_packet(packet, scale):
-        """Helper method to compute a SE(3) pose matrix from an OXTS packet.
-        """
-        er = 6378137.  # earth radius (approx.) in meters
+    def source_files(path):
+        """raw files of a drive read by read_drive"""
+        return [os.path.join(path, 'oxts', 'timestamps.txt')] + \
+            sorted(glob.glob(os.path.join(path, 'oxts', 'data', '*.txt')))
 
-        # Use a Mercator projection to get the translation vector
-        tx = scale * packet.lon * np.pi * er / 180.
-        ty = scale * er * np.log(np.tan((90. + packet.lat) * np.pi / 360.))
-        tz = packet.alt
-        t = np.array([tx, ty, tz])
+    @staticmethod
+    def source_stats(path):
+        """number, total size and latest modification time (ns) of the raw
+        files of a drive"""
+        stats = [os.stat(filename) for filename in KITTIDataset.source_files(path)
+                 if os.path.exists(filename)]
+        return {'n_files': len(stats), 'size': sum(s.st_size for s in stats),
+                'mtime': max((s.st_mtime_ns for s in stats), default=0)}
 
-        # Use the Euler angles to get the rotation matrix
-        Rx = KITTIDataset.rotx(packet.roll)
-        Ry = KITTIDataset.roty(packet.pitch)
-        Rz = KITTIDataset.rotz(packet.yaw)
-        R = Rz.dot(Ry.dot(Rx))
+    @staticmethod
+    def source_hash(path):
+        """sha1 of the names and contents of the raw files of a drive"""
+        h = hashlib.sha1()
+        for filename in KITTIDataset.source_files(path):
+            if not os.path.exists(filename):
+                continue
+            h.update(os.path.relpath(filename, path).encode())
+            with open(filename, 'rb') as f:
+                h.update(f.read())
+        return h.hexdigest()
 
-        # Combine the translation and rotation into a homogeneous transform
-        return R, t
+    @staticmethod
+    def load_manifest(store):
+        """preprocessed drives of store, empty if none or of another
+        preprocessing version"""
+        path = os.path.join(store.predata_dir, KITTIDataset.ingest_manifest)
+        if os.path.exists(path):
+            with open(path) as f:
+                manifest = json.load(f)
+            if manifest.get('version') == KITTIDataset.preprocessing_version:
+                return manifest
+        return {'version': KITTIDataset.preprocessing_version, 'drives': {}}
 
+    @staticmethod
+    def save_manifest(store, manifest):
+        path = os.path.join(store.predata_dir, KITTIDataset.ingest_manifest)
+        # a temporary file per process, as the processes of distributed
+        # training check the drives at once
+        tmp_path = '{}.{}.tmp'.format(path, os.getpid())
+        with open(tmp_path, 'w') as f:
+            json.dump(manifest, f, indent=2, sort_keys=True)
+        os.replace(tmp_path, path)  # never leave a truncated manifest
 
     @staticmethod
-    def transform_from_rot_trans(R, t):
-        """Transformation matrix from rotation matrix and translation vector."""
-        R = R.reshape(3, 3)
-        t = t.reshape(3, 1)
-        return np.vstack((np.hstack([R, t]), [0, 0, 0, 1]))
+    def is_up_to_date(store, manifest, path, name):
+        """whether the pre loaded data of a drive is from its current raw
+        files. Files are hashed only when their sizes or times changed"""
+        entry = manifest['drives'].get(name)
+        if entry is None or (entry['status'] == 'done' and not store.exists(name)):
+            return False
+        stats = KITTIDataset.source_stats(path)
+        if all(entry[key] == value for key, value in stats.items()):
+            return True
+        if entry['n_files'] != stats['n_files'] or entry['size'] != stats['size'] or \
+                entry['sha1'] != KITTIDataset.source_hash(path):
+            return False
+        entry.update(stats)  # touched but identical files
+        return True
 
+    @staticmethod
+    def ingest(data_dir, store, n_workers=1, force=False):
+        """Convert raw drives to pre loaded data in store, with n_workers
+        processes. Only drives that are new, changed or of a previous
+        preprocessing version are converted, unless force. A failing drive is
+        reported, skipped and retried at the next call. Returns the names of
+        the failed drives"""
+        print("Start read_data")
+        os.makedirs(store.predata_dir, exist_ok=True)
+        manifest = KITTIDataset.load_manifest(store)
+        drives = [(path, name) for path, name in KITTIDataset.list_drives(data_dir)
+                  if force or not KITTIDataset.is_up_to_date(store, manifest, path, name)]
+        if not drives:
+            KITTIDataset.save_manifest(store, manifest)
+            return []
+        t_tot = 0  # sum of times for the all dataset
+        failures = []
+
+        def report(k, name, duration, error, source):
+            nonlocal t_tot
+            if error is not None:
+                failures.append(name)
+                manifest['drives'].pop(name, None)
+                cprint("[{}/{}] {} failed: {}".format(k, len(drives), name, error), 'red')
+                return
+            if duration is not None:
+                t_tot += duration
+            manifest['drives'][name] = dict(source, status='short' if duration is None
+                                            else 'done')
+            KITTIDataset.save_manifest(store, manifest)
+            print("[{}/{}] {} done".format(k, len(drives), name))
+
+        if n_workers == 1:
+            for k, (path, name) in enumerate(drives, 1):
+                report(k, name, *KITTIDataset.ingest_drive(store, path, name))
+        else:
+            with ProcessPoolExecutor(n_workers) as pool:
+                futures = {pool.submit(KITTIDataset.ingest_drive, store, path, name): name
+                           for path, name in drives}
+                for k, future in enumerate(as_completed(futures), 1):
+                    try:
+                        result = future.result()
+                    except Exception as error:  # the worker died
+                        result = None, repr(error), None
+                    report(k, futures[future], *result)
+
+        KITTIDataset.save_manifest(store, manifest)
+        # normalization factors may depend on the converted drives
+        path_normalize_factors = os.path.join(store.predata_dir, 'nf.p')
+        if os.path.exists(path_normalize_factors):
+            normalize_factors = pload(path_normalize_factors)
+            partials = normalize_factors.get('partials', {})
+            for path, name in drives:
+                partials.pop(name, None)
+            BaseDataset.save_normalize_factors({'train_seqs': None, 'partials': partials},
+                                               path_normalize_factors)
+        print("\n Total dataset duration : {:.2f} s".format(t_tot))
+        if failures:
+            cprint("Failed drives: " + ", ".join(failures), 'red')
+        return failures
 
     @staticmethod
-    def load_oxts_packets_and_poses(oxts_files):
-        """Generator to read OXTS ground truth data.
-           Poses are given in an East-North-Up coordinate system
-           whose origin is the first GPS position.
-        """
-        # Scale for Mercator projection (from first lat value)
-        scale = None
-        # Origin of the global coordinate system (first GPS position)
-        origin = None
+    def ingest_drive(store, path, name):
+        """read and save a drive, returns its duration (s), None if it is too
+        short, the error if it failed and the sizes, times and hash of its raw
+        files"""
+        try:
+            # before reading, so that a file changed meanwhile is read again
+            source = dict(KITTIDataset.source_stats(path), sha1=KITTIDataset.source_hash(path))
+            mondict = KITTIDataset.read_drive(path, name)
+            if mondict is None:
+                return None, None, source
+            store.save(name, mondict)
+            source['time_report'] = mondict['time_report']
+        except Exception as error:
+            return None, repr(error), None
+        return float(mondict['t'][-1] - mondict['t'][0]), None, source
 
-        oxts = []
+    @staticmethod
+    def read_drive(path2, date_dir2):
+        """pre loaded data of a raw drive, None if it is too short"""
+        # read data
+        oxts_files = sorted(glob.glob(os.path.join(path2, 'oxts', 'data', '*.txt')))
+        oxts = KITTIDataset.load_oxts(oxts_files)
+
+        print("\n Sequence name : " + date_dir2)
+        if len(oxts) < KITTIDataset.min_seq_dim:  #  sequence shorter than 30 s are rejected
+            cprint("Dataset is too short ({:.2f} s)".format(len(oxts) / 100), 'yellow')
+            return None
+        t_ns = KITTIDataset.load_timestamps_ns(path2)
+        col = KITTIDataset.oxts_columns
+        Rot_oxts, p_gt = KITTIDataset.poses_from_oxts(oxts)
+        ang_gt = KITTIDataset.to_rpy_batch(Rot_oxts)
+        v_gt = oxts[:, [col['ve'], col['vn'], col['vu']]]
+        gyro_bis = oxts[:, col['wx']: col['wz'] + 1]
+        acc_bis = oxts[:, col['ax']: col['az'] + 1]
+
+        # time of the day of the first sample, and times relative to it
+        t0 = float(t_ns[0] % (24 * 3600 * 10**9)) / 1e9
+        t = (t_ns - t_ns[0]) / 1e9
+        time_report = KITTIDataset.check_timestamps(t, date_dir2)
+
+        imu = np.concatenate((gyro_bis, acc_bis), -1)
+
+        t = torch.from_numpy(t)
+        p_gt = torch.from_numpy(p_gt)
+        v_gt = torch.from_numpy(v_gt)
+        ang_gt = torch.from_numpy(ang_gt)
+        imu = torch.from_numpy(imu)
+
+
+        Rot_gt = SO3.from_rpy(ang_gt[:, 0], ang_gt[:, 1], ang_gt[:, 2])
+        dRot_ij = bmtm(Rot_gt[:-1], Rot_gt[1:])
+        dRot_ij = SO3.dnormalize(dRot_ij)
+        dxi_ij = SO3.log(dRot_ij)
+
+        dv_ij = v_gt[1:] - v_gt[:-1]
+        dp_ij = p_gt[1:] - p_gt[:-1]
+
+        xs = np.concatenate((dxi_ij, dv_ij, dp_ij), -1)
+
+        xs = torch.from_numpy(xs)
+
+        mondict = {
+            't': t,
+            'xs': xs,
+            'us': imu,
+            'p_gt': p_gt,
+            'ang_gt': ang_gt,
+            'v_gt': v_gt,
+            'name': date_dir2,
+            't0': t0,
+            'time_report': time_report,
+            }
+        return KITTIDataset.add_rotations(mondict)
+
+
+    # column of each OXTS field in the rows of load_oxts
+    oxts_columns = {field: i for i, field in enumerate(OxtsPacket._fields)}
 
+    @staticmethod
+    def load_oxts(oxts_files):
+        """OXTS packets of a drive as one (N, 30) array, the last five entries
+        (flags and counts) being truncated to integers"""
+        texts = []
         for filename in oxts_files:
             with open(filename, 'r') as f:
-                for line in f.readlines():
-                    line = line.split()
-                    # Last five entries are flags and counts
-                    line[:-5] = [float(x) for x in line[:-5]]
-                    line[-5:] = [int(float(x)) for x in line[-5:]]
-
-                    packet = KITTIDataset.OxtsPacket(*line)
-
-                    if scale is None:
-                        scale = np.cos(packet.lat * np.pi / 180.)
-
-                    R, t = KITTIDataset.pose_from_oxts_packet(packet, scale)
-
-                    if origin is None:
-                        origin = t
-
-                    T_w_imu = KITTIDataset.transform_from_rot_trans(R, t - origin)
-
-                    oxts.append(KITTIDataset.OxtsData(packet, T_w_imu))
+                texts.append(f.read())
+        oxts = np.array(' '.join(texts).split(), dtype=np.float64).reshape(-1, 30)
+        oxts[:, -5:] = np.trunc(oxts[:, -5:])
         return oxts
 
+    @staticmethod
+    def poses_from_oxts(oxts):
+        """Rotation matrices (N, 3, 3) and positions (N, 3) of OXTS packets,
+        in an East-North-Up frame whose origin is the first position"""
+        er = 6378137.  # earth radius (approx.) in meters
+        col = KITTIDataset.oxts_columns
+        lat, lon, alt = oxts[:, col['lat']], oxts[:, col['lon']], oxts[:, col['alt']]
+        # Scale for Mercator projection (from first lat value)
+        scale = np.cos(lat[0] * np.pi / 180.)
+        # Use a Mercator projection to get the translation vector
+        tx = scale * lon * np.pi * er / 180.
+        ty = scale * er * np.log(np.tan((90. + lat) * np.pi / 360.))
+        p = np.stack((tx, ty, alt), -1)
+        # Use the Euler angles to get the rotation matrix R = Rz Ry Rx
+        cr, sr = np.cos(oxts[:, col['roll']]), np.sin(oxts[:, col['roll']])
+        cp, sp = np.cos(oxts[:, col['pitch']]), np.sin(oxts[:, col['pitch']])
+        cy, sy = np.cos(oxts[:, col['yaw']]), np.sin(oxts[:, col['yaw']])
+        Rot = np.empty((oxts.shape[0], 3, 3))
+        Rot[:, 0, 0] = cy * cp
+        Rot[:, 0, 1] = cy * (sp * sr) - sy * cr
+        Rot[:, 0, 2] = cy * (sp * cr) + sy * sr
+        Rot[:, 1, 0] = sy * cp
+        Rot[:, 1, 1] = sy * (sp * sr) + cy * cr
+        Rot[:, 1, 2] = sy * (sp * cr) - cy * sr
+        Rot[:, 2, 0] = -sp
+        Rot[:, 2, 1] = cp * sr
+        Rot[:, 2, 2] = cp * cr
+        return Rot, p - p[0]
 
     @staticmethod
-    def load_timestamps(data_path):
-        """Load timestamps from file."""
+    def load_timestamps_ns(data_path):
+        """Load timestamps from file as int64 nanoseconds since the epoch."""
         timestamp_file = os.path.join(data_path, 'oxts', 'timestamps.txt')
-
-        # Read and parse the timestamps
-        timestamps = []
         with open(timestamp_file, 'r') as f:
-            for line in f.readlines():
-                # NB: datetime only supports microseconds, but KITTI timestamps
-                # give nanoseconds, so need to truncate last 4 characters to
-                # get rid of \n (counts as 1) and extra 3 digits
-                t = datetime.datetime.strptime(line[:-4], '%Y-%m-%d %H:%M:%S.%f')
-                timestamps.append(t)
-        return timestamps
-
+            lines = [line.strip() for line in f.read().splitlines() if line.strip()]
+        return np.array(lines, dtype='datetime64[ns]').astype(np.int64)
 
     @staticmethod
-    def rotx(t):
-        """Rotation about the x-axis."""
-        c = np.cos(t)
-        s = np.sin(t)
-        return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
-
-    @staticmethod
-    def roty(t):
-        """Rotation about the y-axis."""
-        c = np.cos(t)
-        s = np.sin(t)
-        return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
-
-    @staticmethod
-    def rotz(t):
-        """Rotation about the z-axis."""
-        c = np.cos(t)
-        s = np.sin(t)
-        return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+    def check_timestamps(t, name, dt=0.01, max_gap=10):
+        """Report non-monotonic steps and gaps longer than max_gap sampling
+        times dt (s) of timestamps t (s) of a drive. The report is kept with
+        the drive and in its ingest manifest entry"""
+        max_gap = max_gap * dt
+        steps = np.diff(t)
+        backward = np.flatnonzero(steps <= 0)
+        gaps = np.flatnonzero(steps > max_gap)
+        report = {
+            'n_samples': len(t),
+            'median_dt': float(np.median(steps)) if len(steps) else dt,
+            'n_non_monotonic': len(backward),
+            'n_gaps': len(gaps),
+            'max_step': float(steps.max()) if len(steps) else 0.,
+            'min_step': float(steps.min()) if len(steps) else 0.,
+            'max_gap': max_gap,
+        }
+        if len(backward) or len(gaps):
+            cprint("{} has time problem: {} non-monotonic steps (first at {}, min step "
+                   "{:.3f} s), {} gaps > {} s (first at {}, max step {:.3f} s)".format(
+                       name, len(backward), backward[:1].tolist(), report['min_step'],
+                       len(gaps), max_gap, gaps[:1].tolist(), report['max_step']), 'yellow')
+        return report
 
     @staticmethod
-    def to_rpy(Rot):
-        pitch = np.arctan2(-Rot[2, 0], np.sqrt(Rot[0, 0]**2 + Rot[1, 0]**2))
-
-        if np.isclose(pitch, np.pi / 2.):
-            yaw = 0.
-            roll = np.arctan2(Rot[0, 1], Rot[1, 1])
-        elif np.isclose(pitch, -np.pi / 2.):
-            yaw = 0.
-            roll = -np.arctan2(Rot[0, 1], Rot[1, 1])
-        else:
-            sec_pitch = 1. / np.cos(pitch)
-            yaw = np.arctan2(Rot[1, 0] * sec_pitch,
-                             Rot[0, 0] * sec_pitch)
-            roll = np.arctan2(Rot[2, 1] * sec_pitch,
-                              Rot[2, 2] * sec_pitch)
-        return roll, pitch, yaw
-
+    def to_rpy_batch(Rot):
+        """roll, pitch and yaw (N, 3) of rotation matrices (N, 3, 3)"""
+        pitch = np.arctan2(-Rot[:, 2, 0], np.sqrt(Rot[:, 0, 0]**2 + Rot[:, 1, 0]**2))
+        up = np.isclose(pitch, np.pi / 2.)
+        down = np.isclose(pitch, -np.pi / 2.)
+        sec_pitch = 1. / np.cos(pitch)
+        yaw = np.arctan2(Rot[:, 1, 0] * sec_pitch, Rot[:, 0, 0] * sec_pitch)
+        roll = np.arctan2(Rot[:, 2, 1] * sec_pitch, Rot[:, 2, 2] * sec_pitch)
+        yaw[up | down] = 0.
+        roll[up] = np.arctan2(Rot[up, 0, 1], Rot[up, 1, 1])
+        roll[down] = -np.arctan2(Rot[down, 0, 1], Rot[down, 1, 1])
+        return np.stack((roll, pitch, yaw), -1)
@@ -0,0 +1,89 @@
+"""Inference-only entry point.
+
+The exported file holds the network as TorchScript and the filter parameters
+as JSON. The filter itself is run by the Python IEKF, so a pipeline needs
+torch, numpy and src/deploy.py, src/utils_IEKF.py, src/lie_algebra.py and
+src/utils.py, but neither the training code nor its dependencies
+(matplotlib, tensorboard, navpy, yaml and termcolor).
+
+    python -m src.deploy gyro_iekf.pt <predata_dir>/<sequence>.p --output p.npy
+"""
+import json
+import argparse
+import numpy as np
+import torch
+from src.utils import pload
+from src.utils_IEKF import IEKF
+
+FILTER_CONFIG = 'filter.json'
+"""name of the filter parameters in the exported file"""
+
+
+def export_pipeline(learning_process, path):
+    """Save the trained network and the filter parameters in one TorchScript
+    file.
+
+    The file holds the inference network (normalization factors, folded batch
+    normalizations and head included) and, as an extra file, the filter
+    covariances, dtype and learned InitProcessCovNet factors. It is loaded
+    back by Pipeline without the training code, but with the filter modules,
+    see the module docstring.
+    """
+    learning_process.net.eval()
+    net = torch.jit.script(learning_process.net.export_for_inference())
+    iekf = learning_process.iekf
+    initprocesscov_net = iekf.initprocesscov_net
+    config = {
+        'dtype': str(iekf.dtype).replace('torch.', ''),
+        'covariances': {name: value for name, value in vars(iekf).items()
+                        if name.startswith('cov_') and isinstance(value, (int, float))},
+        'factor_initial_covariance':
+            initprocesscov_net.factor_initial_covariance.weight.detach().flatten().tolist(),
+        'factor_process_covariance':
+            initprocesscov_net.factor_process_covariance.weight.detach().flatten().tolist(),
+    }
+    torch.jit.save(net, path, _extra_files={FILTER_CONFIG: json.dumps(config)})
+
+
+class Pipeline:
+    """Network and filter loaded from a file written by export_pipeline"""
+
+    def __init__(self, path):
+        extra_files = {FILTER_CONFIG: ''}
+        self.net = torch.jit.load(path, _extra_files=extra_files)
+        config = json.loads(extra_files[FILTER_CONFIG])
+        self.iekf = IEKF()
+        self.iekf.dtype = getattr(torch, config['dtype'])
+        for name, value in config['covariances'].items():
+            setattr(self.iekf, name, value)
+        self.iekf.cov0_measurement = torch.Tensor([self.iekf.cov_lat, self.iekf.cov_up])
+        initprocesscov_net = self.iekf.initprocesscov_net
+        with torch.no_grad():
+            for name in ('factor_initial_covariance', 'factor_process_covariance'):
+                weight = getattr(initprocesscov_net, name).weight
+                weight.copy_(torch.tensor(config[name]).view_as(weight))
+
+    def run(self, t, us, v0, ang0):
+        """Filter a batch of sequences from timestamps t (batch x N), IMU
+        samples us (batch x N x 6), initial velocity v0 (batch x 3) and initial
+        roll, pitch and yaw ang0 (batch x 3). Returns Rot, v, p, b_omega, b_acc,
+        Rot_c_i and t_c_i"""
+        with torch.no_grad():
+            ys = self.net(us).to(self.iekf.dtype)
+            us_fix, measurements_covs = IEKF.correct_imu(ys, us.to(self.iekf.dtype))
+            self.iekf.set_Q()
+            return self.iekf.run(t, us_fix, measurements_covs, v0.unsqueeze(1), None,
+                                 t.shape[1], ang0)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument('pipeline', help='file written by export_pipeline')
+    parser.add_argument('sequence', help='preprocessed sequence')
+    parser.add_argument('--output', default='p.npy', help='estimated positions')
+    args = parser.parse_args()
+    mondict = pload(args.sequence)
+    p = Pipeline(args.pipeline).run(mondict['t'].unsqueeze(0), mondict['us'].unsqueeze(0),
+                                    mondict['v_gt'][:1], mondict['ang_gt'][:1])[2]
+    np.save(args.output, p[0].numpy())
@@ -1,18 +1,11 @@
 import torch
 import time
-import matplotlib.pyplot as plt
-import matplotlib.font_manager as fm
-plt.rcParams["legend.loc"] = "upper right"
-plt.rcParams['axes.titlesize'] = 'x-large'
-plt.rcParams['axes.labelsize'] = 'x-large'
-plt.rcParams['legend.fontsize'] = 'x-large'
-plt.rcParams['xtick.labelsize'] = 'x-large'
-plt.rcParams['ytick.labelsize'] = 'x-large'
 from termcolor import cprint
 import numpy as np
 import os
-from torch.utils.tensorboard import SummaryWriter
-from torch.utils.data import DataLoader
+import copy
+import torch.distributed as dist
+from torch.utils.data import DataLoader, DistributedSampler
 from src.utils import *
 
 from datetime import datetime
@@ -23,6 +16,24 @@ from src.lie_algebra import SO3, CPUSO3
 # from lie_algebra import SO3, CPUSO3
 
 from src.utils_IEKF import IEKF
+from src.precision import PrecisionPolicy
+from src.networks import chunked_forward, ChunkedStreamingNet
+from src.cache import OutputCache
+from src.dataset import WindowSampler, Prefetcher
+from src.storage import ColumnarStore
+
+
+def set_plot_style(plt):
+    plt.rcParams["legend.loc"] = "upper right"
+    plt.rcParams['axes.titlesize'] = 'x-large'
+    plt.rcParams['axes.labelsize'] = 'x-large'
+    plt.rcParams['legend.fontsize'] = 'x-large'
+    plt.rcParams['xtick.labelsize'] = 'x-large'
+    plt.rcParams['ytick.labelsize'] = 'x-large'
+
+
+# plotting is only imported when a figure is drawn
+plt = LazyModule('matplotlib.pyplot', set_plot_style)
 
 
 class LearningBasedProcessing:
@@ -38,6 +49,16 @@ class LearningBasedProcessing:
         self.address, self.tb_address = self.find_address(address)
         self.iekf = IEKF()
         self.g = torch.Tensor([0, 0, -9.80665])
+        # network outputs of frozen networks, see set_output_cache
+        self.output_cache = None
+        self.noise_seeds = 1
+        # batches loaded ahead by a background thread, see Prefetcher, and
+        # time the last loop waited for them (s)
+        self.prefetch = 0
+        self.idle_time = 0
+        # process of distributed data-parallel training, see train_process
+        self.rank = 0
+        self.world_size = 1
         if address is None:  # create new address
             pdump(self.net_params, self.address, 'net_params.p')
             ydump(self.net_params, self.address, 'net_params.yaml')
@@ -47,9 +68,27 @@ class LearningBasedProcessing:
             self._ready = True
         self.path_weights = os.path.join(self.address, 'weights.pt')
         self.net = self.net_class(**self.net_params)
+        self.set_precision(self.train_params.get('precision'))
         if self._ready:  # fill network parameters
             self.load_weights(self.iekf)
 
+    def set_precision(self, precision):
+        """Set the dtype of each stage from train_params['precision']"""
+        self.precision = PrecisionPolicy.from_params(precision)
+        self.net.set_precision(self.precision)
+        self.iekf.set_precision(self.precision)
+
+    def set_output_cache(self, cache_params=None):
+        """Freeze the network and cache its outputs, for fine-tuning the filter
+        only. cache_params are the OutputCache parameters and 'noise_seeds',
+        the number of noise realizations of each sequence"""
+        if cache_params is None:
+            self.output_cache = None
+            return
+        cache_params = dict(cache_params)
+        self.noise_seeds = cache_params.pop('noise_seeds', 8)
+        self.output_cache = OutputCache(**cache_params)
+
     def find_address(self, address):
         """return path where net and training info are saved"""
         if address == 'last':
@@ -86,12 +125,26 @@ class LearningBasedProcessing:
 
     def train(self, dataset_class, dataset_params, train_params):
         """train the neural network. GPU is assumed"""
+        # also set in the parent of distributed training, for testing after
         self.train_params = train_params
-        pdump(self.train_params, self.address, 'train_params.p')
-        ydump(self.train_params, self.address, 'train_params.yaml')
-
-        hparams = self.get_hparams(dataset_class, dataset_params, train_params)
-        ydump(hparams, self.address, 'hparams.yaml')
+        self.set_precision(train_params.get('precision'))
+        distributed = train_params.get('distributed')
+        if distributed is not None and not dist.is_initialized():
+            # raw data is converted, then normalization factors are computed
+            # and saved once, before the processes start
+            dataset_class(**dataset_params, mode='train')
+            torch.multiprocessing.spawn(train_process, nprocs=distributed['world_size'],
+                args=(self, dataset_class, dataset_params, train_params))
+            if os.path.exists(self.path_weights):  # weights saved by rank 0
+                self.load_weights(self.iekf)
+            return
+        if dist.is_initialized():
+            self.rank, self.world_size = dist.get_rank(), dist.get_world_size()
+        if self.rank == 0:
+            pdump(self.train_params, self.address, 'train_params.p')
+            ydump(self.train_params, self.address, 'train_params.yaml')
+            hparams = self.get_hparams(dataset_class, dataset_params, train_params)
+            ydump(hparams, self.address, 'hparams.yaml')
 
         # define datasets
         dataset_train = dataset_class(**dataset_params, mode='train')
@@ -111,11 +164,42 @@ class LearningBasedProcessing:
         loss_params = train_params['loss']
 
         # define optimizer, scheduler and loss
-        dataloader = DataLoader(dataset_train, **dataloader_params)
-        dataloader_val = DataLoader(dataset_val, **dataloader_params)
-        optimizer = Optimizer(self.net.parameters(), **optimizer_params)
+        self.prefetch = train_params.get('prefetch', 0)
+        # noise is added by the DataLoader workers
+        dataset_train.augment = train_params.get('worker_noise', False)
+        if dataset_train.augment and dataloader_params.get('num_workers', 0) == 0:
+            # or by the prefetch thread, with its own generator, so that its
+            # draws do not interleave with those of training (dropout)
+            dataset_train.noise_generator = torch.Generator().manual_seed(torch.initial_seed())
+        sampler_params = train_params.get('sampler')
+        seed = (distributed or {}).get('seed', 0)
+        if sampler_params is None and self.world_size == 1:
+            dataloader = DataLoader(dataset_train, worker_init_fn=dataset_train.seed_worker,
+                                    **dataloader_params)
+        else:
+            if sampler_params is None:  # sequences are split between processes
+                sampler = DistributedSampler(dataset_train, self.world_size, self.rank,
+                                             dataloader_params['shuffle'], seed)
+            else:  # windows drawn over all training sequences
+                sampler = WindowSampler(dataset_train, **sampler_params,
+                    num_replicas=self.world_size, rank=self.rank, seed=seed)
+            dataloader = DataLoader(dataset_train, sampler=sampler,
+                worker_init_fn=dataset_train.seed_worker,
+                **{k: v for k, v in dataloader_params.items() if k != 'shuffle'})
+        if self.world_size == 1:
+            dataloader_val = DataLoader(dataset_val, **dataloader_params)
+        else:
+            dataloader_val = DataLoader(dataset_val,
+                sampler=DistributedSampler(dataset_val, self.world_size, self.rank, False),
+                **{k: v for k, v in dataloader_params.items() if k != 'shuffle'})
+        self.set_output_cache(train_params.get('output_cache'))
+        if self.output_cache is None:
+            optimizer = Optimizer(self.net.parameters(), **optimizer_params)
+        else:  # only the filter factors are trained
+            optimizer = Optimizer(self.iekf.initprocesscov_net.parameters(), **optimizer_params)
         scheduler = Scheduler(optimizer, **scheduler_params)
         criterion = Loss(**loss_params)
+        criterion.set_precision(self.precision)
 
         # remaining training parameters
         freq_val = train_params['freq_val']
@@ -126,49 +210,66 @@ class LearningBasedProcessing:
         mean_u, std_u = dataset_train.mean_u.cpu(), dataset_train.std_u.cpu()
         self.net.set_normalized_factors(mean_u, std_u)
         
-        sample_data = next(iter(dataloader))
-        t, us, xs, p_gt, v_gt, ang_gt, name = sample_data
-        us_noise = dataset_train.add_noise(us) 
-        # start tensorboard writer
-        writer = SummaryWriter(self.tb_address)
-        writer.add_graph(self.net, us_noise)
+        # only the first process logs and saves
+        if self.rank == 0:
+            sample_data = next(iter(dataloader))
+            t, us, xs, p_gt, v_gt, ang_gt, Rot_gt, Rot_xs, name = sample_data
+            us_noise = self.batch_noise(dataloader, us)
+            # start tensorboard writer
+            from torch.utils.tensorboard import SummaryWriter
+            writer = SummaryWriter(self.tb_address)
+            writer.add_graph(self.net, us_noise)
         start_time = time.time()
         best_loss = torch.Tensor([float('Inf')])
 
         #  define some function for seeing evolution of training
         def write(epoch, loss_epoch):
-            writer.add_scalar('loss/train', loss_epoch.item(), epoch)
-            writer.add_scalar('lr', optimizer.param_groups[0]['lr'], epoch)
-            cprint('Train Epoch: {:2d} \tLoss: {:.4f}'.format(
-                epoch, loss_epoch.item()), 'green')
+            if self.rank == 0:
+                writer.add_scalar('loss/train', loss_epoch.item(), epoch)
+                writer.add_scalar('lr', optimizer.param_groups[0]['lr'], epoch)
+                writer.add_scalar('time_idle', self.idle_time, epoch)
+                cprint('Train Epoch: {:2d} \tLoss: {:.4f} \tIdle: {:.2f}s'.format(
+                    epoch, loss_epoch.item(), self.idle_time), 'green')
             scheduler.step(epoch)
 
         def write_time(epoch, start_time):
-            delta_t = time.time() - start_time
-            print("Amount of time spent for epochs " +
-                  "{}-{}: {:.1f}s\n".format(epoch - freq_val, epoch, delta_t))
-            writer.add_scalar('time_spend', delta_t, epoch)
+            if self.rank == 0:
+                delta_t = time.time() - start_time
+                print("Amount of time spent for epochs " +
+                      "{}-{}: {:.1f}s\n".format(epoch - freq_val, epoch, delta_t))
+                writer.add_scalar('time_spend', delta_t, epoch)
 
         def write_val(loss, best_loss):
+            # losses are averaged over the processes, which keep the same best_loss
             if 0.5 * loss <= best_loss:
                 msg = 'validation loss decreases! :) '
                 msg += '(curr/prev loss {:.4f}/{:.4f})'.format(loss.item(),
                                                                best_loss.item())
-                cprint(msg, 'green')
                 best_loss = loss
-                self.save_net(self.iekf)
+                if self.rank == 0:
+                    cprint(msg, 'green')
+                    self.save_net(self.iekf)
             else:
                 msg = 'validation loss increases! :( '
                 msg += '(curr/prev loss {:.4f}/{:.4f})'.format(loss.item(),
                                                                best_loss.item())
-                cprint(msg, 'yellow')
-            writer.add_scalar('loss/val', loss.item(), epoch)
+                if self.rank == 0:
+                    cprint(msg, 'yellow')
+            if self.rank == 0:
+                writer.add_scalar('loss/val', loss.item(), epoch)
             return best_loss
 
-        n_pre_epochs = 4000
+        def set_epoch(epoch):
+            # processes shuffle sequences or draw windows alike at each epoch
+            if hasattr(dataloader.sampler, 'set_epoch'):
+                dataloader.sampler.set_epoch(epoch)
+
+        n_pre_epochs = 4000 if self.output_cache is None else 0
         pre_loss_epoch_train = torch.zeros(n_pre_epochs)
         for epoch in range(1, n_pre_epochs + 1):
+            set_epoch(epoch)
             loss_epoch = self.pre_loop_train(dataloader, optimizer, criterion)
+            self.average_buffers()
             pre_loss_epoch_train[epoch-1] = loss_epoch
             write(epoch, loss_epoch)
             scheduler.step(epoch)
@@ -181,11 +282,21 @@ class LearningBasedProcessing:
         mondict = {
             'pre_loss_epoch_train': pre_loss_epoch_train.cpu(),
         }
-        pdump(mondict, self.address, 'pre_loss_epoch_train.p')
+        if self.rank == 0:
+            pdump(mondict, self.address, 'pre_loss_epoch_train.p')
         # training loop !
         loss_epoch_train = torch.zeros(n_epochs)
+        n_windows = train_params.get('shared_windows')
+        if self.output_cache is not None and not n_windows:
+            n_windows = dataloader_params['batch_size']
         for epoch in range(1, n_epochs + 1):
-            loss_epoch = self.loop_train(dataloader, optimizer, criterion, self.iekf)
+            set_epoch(n_pre_epochs + epoch)
+            if n_windows:
+                loss_epoch = self.loop_train_shared(dataset_train, optimizer,
+                                                    criterion, self.iekf, n_windows)
+            else:
+                loss_epoch = self.loop_train(dataloader, optimizer, criterion, self.iekf)
+            self.average_buffers()
             loss_epoch_train[epoch-1] = loss_epoch
             write(epoch, loss_epoch)
             scheduler.step(epoch)
@@ -196,6 +307,8 @@ class LearningBasedProcessing:
                 best_loss = write_val(loss, best_loss)
                 start_time = time.time()
         # training is over !
+        if self.rank != 0:
+            return
         mondict = {
             'loss_epoch_train': loss_epoch_train.cpu(),
         }
@@ -216,12 +329,12 @@ class LearningBasedProcessing:
     def pre_loop_train(self, dataloader, optimizer, criterion):
         """Forward-backward loop over training data"""
         loss_epoch = 0
+        batches = Prefetcher(dataloader, self.prefetch)
         optimizer.zero_grad()
 
         # iekf = IEKF()
-        for t, us, xs, p_gt, v_gt, ang_gt, name in dataloader:
-            t, us, xs, p_gt, v_gt, ang_gt = t, us, xs, p_gt, v_gt, ang_gt
-            us_noise = dataloader.dataset.add_noise(us)
+        for t, us, xs, p_gt, v_gt, ang_gt, Rot_gt, Rot_xs, name in batches:
+            us_noise = self.batch_noise(dataloader, us)
 
             # IEKF
             time_net = time.time()
@@ -235,124 +348,61 @@ class LearningBasedProcessing:
             print('A =', ys_A)
             print('bias =', ys_b)
             print('mescov =', ys_mc)
-            time_IEKF = time.time()
-            us_fix = ys[:, :, :6] * us_noise[:, :, :6] - ys[:, :, 6:12]
-            # iekf.set_Q()
-            measurements_covs = ys[:, :, 12:14]
-            # Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i = \
-            #     iekf.run(t, us_fix, measurements_covs, v_gt, p_gt, t.shape[1], ang_gt[:, 0, :])
-            # print(name, "train_time_IEKF = ", "{:.3f}s".format(time.time() - time_IEKF))
-            time_Loss = time.time()
-            # hat_dRot_ij = bbmtm(Rot[:, :-1].clone(), Rot[:, 1:].clone()).double()
-
-            hat_dxi_ij = torch.zeros(us_fix.shape[0], us_fix.shape[1]-1, 3).double()
-            Rot_gt = torch.zeros(us_fix.shape[0], us_fix.shape[1], 3, 3).double()
-            # hat_acc = torch.zeros(Rot_gt.shape[0], Rot_gt.shape[1], 3).double()
-
-            for i in range(0, Rot_gt.shape[0]):
-                # hat_dxi_ij[i] = SO3.log(hat_dRot_ij[i].clone()).double()
-                Rot_gt[i] = SO3.from_rpy(ang_gt[i, :, 0], ang_gt[i, :, 1], ang_gt[i, :, 2])
-
-            hat_dRot_gt_ij = bbmtm(Rot_gt[:, :-1].clone(), Rot_gt[:, 1:].clone()).double()
-            for i in range(0, Rot_gt.shape[0]):
-                hat_dxi_ij[i] = SO3.log(hat_dRot_gt_ij[i].clone()).double()
-
-            hat_acc = (bbmv(Rot_gt[:, :-1], us_fix[:, :-1, 3:6]) + self.g).double()
-
-            hat_dv_ij = (v_gt[:, 1:, :].clone() - v_gt[:, :-1, :].clone()).double()
-            hat_dp_ij = (p_gt[:, 1:, :].clone() - p_gt[:, :-1, :].clone()).double()
+            us_fix, measurements_covs = self.calibrate(ys, us_noise)
 
-            # hat_dv_ij = (v[:, 1:, :].clone() - v[:, :-1, :].clone()).double()
-            # hat_dp_ij = (p[:, 1:, :].clone() - p[:, :-1, :].clone()).double()
+            # the filter is not run during pre-training, increments are
+            # computed from ground truth
+            Rot_gt = self.precision.cast(Rot_gt, 'lie')
+            hat_dxi_ij = self.rotation_increments(Rot_gt)
+            hat_xs = self.get_hat_xs(t, us_fix, Rot_gt, hat_dxi_ij, v_gt, p_gt)
 
-            # hat_xs = torch.cat((hat_dxi_ij.clone(), hat_dv_ij.clone(), hat_dp_ij.clone()), dim=2)
-            dt = t[:, 1:] - t[:, :-1]
-            hat_xi = torch.einsum('bij, bi -> bij', (us_fix[:, :-1, :3].clone()), dt).double()
-            hat_dv = torch.einsum('bij, bi -> bij', (hat_acc.clone()), dt).double()
-
-            # hat_xs = torch.cat((hat_xi.clone(), hat_dv.clone(), hat_dp_ij.clone()), dim=2)
-
-            hat_xs = torch.cat((hat_xi.clone(), hat_dv.clone(),
-                                hat_dxi_ij.clone(), hat_dv_ij.clone(), hat_dp_ij.clone()), dim=2)
-
-            loss = criterion(xs[:, :-1, :], hat_xs) / len(dataloader)
-
-            loss = loss.cuda()
+            loss = criterion(xs[:, :-1, :], hat_xs, Rot_xs[:, :-1]) / len(dataloader)
             loss.backward()
-            loss = loss.cpu()
 
             loss_epoch += loss.detach().cpu()
-            # print(name, "train_time_Loss = ", "{:.3f}s".format(time.time() - time_Loss))
-
-            # with torch.autograd.detect_anomaly():
 
+        self.average_gradients(optimizer)
         optimizer.step()
-        return loss_epoch
+        if self.output_cache is not None:  # weights are hashed again
+            self.output_cache.invalidate()
+        self.idle_time = batches.idle_time
+        return self.average(loss_epoch)
 
     def pre_loop_val(self, dataloader, criterion):
         """Forward loop over validation data"""
         loss_epoch = 0
+        batches = Prefetcher(dataloader, self.prefetch)
         self.net.eval()
         # iekf = IEKF()
         with torch.no_grad():
-            for t, us, xs, p_gt, v_gt, ang_gt, name in dataloader:
-                t, us, xs, p_gt, v_gt, ang_gt = t, us, xs, p_gt, v_gt, ang_gt
-                us_noise = dataloader.dataset.add_noise(us)
+            for t, us, xs, p_gt, v_gt, ang_gt, Rot_gt, Rot_xs, name in batches:
+                us_noise = self.batch_noise(dataloader, us)
                 # IEKF
                 time_net = time.time()
                 ys = self.net(us_noise)
                 # print(name, "val_time_net = ", "{:.3f}s".format(time.time() - time_net))
-                time_IEKF = time.time()
-
-                us_fix = ys[:, :, :6] * us_noise[:, :, :6] - ys[:, :, 6:12]
-                # iekf.set_Q()
-                measurements_covs = ys[:, :, 12:14]
-                # Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i = \
-                #     iekf.run(t, us_fix, measurements_covs, v_gt, p_gt, t.shape[1], ang_gt[:, 0, :])
 
-                # print(name, "val_time_IEKF = ", "{:.3f}s".format(time.time() - time_IEKF))
-
-                time_Loss = time.time()
-
-                # hat_dRot_ij = bbmtm(Rot[:, :-1].clone(), Rot[:, 1:].clone()).double()
-                hat_dxi_ij = torch.zeros(us_fix.shape[0], us_fix.shape[1]-1, 3).double()
-                Rot_gt = torch.zeros(us_fix.shape[0], us_fix.shape[1] - 1, 3, 3).double()
-                # hat_acc = torch.zeros(Rot_gt.shape[0], Rot_gt.shape[1], 3).double()
-                for i in range(0, Rot_gt.shape[0]):
-                    # hat_dxi_ij[i] = SO3.log(hat_dRot_ij[i].clone()).double()
-                    Rot_gt[i] = SO3.from_rpy(ang_gt[i, :-1, 0], ang_gt[i, :-1, 1], ang_gt[i, :-1, 2])
-                hat_acc = (bbmv(Rot_gt, us_fix[:, :-1, 3:6]) + self.g).double()
-                hat_dv_ij = (v_gt[:, 1:, :].clone() - v_gt[:, :-1, :].clone()).double()
-                hat_dp_ij = (p_gt[:, 1:, :].clone() - p_gt[:, :-1, :].clone()).double()
-                # hat_dv_ij = (v[:, 1:, :].clone() - v[:, :-1, :].clone()).double()
-                # hat_dp_ij = (p[:, 1:, :].clone() - p[:, :-1, :].clone()).double()
-                # hat_xs = torch.cat((hat_dxi_ij.clone(), hat_dv_ij.clone(), hat_dp_ij.clone()), dim=2)
-                # hat_xs = torch.cat((us_fix[:, :-1, :3].clone(), hat_acc[:, :, :].clone(), hat_dp_ij.clone()), dim=2)
-
-                dt = t[:, 1:] - t[:, :-1]
-                hat_xi = torch.einsum('bij, bi -> bij', (us_fix[:, :-1, :3].clone()), dt).double()
-                hat_dv = torch.einsum('bij, bi -> bij', (hat_acc.clone()), dt).double()
-                # hat_xs = torch.cat((hat_xi.clone(), hat_dv.clone(), hat_dp_ij.clone()), dim=2)
-                hat_xs = torch.cat((hat_xi.clone(), hat_dv.clone(),
-                                    hat_dxi_ij.clone(), hat_dv_ij.clone(), hat_dp_ij.clone()), dim=2)
-
-                loss = criterion(xs[:, :-1, :], hat_xs) / len(dataloader)
+                us_fix, measurements_covs = self.calibrate(ys, us_noise)
 
+                Rot_gt = self.precision.cast(Rot_gt, 'lie')
+                hat_dxi_ij = us_fix.new_zeros(us_fix.shape[0], us_fix.shape[1] - 1, 3)
+                hat_xs = self.get_hat_xs(t, us_fix, Rot_gt, hat_dxi_ij, v_gt, p_gt)
 
+                loss = criterion(xs[:, :-1, :], hat_xs, Rot_xs[:, :-1]) / len(dataloader)
                 loss_epoch += loss.cpu()
-                # print(name, "val_time_Loss = ", "{:.3f}s".format(time.time() - time_Loss))
 
         self.net.train()
-        return loss_epoch
+        self.idle_time = batches.idle_time
+        return self.average(loss_epoch)
 
     def loop_train(self, dataloader, optimizer, criterion, iekf):
         """Forward-backward loop over training data"""
         loss_epoch = 0
+        batches = Prefetcher(dataloader, self.prefetch)
         optimizer.zero_grad()
 
-        for t, us, xs, p_gt, v_gt, ang_gt, name in dataloader:
-            t, us, xs, p_gt, v_gt, ang_gt = t, us, xs, p_gt, v_gt, ang_gt
-            us_noise = dataloader.dataset.add_noise(us)
+        for t, us, xs, p_gt, v_gt, ang_gt, Rot_gt, Rot_xs, name in batches:
+            us_noise = self.batch_noise(dataloader, us)
 
             # IEKF
             time_net = time.time()
@@ -367,81 +417,105 @@ class LearningBasedProcessing:
             print('bias =', ys_b)
             print('mescov =', ys_mc)
             time_IEKF = time.time()
-            us_fix = ys[:, :, :6] * us_noise[:, :, :6] - ys[:, :, 6:12]
+            us_fix, measurements_covs = self.calibrate(ys, us_noise)
             iekf.set_Q()
-            measurements_covs = ys[:, :, 12:14]
 
             Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i = \
                 iekf.run(t, us_fix, measurements_covs, v_gt, p_gt, t.shape[1], ang_gt[:, 0, :])
 
             print(name, "train_time_IEKF = ", "{:.3f}s".format(time.time() - time_IEKF))
             time_Loss = time.time()
-            hat_dRot_ij = bbmtm(Rot[:, :-1].clone(), Rot[:, 1:].clone()).double()
-
-            hat_dxi_ij = torch.zeros(hat_dRot_ij.shape[0], hat_dRot_ij.shape[1], 3).double()
-            Rot_gt = torch.zeros(us_fix.shape[0], us_fix.shape[1] - 1, 3, 3).double()
-            # hat_acc = torch.zeros(Rot_gt.shape[0], Rot_gt.shape[1], 3).double()
-
-            for i in range(0, Rot_gt.shape[0]):
-                hat_dxi_ij[i] = SO3.log(hat_dRot_ij[i].clone()).double()
-                Rot_gt[i] = SO3.from_rpy(ang_gt[i, :-1, 0], ang_gt[i, :-1, 1], ang_gt[i, :-1, 2])
-
-            hat_acc = (bbmv(Rot_gt, us_fix[:, :-1, 3:6]) + self.g).double()
-
-            # hat_dv_ij = (v_gt[:, 1:, :].clone() - v_gt[:, :-1, :].clone()).double()
-            # hat_dp_ij = (p_gt[:, 1:, :].clone() - p_gt[:, :-1, :].clone()).double()
-
-            hat_dv_ij = (v[:, 1:, :].clone() - v[:, :-1, :].clone()).double()
-            hat_dp_ij = (p[:, 1:, :].clone() - p[:, :-1, :].clone()).double()
-
-            # hat_xs = torch.cat((hat_dxi_ij.clone(), hat_dv_ij.clone(), hat_dp_ij.clone()), dim=2)
-            dt = t[:, 1:] - t[:, :-1]
-            hat_xi = torch.einsum('bij, bi -> bij', (us_fix[:, :-1, :3].clone()), dt).double()
-            hat_dv = torch.einsum('bij, bi -> bij', (hat_acc.clone()), dt).double()
-
-            # hat_xs = torch.cat((hat_xi.clone(), hat_dv.clone(), hat_dp_ij.clone()), dim=2)
-
-            hat_xs = torch.cat((hat_xi.clone(), hat_dv.clone(),
-                                hat_dxi_ij.clone(), hat_dv_ij.clone(), hat_dp_ij.clone()), dim=2)
+            hat_dxi_ij = self.rotation_increments(Rot)
+            Rot_gt = self.precision.cast(Rot_gt, 'lie')
+            hat_xs = self.get_hat_xs(t, us_fix, Rot_gt, hat_dxi_ij, v, p)
 
             # def print_grad(grad):
             #     print("Gradient on model.fc1.weight:\n", grad)
             # iekf.initprocesscov_net.factor_process_covariance.weight.register_hook(print_grad)
 
-            loss = criterion(xs[:, :-1, :], hat_xs) / len(dataloader)
-
-            loss = loss.cuda()
+            loss = criterion(xs[:, :-1, :], hat_xs, Rot_xs[:, :-1]) / len(dataloader)
             loss.backward()
-            loss = loss.cpu()
-
-
 
             loss_epoch += loss.detach().cpu()
             print(name, "train_time_Loss = ", "{:.3f}s".format(time.time() - time_Loss))
 
             # with torch.autograd.detect_anomaly():
 
+        self.average_gradients(optimizer)
+        optimizer.step()
+        if self.output_cache is not None:  # weights are hashed again
+            self.output_cache.invalidate()
+        self.idle_time = batches.idle_time
+        return self.average(loss_epoch)
+
+    def loop_train_shared(self, dataset, optimizer, criterion, iekf, n_windows):
+        """Forward-backward loop over training data, the network being run once
+        per full training sequence and the filter on n_windows random windows
+        sliced from each network output"""
+        optimizer.zero_grad()
+        self.idle_time = 0  # sequences are read by the network pass
+        N = dataset.N
+        keys = ('t', 'xs', 'p_gt', 'v_gt', 'ang_gt', 'Rot_gt', 'Rot_xs')
+        batch = {key: [] for key in keys + ('ys', 'us_noise')}
+
+        time_net = time.time()
+        # sequences are split between processes
+        for i in DistributedSampler(dataset, self.world_size, self.rank, False):
+            mondict = dict(dataset.load_seq(i))  # the loaded dict is shared
+            us_noise, ys = self.noisy_forward(dataset, mondict['us'].unsqueeze(0),
+                mondict['name'], np.random.randint(self.noise_seeds))
+            mondict['us_noise'], mondict['ys'] = us_noise[0], ys[0]
+            # windows see the true history of the sequence instead of padding
+            for _ in range(n_windows):
+                n0 = dataset.random_start(mondict['us'].shape[0])
+                for key in batch:
+                    batch[key].append(mondict[key][n0: n0 + N])
+        print("train_time_net = ", "{:.3f}s".format(time.time() - time_net))
+        t, xs, p_gt, v_gt, ang_gt, Rot_gt, Rot_xs, ys, us_noise = \
+            [torch.stack(batch[key]) for key in batch]
+
+        time_IEKF = time.time()
+        us_fix, measurements_covs = self.calibrate(ys, us_noise)
+        iekf.set_Q()
+
+        Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i = \
+            iekf.run(t, us_fix, measurements_covs, v_gt, p_gt, t.shape[1], ang_gt[:, 0, :])
+
+        print("train_time_IEKF = ", "{:.3f}s".format(time.time() - time_IEKF))
+        hat_dxi_ij = self.rotation_increments(Rot)
+        Rot_gt = self.precision.cast(Rot_gt, 'lie')
+        hat_xs = self.get_hat_xs(t, us_fix, Rot_gt, hat_dxi_ij, v, p)
+
+        loss = criterion(xs[:, :-1, :], hat_xs, Rot_xs[:, :-1])
+        loss.backward()
+
+        self.average_gradients(optimizer)
         optimizer.step()
-        return loss_epoch
+        if self.output_cache is not None:  # weights are hashed again
+            self.output_cache.invalidate()
+        return self.average(loss.detach().cpu())
 
     def loop_val(self, dataloader, criterion, iekf):
         """Forward loop over validation data"""
         loss_epoch = 0
+        batches = Prefetcher(dataloader, self.prefetch)
         self.net.eval()
         # iekf = IEKF()
         with torch.no_grad():
-            for t, us, xs, p_gt, v_gt, ang_gt, name in dataloader:
-                t, us, xs, p_gt, v_gt, ang_gt = t, us, xs, p_gt, v_gt, ang_gt
-                us_noise = dataloader.dataset.add_noise(us)
+            for t, us, xs, p_gt, v_gt, ang_gt, Rot_gt, Rot_xs, name in batches:
                 # IEKF
                 time_net = time.time()
-                ys = self.net(us_noise)
+                if self.output_cache is None:
+                    us_noise = self.batch_noise(dataloader, us)
+                    ys = self.net(us_noise)
+                else:
+                    us_noise, ys = map(torch.cat, zip(*[self.noisy_forward(
+                        dataloader.dataset, us[j: j + 1], name[j], 0) for j in range(len(name))]))
                 print(name, "val_time_net = ", "{:.3f}s".format(time.time() - time_net))
                 time_IEKF = time.time()
 
-                us_fix = ys[:, :, :6] * us_noise[:, :, :6] - ys[:, :, 6:12]
+                us_fix, measurements_covs = self.calibrate(ys, us_noise)
                 self.iekf.set_Q()
-                measurements_covs = ys[:, :, 12:14]
 
                 Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i = \
                     iekf.run(t, us_fix, measurements_covs, v_gt, p_gt, t.shape[1], ang_gt[:, 0, :])
@@ -449,37 +523,105 @@ class LearningBasedProcessing:
                 print(name, "val_time_IEKF = ", "{:.3f}s".format(time.time() - time_IEKF))
 
                 time_Loss = time.time()
+                hat_dxi_ij = self.rotation_increments(Rot)
+                Rot_gt = self.precision.cast(Rot_gt, 'lie')
+                hat_xs = self.get_hat_xs(t, us_fix, Rot_gt, hat_dxi_ij, v, p)
 
-                hat_dRot_ij = bbmtm(Rot[:, :-1].clone(), Rot[:, 1:].clone()).double()
-                hat_dxi_ij = torch.zeros(hat_dRot_ij.shape[0], hat_dRot_ij.shape[1], 3).double()
-                Rot_gt = torch.zeros(us_fix.shape[0], us_fix.shape[1] - 1, 3, 3).double()
-                # hat_acc = torch.zeros(Rot_gt.shape[0], Rot_gt.shape[1], 3).double()
-                for i in range(0, Rot_gt.shape[0]):
-                    hat_dxi_ij[i] = SO3.log(hat_dRot_ij[i].clone()).double()
-                    Rot_gt[i] = SO3.from_rpy(ang_gt[i, :-1, 0], ang_gt[i, :-1, 1], ang_gt[i, :-1, 2])
-                hat_acc = (bbmv(Rot_gt, us_fix[:, :-1, 3:6]) + self.g).double()
-                # hat_dv_ij = (v_gt[:, 1:, :].clone() - v_gt[:, :-1, :].clone()).double()
-                # hat_dp_ij = (p_gt[:, 1:, :].clone() - p_gt[:, :-1, :].clone()).double()
-                hat_dv_ij = (v[:, 1:, :].clone() - v[:, :-1, :].clone()).double()
-                hat_dp_ij = (p[:, 1:, :].clone() - p[:, :-1, :].clone()).double()
-                # hat_xs = torch.cat((hat_dxi_ij.clone(), hat_dv_ij.clone(), hat_dp_ij.clone()), dim=2)
-                # hat_xs = torch.cat((us_fix[:, :-1, :3].clone(), hat_acc[:, :, :].clone(), hat_dp_ij.clone()), dim=2)
-
-                dt = t[:, 1:] - t[:, :-1]
-                hat_xi = torch.einsum('bij, bi -> bij', (us_fix[:, :-1, :3].clone()), dt).double()
-                hat_dv = torch.einsum('bij, bi -> bij', (hat_acc.clone()), dt).double()
-                # hat_xs = torch.cat((hat_xi.clone(), hat_dv.clone(), hat_dp_ij.clone()), dim=2)
-                hat_xs = torch.cat((hat_xi.clone(), hat_dv.clone(),
-                                    hat_dxi_ij.clone(), hat_dv_ij.clone(), hat_dp_ij.clone()), dim=2)
-
-                loss = criterion(xs[:, :-1, :], hat_xs) / len(dataloader)
-
-
+                loss = criterion(xs[:, :-1, :], hat_xs, Rot_xs[:, :-1]) / len(dataloader)
                 loss_epoch += loss.cpu()
                 print(name, "val_time_Loss = ", "{:.3f}s".format(time.time() - time_Loss))
 
         self.net.train()
-        return loss_epoch
+        self.idle_time = batches.idle_time
+        return self.average(loss_epoch)
+
+    @staticmethod
+    def average_gradients(optimizer):
+        """average the gradients of the optimized parameters over the processes
+        of distributed training, in one all-reduce"""
+        if not dist.is_initialized():
+            return
+        params = [param for group in optimizer.param_groups for param in group['params']]
+        for param in params:
+            if param.grad is None:  # e.g. unused in this process
+                param.grad = torch.zeros_like(param)
+        grads = torch.cat([param.grad.flatten() for param in params])
+        dist.all_reduce(grads)
+        grads /= dist.get_world_size()
+        for param, grad in zip(params, grads.split([param.numel() for param in params])):
+            param.grad.copy_(grad.view_as(param))
+
+    def average_buffers(self):
+        """average the batch normalization statistics of the network over the
+        processes of distributed training, which saw different batches"""
+        if not dist.is_initialized():
+            return
+        for buffer in self.net.buffers():
+            if buffer.is_floating_point():
+                dist.all_reduce(buffer)
+                buffer /= dist.get_world_size()
+
+    @staticmethod
+    def average(loss):
+        """mean of a loss over the processes of distributed training"""
+        if not dist.is_initialized():
+            return loss
+        loss = torch.as_tensor(loss).clone()
+        dist.all_reduce(loss)
+        return loss / dist.get_world_size()
+
+    @staticmethod
+    def batch_noise(dataloader, us):
+        """noisy inputs of a batch, unless the dataset already added noise"""
+        if dataloader.dataset.augment:
+            return us
+        return dataloader.dataset.add_noise(us)
+
+    def noisy_forward(self, dataset, us, name, seed):
+        """Noisy inputs and network outputs of a full sequence. With an output
+        cache, the noise is drawn from seed and the outputs of the frozen
+        network are read from the cache"""
+        if self.output_cache is None:
+            us_noise = dataset.add_noise(us)
+            return us_noise, self.net(us_noise)
+        with torch.random.fork_rng():
+            torch.manual_seed(seed)
+            us_noise = dataset.add_noise(us)
+        ys = self.output_cache.get(self.net, name, seed)
+        if ys is None:
+            training = self.net.training
+            with torch.no_grad():
+                ys = self.net.eval()(us_noise)
+            self.net.train(training)
+            self.output_cache.put(self.net, name, seed, ys)
+        return us_noise, ys
+
+    def calibrate(self, ys, us_noise):
+        """Correct IMU inputs with the network outputs, in filter precision"""
+        ys = self.precision.cast(ys, 'filter')
+        us_noise = self.precision.cast(us_noise, 'filter')
+        return IEKF.correct_imu(ys, us_noise)
+
+    def rotation_increments(self, Rot):
+        """Logarithm of orientation increments between consecutive samples"""
+        Rot = self.precision.cast(Rot, 'lie')
+        dRot_ij = bbmtm(Rot[:, :-1], Rot[:, 1:])
+        dxi_ij = SO3.log(dRot_ij.reshape(-1, 3, 3))
+        return dxi_ij.reshape(Rot.shape[0], Rot.shape[1] - 1, 3)
+
+    def get_hat_xs(self, t, us_fix, Rot_gt, hat_dxi_ij, v, p):
+        """Stack the estimated increments compared to ground truth in the loss"""
+        cast = self.precision.cast
+        us_fix, Rot_gt, hat_dxi_ij, v, p = cast(us_fix, 'loss'), cast(Rot_gt, 'loss'), \
+            cast(hat_dxi_ij, 'loss'), cast(v, 'loss'), cast(p, 'loss')
+        dt = cast(t[:, 1:] - t[:, :-1], 'loss')
+
+        hat_acc = bbmv(Rot_gt[:, :-1], us_fix[:, :-1, 3:6]) + self.g.to(us_fix.dtype)
+        hat_dv_ij = v[:, 1:] - v[:, :-1]
+        hat_dp_ij = p[:, 1:] - p[:, :-1]
+        hat_xi = torch.einsum('bij, bi -> bij', us_fix[:, :-1, :3], dt)
+        hat_dv = torch.einsum('bij, bi -> bij', hat_acc, dt)
+        return torch.cat((hat_xi, hat_dv, hat_dxi_ij, hat_dv_ij, hat_dp_ij), dim=2)
 
     # def save_net(self):
     #     """save the weights on the net in CPU"""
@@ -533,28 +675,69 @@ class LearningBasedProcessing:
                 **loss_params, **scheduler_params,
                 'n_epochs': n_epochs, 'freq_val': freq_val}
 
-    def test(self, dataset_class, dataset_params, modes, display_only = False):
+    def test(self, dataset_class, dataset_params, modes, display_only = False,
+             inference=None, chunk_size=None, stream_size=None):
+        """Test the network and filter, inference selects the network used:
+        None for the trained network, 'fused' for its export_for_inference()
+        copy and 'int8' for its quantized copy, calibrated on the training
+        sequences. If chunk_size is given, the network is evaluated by chunks,
+        see chunked_forward. If stream_size is given, sequences are read,
+        filtered and saved by chunks of stream_size samples, see
+        loop_test_streaming"""
 
         Loss = self.train_params['loss_class']
         loss_params = self.train_params['loss']
         criterion = Loss(**loss_params)
+        criterion.set_precision(self.precision)
+        calibration_us = None
+        if inference == 'int8':
+            calibration_us = self.calibration_inputs(dataset_class, dataset_params)
+        net = self.get_inference_net(inference, calibration_us)
+        self.prefetch = self.train_params.get('prefetch', 0)
 
         for mode in modes:
             dataset = dataset_class(**dataset_params, mode=mode)
             if display_only:
                 self.display_test(dataset, mode)
+            elif stream_size is not None:
+                self.loop_test_streaming(dataset, criterion, self.iekf, net, stream_size)
+                self.display_test(dataset, mode)
             else:
-                self.loop_test(dataset, criterion, self.iekf)
+                self.loop_test(dataset, criterion, self.iekf, net, chunk_size)
                 self.display_test(dataset, mode)
 
-    def loop_test(self, dataset, criterion, iekf):
-        """Forward loop over test data"""
+    def get_inference_net(self, inference=None, calibration_us=None):
+        """network used at test time"""
         self.net.eval()
+        if inference is None:
+            return self.net
+        elif inference == 'fused':
+            return self.net.export_for_inference()
+        elif inference == 'int8':
+            return self.net.export_quantized(calibration_us,
+                self.train_params.get('quantized_backend', 'x86'))
+        raise ValueError("unknown inference network: {}".format(inference))
+
+    def calibration_inputs(self, dataset_class, dataset_params):
+        """noisy full training sequences for calibrating quantization"""
+        dataset = dataset_class(**dataset_params, mode='train')
+        calibration_us = []
         for i in range(len(dataset)):
+            us = dataset[i][1]
+            calibration_us.append(dataset.add_noise(us.unsqueeze(0)))
+        return calibration_us
+
+    def loop_test(self, dataset, criterion, iekf, net=None, chunk_size=None):
+        """Forward loop over test data"""
+        self.net.eval()
+        net = self.net if net is None else net
+        # the next sequences are read while the current one is filtered
+        sequences = Prefetcher((dataset[i] for i in range(len(dataset))), self.prefetch)
+        for i, sequence in enumerate(sequences):
             seq = dataset.sequences[i]
             # iekf = IEKF()
 
-            t, us, xs, p_gt, v_gt, ang_gt, name = dataset[i]
+            t, us, xs, p_gt, v_gt, ang_gt, Rot_gt, Rot_xs, name = sequence
 
             t, us, xs, p_gt, v_gt, ang_gt = \
                 t, us, xs, p_gt, v_gt, ang_gt
@@ -565,48 +748,37 @@ class LearningBasedProcessing:
             p_gt = p_gt.clone().unsqueeze(0)
             v_gt = v_gt.clone().unsqueeze(0)
             ang_gt = ang_gt.clone().unsqueeze(0)
+            Rot_gt = Rot_gt.unsqueeze(0)
+            Rot_xs = Rot_xs.unsqueeze(0)
 
             us_noise = dataset.add_noise(us)
 
             with torch.no_grad():
                 # IEKF
                 time_net = time.time()
-                ys = self.net(us_noise)
+                if chunk_size is None:
+                    ys = net(us_noise)
+                else:
+                    ys = chunked_forward(net, us_noise, chunk_size)
 
 
                 print(name, "test_time_net = ", "{:.3f}s".format(time.time() - time_net))
                 time_IEKF = time.time()
 
-                us_fix = ys[:, :, :6] * us_noise[:, :, :6] - ys[:, :, 6:12] #is there a mistake?
+                us_fix, measurements_covs = self.calibrate(ys, us_noise) #is there a mistake?
                 iekf.set_Q()
-                measurements_covs = ys[:, :, 12:14]
                 Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i = \
                     iekf.run(t, us_fix, measurements_covs, v_gt, p_gt, t.shape[1], ang_gt[:, 0, :])
 
                 print(name, "test_time_IEKF = ", "{:.3f}s".format(time.time() - time_IEKF))
 
-                hat_dRot_ij = bbmtm(Rot[:, :-1].clone(), Rot[:, 1:].clone()).double()
-                hat_dxi_ij = torch.zeros(hat_dRot_ij.shape[0], hat_dRot_ij.shape[1], 3).double()
-                Rot_gt = torch.zeros(us_fix.shape[0], us_fix.shape[1] - 1, 3, 3).double()
-
-                for i in range(0, Rot_gt.shape[0]):
-                    hat_dxi_ij[i] = SO3.log(hat_dRot_ij[i].clone()).double()
-                    Rot_gt[i] = SO3.from_rpy(ang_gt[i, :-1, 0], ang_gt[i, :-1, 1], ang_gt[i, :-1, 2])
-
-                hat_acc = (bbmv(Rot_gt, us_fix[:, :-1, 3:6]) + self.g).double()
-                hat_dv_ij = (v[:, 1:, :].clone() - v[:, :-1, :].clone()).double()
-                hat_dp_ij = (p[:, 1:, :].clone() - p[:, :-1, :].clone()).double()
-
-                dt = t[:, 1:] - t[:, :-1]
-                hat_xi = torch.einsum('bij, bi -> bij', (us_fix[:, :-1, :3].clone()), dt).double()
-                hat_dv = torch.einsum('bij, bi -> bij', (hat_acc.clone()), dt).double()
-
-                hat_xs = torch.cat((hat_xi.clone(), hat_dv.clone(),
-                                    hat_dxi_ij.clone(), hat_dv_ij.clone(), hat_dp_ij.clone()), dim=2)
+                hat_dxi_ij = self.rotation_increments(Rot)
+                Rot_gt = self.precision.cast(Rot_gt, 'lie')
+                hat_xs = self.get_hat_xs(t, us_fix, Rot_gt, hat_dxi_ij, v, p)
                 time_dateset = time.time() - time_net
                 print('time_dateset=',time_dateset)
 
-            loss = criterion(xs[:, :-1, :], hat_xs)
+            loss = criterion(xs[:, :-1, :], hat_xs, Rot_xs[:, :-1])
 
             print(name, "test_loss = ", "{:.3f}".format(loss))
             mkdir(self.address, seq)
@@ -637,11 +809,120 @@ class LearningBasedProcessing:
                 'time_dateset': time_dateset,
             }
             pdump(mondict, self.address, seq, 'results.p')
+        self.idle_time = sequences.idle_time
+        print("test_time_idle = ", "{:.3f}s".format(self.idle_time))
+
+    def loop_test_streaming(self, dataset, criterion, iekf, net, chunk_size):
+        """Forward loop over test data read by chunks of chunk_size samples,
+        for recordings longer than memory.
+
+        The network keeps its receptive field as context and the filter its
+        state from a chunk to the next, and the loss is accumulated over
+        chunks, so that results are those of loop_test up to the noise draws.
+        Results are appended to a columnar 'results' sequence in the result
+        directory of each sequence, see load_test_result.
+        """
+        N0 = criterion.N0
+        fields = ('t', 'us_fix', 'Rot', 'v', 'p', 'Rot_gt', 'xs', 'Rot_xs')
+        for i in range(len(dataset)):
+            seq = dataset.sequences[i]
+            mkdir(self.address, seq)
+            if os.path.exists(os.path.join(self.address, seq, 'results.p')):
+                os.remove(os.path.join(self.address, seq, 'results.p'))
+            writer = ColumnarStore(os.path.join(self.address, seq)).writer('results')
+            stream = ChunkedStreamingNet(net)
+            state = None
+            # last N0 + 1 samples of the previous chunk, whose N0 increments
+            # are discarded by the loss
+            tail = None
+            loss_sum, n_loss = 0, 0
+            time_net = time.time()
+            for n0, chunk in Prefetcher(dataset.iter_chunks(i, chunk_size), self.prefetch):
+                t, us, xs, p_gt, v_gt, ang_gt, Rot_gt, Rot_xs = [
+                    chunk[key].unsqueeze(0) for key in ('t', 'us', 'xs', 'p_gt', 'v_gt',
+                                                        'ang_gt', 'Rot_gt', 'Rot_xs')]
+                name = chunk['name']
+                with torch.no_grad():
+                    if state is None:  # the bias of a sequence is constant
+                        b0 = dataset.sample_b0(us[:, 0].shape)
+                    us_noise = dataset.add_noise(us, b0)
+                    ys = stream(us_noise)
+                    us_fix, measurements_covs = self.calibrate(ys, us_noise)
+                    if state is None:
+                        iekf.set_Q()
+                        state = iekf.init_state(t[:, 0], v_gt[:, 0], ang_gt[:, 0])
+                        first = [state[key].unsqueeze(1) for key in ('Rot', 'v', 'p',
+                            'b_omega', 'b_acc', 'Rot_c_i', 't_c_i')]
+                        estimates, state = iekf.run_chunk(state, t[:, 1:], us_fix[:, 1:],
+                                                          measurements_covs[:, 1:])
+                        estimates = [torch.cat(x, 1) for x in zip(first, estimates)]
+                    else:
+                        estimates, state = iekf.run_chunk(state, t, us_fix, measurements_covs)
+                    Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i = estimates
+
+                    current = dict(zip(fields, (t, us_fix, Rot, v, p,
+                                                self.precision.cast(Rot_gt, 'lie'), xs, Rot_xs)))
+                    if tail is not None:
+                        current = {key: torch.cat((tail[key], current[key]), 1)
+                                   for key in fields}
+                    hat_dxi_ij = self.rotation_increments(current['Rot'])
+                    hat_xs = self.get_hat_xs(current['t'], current['us_fix'],
+                        current['Rot_gt'], hat_dxi_ij, current['v'], current['p'])
+                    n_inc = hat_xs.shape[1]
+                    loss = criterion(current['xs'][:, :n_inc], hat_xs,
+                                     current['Rot_xs'][:, :n_inc])
+                    # criterion is a mean over the increments after the N0 first
+                    loss_sum += loss.item() * (n_inc - N0)
+                    n_loss += n_inc - N0
+                    tail = {key: x[:, -(N0 + 1):] for key, x in current.items()}
+
+                n_new = t.shape[1] if n0 > 0 else t.shape[1] - 1  # new increments
+                writer.append(xs=xs[0], hat_xs=hat_xs[0, n_inc - n_new:], t=t[0], us=us[0],
+                              p_gt=p_gt[0], ang_gt=ang_gt[0], v_gt=v_gt[0], ys=ys[0],
+                              us_fix=us_fix[0], us_noise=us_noise[0],
+                              measurements_covs=measurements_covs[0], Rot=Rot[0], v=v[0],
+                              p=p[0], b_omega=b_omega[0], b_acc=b_acc[0], Rot_c_i=Rot_c_i[0],
+                              t_c_i=t_c_i[0])
+            time_dateset = time.time() - time_net
+            loss = loss_sum / n_loss
+            print(name, "test_loss = ", "{:.3f}".format(loss))
+            writer.close(loss=loss, time_dateset=time_dateset)
+
+    def load_test_result(self, seq):
+        """results of loop_test, or of loop_test_streaming memory-mapped"""
+        if os.path.exists(os.path.join(self.address, seq, 'results.p')):
+            return pload(self.address, seq, 'results.p')
+        return ColumnarStore(os.path.join(self.address, seq)).load('results')
 
     def display_test(self, dataset, mode):
         raise NotImplementedError
 
 
+def train_process(rank, learning_process, dataset_class, dataset_params, train_params):
+    """Process rank of distributed data-parallel training on CPU, started by
+    LearningBasedProcessing.train when train_params['distributed'] is set.
+
+    Processes join a gloo group on localhost, train a copy of the network on
+    their share of the sequences or windows and average their gradients before
+    each optimizer step, so that they keep the same weights.
+    """
+    distributed = train_params['distributed']
+    dist.init_process_group('gloo', init_method='tcp://127.0.0.1:{}'.format(
+        distributed.get('port', 29500)), rank=rank, world_size=distributed['world_size'])
+    # one core per process by default
+    torch.set_num_threads(distributed.get('threads', 1))
+    # noise and window starts differ between processes
+    seed = distributed.get('seed', 0)
+    torch.manual_seed(seed + rank)
+    np.random.seed(seed + rank)
+    # parameters received from the parent are in shared memory
+    learning_process = copy.deepcopy(learning_process)
+    try:
+        learning_process.train(dataset_class, dataset_params, train_params)
+    finally:
+        dist.destroy_process_group()
+
+
 class GyroLearningBasedProcessing(LearningBasedProcessing):
     def __init__(self, res_dir, tb_dir, net_class, net_params, address, dt):
         super().__init__(res_dir, tb_dir, net_class, net_params, address, dt)
@@ -680,7 +961,7 @@ class GyroLearningBasedProcessing(LearningBasedProcessing):
 
             self.seq = seq
             # self.test_seq = dataset.load_seq(i)
-            self.test_result = pload(self.address, seq, 'results.p')
+            self.test_result = self.load_test_result(seq)
 
             t = self.test_result['t']
             p_gt = self.test_result['p_gt']
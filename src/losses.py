@@ -2,7 +2,7 @@ import numpy as np
 import torch
 from src.utils import bmmt, bmv, bmtv, bbmv, bmtm
 from src.lie_algebra import SO3
-import matplotlib.pyplot as plt
+from src.precision import PrecisionPolicy
 
 
 class BaseLoss(torch.nn.Module):
@@ -16,6 +16,11 @@ class BaseLoss(torch.nn.Module):
         self.max_train_freq = 2 ** self.max_N
         # sampling time
         self.dt = dt # (s)
+        # dtype of loss and Lie group computations
+        self.precision = PrecisionPolicy()
+
+    def set_precision(self, precision):
+        self.precision = precision
 
 
 class GyroLoss(BaseLoss):
@@ -39,35 +44,40 @@ class GyroLoss(BaseLoss):
         loss = self.w * self.sl(rs/self.huber, torch.zeros_like(rs)) * (self.huber**2)
         return loss
 
-    def forward_with_all(self, xs, hat_xs):
-        """Forward errors with SE2(3)"""
+    def forward_with_all(self, xs, hat_xs, Omegas_Xs=None):
+        """Forward errors with SE2(3). Omegas_Xs are the rotations of the
+        ground truth increments, computed from xs if not given"""
 
 
         N = xs.shape[0]
 
         # IEKF
-        xs = xs.reshape(-1, 9).double()
-        omegas_xs = xs[:, :3].double()
-        dv_xs = xs[:, 3:6].double()
-        dp_xs = xs[:, 6:9].double()
+        cast = self.precision.cast
+        xs = cast(xs.reshape(-1, 9), 'loss')
+        omegas_xs = xs[:, :3]
+        dv_xs = xs[:, 3:6]
+        dp_xs = xs[:, 6:9]
 
-        Omegas_Xs = SO3.exp(omegas_xs).double()
+        if Omegas_Xs is None:
+            Omegas_Xs = SO3.exp(cast(omegas_xs, 'lie'))
+        else:
+            Omegas_Xs = cast(Omegas_Xs.reshape(-1, 3, 3), 'lie')
 
 
-        hat_xs = hat_xs.reshape(-1, 15).double()
-        hat_omegas = hat_xs[:, :3].double()
-        hat_acc = hat_xs[:, 3:6].double()
-        hat_dxi = hat_xs[:, 6:9].double()
-        hat_dv = hat_xs[:, 9:12].double()
-        hat_dp = hat_xs[:, 12:15].double()
-        hat_Omegas = SO3.exp(hat_omegas).double()
-        hat_Xi = SO3.exp(hat_dxi).double()
+        hat_xs = cast(hat_xs.reshape(-1, 15), 'loss')
+        hat_omegas = hat_xs[:, :3]
+        hat_acc = hat_xs[:, 3:6]
+        hat_dxi = hat_xs[:, 6:9]
+        hat_dv = hat_xs[:, 9:12]
+        hat_dp = hat_xs[:, 12:15]
+        hat_Omegas = SO3.exp(cast(hat_omegas, 'lie'))
+        hat_Xi = SO3.exp(cast(hat_dxi, 'lie'))
 
 
 
-        rs1 = 6e0 * SO3.log(bmtm(Omegas_Xs, hat_Omegas)).reshape(N, -1, 3)[:, self.N0:]
+        rs1 = 6e0 * cast(SO3.log(bmtm(Omegas_Xs, hat_Omegas)), 'loss').reshape(N, -1, 3)[:, self.N0:]
         rs2 = 6e0 * (dv_xs - hat_acc).reshape(N, -1, 3)[:, self.N0:]
-        rs3 = SO3.log(bmtm(Omegas_Xs, hat_Xi)).reshape(N, -1, 3)[:, self.N0:]
+        rs3 = cast(SO3.log(bmtm(Omegas_Xs, hat_Xi)), 'loss').reshape(N, -1, 3)[:, self.N0:]
         rs4 = (dv_xs - hat_dv).reshape(N, -1, 3)[:, self.N0:]
         rs5 = (dp_xs - hat_dp).reshape(N, -1, 3)[:, self.N0:]
         rs = torch.cat((rs1, rs2, rs3, rs4, rs5), dim=2)
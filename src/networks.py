@@ -1,8 +1,10 @@
+import copy
+import warnings
 import torch
-import matplotlib.pyplot as plt
 import numpy as np
 from src.utils import bmtm, bmtv, bmmt, bbmv
 from src.lie_algebra import SO3
+from src.precision import PrecisionPolicy
 
 
 class BaseNet(torch.nn.Module):
@@ -25,18 +27,19 @@ class BaseNet(torch.nn.Module):
         d2 = ds[2]
         # padding
         p0 = (k0 - 1) + d0 * (k1 - 1) + d0 * d1 * (k2 - 1) #+ d0 * d1 * d2 * (k3 - 1)
+        self.p0 = p0  # an output depends on the p0 + 1 last inputs
         # nets
         self.cnn = torch.nn.Sequential(
             torch.nn.ReplicationPad1d((p0, 0)),  # padding at start
-            torch.nn.Conv1d(in_dim, c0, k0, dilation=1),
+            *self.conv(in_dim, c0, k0, dilation=1),
             torch.nn.BatchNorm1d(c0, momentum=momentum),
             torch.nn.GELU(),
             torch.nn.Dropout(dropout),
-            torch.nn.Conv1d(c0, c1, k1, dilation=d0),
+            *self.conv(c0, c1, k1, dilation=d0),
             torch.nn.BatchNorm1d(c1, momentum=momentum),
             torch.nn.GELU(),
             torch.nn.Dropout(dropout),
-            torch.nn.Conv1d(c1, c2, k2, dilation=d0 * d1),
+            *self.conv(c1, c2, k2, dilation=d0 * d1),
             torch.nn.BatchNorm1d(c2, momentum=momentum),
             torch.nn.GELU(),
             torch.nn.Dropout(dropout),
@@ -53,22 +56,96 @@ class BaseNet(torch.nn.Module):
                                          requires_grad=False)
         self.std_u = torch.nn.Parameter(torch.ones(in_dim),
                                         requires_grad=False)
+        # dtype of each stage
+        self.precision = PrecisionPolicy()
+        self.init_head()
+
+    def conv(self, in_channels, out_channels, kernel_size, dilation):
+        """modules of a dilated convolution layer"""
+        return [torch.nn.Conv1d(in_channels, out_channels, kernel_size, dilation=dilation)]
 
     def forward(self, us):
-        u = self.norm(us).transpose(1, 2)
+        u = self.norm(self.precision.cast(us, 'net')).transpose(1, 2)
         y_cov = self.cnn(u).transpose(1, 2)
         y = self.lin(y_cov)
-        return y
+        return self.head(y)
+
+    def head(self, ys):
+        """map network outputs to the quantities used by the filter"""
+        ys = self.gain * self.precision.cast(ys, 'head')
+        return self.head_a * torch.pow(10, self.head_s * ys) + self.head_b * ys + self.head_c
+
+    def init_head(self):
+        """precompute the head constants in the head dtype"""
+        gain, a, s, b, c = self.head_constants()
+        dtype = self.precision['head']
+        self.gain = gain
+        # not saved with the weights, they only depend on the class and dtype
+        self.register_buffer('head_a', torch.tensor(a, dtype=dtype), persistent=False)
+        self.register_buffer('head_s', torch.tensor(s, dtype=dtype), persistent=False)
+        self.register_buffer('head_b', torch.tensor(b, dtype=dtype), persistent=False)
+        self.register_buffer('head_c', torch.tensor(c, dtype=dtype), persistent=False)
+
+    def head_constants(self):
+        """gain, a, s, b and c such that head(ys) = a * 10^(s * gain * ys) + b * gain * ys + c"""
+        zeros = [0.] * self.out_dim
+        return 1., zeros, zeros, [1.] * self.out_dim, zeros
+
+    def export_for_inference(self):
+        """copy of the network for inference, see InferenceNet"""
+        return InferenceNet(self)
+
+    def export_quantized(self, calibration_us, backend='x86'):
+        """int8 copy of the network for CPU inference.
+
+        Convolutions and linear layers of the inference network are quantized
+        after training, activation ranges being observed on the calibration
+        inputs (list of batch x N x in_dim tensors). Use backend 'x86' on
+        Intel/AMD CPUs and 'qnnpack' on ARM boards.
+        """
+        from torch.ao.quantization import QConfigMapping, get_default_qconfig
+        from torch.ao.quantization.quantize_fx import prepare_fx, convert_fx
+
+        torch.backends.quantized.engine = backend
+        qconfig = get_default_qconfig(backend)
+        # normalization and head stay in floating point
+        qconfig_mapping = QConfigMapping().set_module_name('cnn', qconfig)\
+            .set_module_name('lin', qconfig)
+        net = self.export_for_inference()
+        with warnings.catch_warnings(), torch.no_grad():
+            # torch.ao.quantization deprecation notices
+            warnings.simplefilter('ignore')
+            net = prepare_fx(net, qconfig_mapping, (calibration_us[0],))
+            for us in calibration_us:
+                net(us)
+            net = convert_fx(net)
+        net.p0 = self.p0
+        return net
 
     def norm(self, us):
         return (us - self.mean_u) / self.std_u
 
     def set_normalized_factors(self, mean_u, std_u):
-        self.mean_u = torch.nn.Parameter(torch.as_tensor(mean_u, dtype=torch.float32), requires_grad=False)
-        self.std_u = torch.nn.Parameter(torch.as_tensor(std_u, dtype=torch.float32), requires_grad=False)
+        dtype = self.mean_u.dtype
+        self.mean_u = torch.nn.Parameter(torch.as_tensor(mean_u, dtype=dtype), requires_grad=False)
+        self.std_u = torch.nn.Parameter(torch.as_tensor(std_u, dtype=dtype), requires_grad=False)
+
+    def set_precision(self, precision):
+        """run the network in the net dtype of the precision policy"""
+        self.precision = precision
+        self.to(precision['net'])
+        self.init_head()
 
 
 class GyroNet(BaseNet):
+    # gains of the IMU inputs, biases and measurement covariances for a
+    # zero network output
+    cali_rate0 = [1, 1, 1,
+                  1, 1, 1,
+                  0, 0, 0,
+                  0, 0, 0,
+                  2, 20]
+
     def __init__(self, in_dim, out_dim, c0, dropout, ks, ds, momentum,
                  gyro_std):
         super().__init__(in_dim, out_dim, c0, dropout, ks, ds, momentum)
@@ -77,23 +154,187 @@ class GyroNet(BaseNet):
 
         self.Id3 = torch.eye(3)
 
+    def head_constants(self):
+        # gains and covariances are in log10 scale, biases are additive
+        cali_rate0 = [float(c) for c in self.cali_rate0]
+        a = cali_rate0[:6] + [0.] * 6 + cali_rate0[12:14]
+        s = [0.01] * 6 + [0.] * 6 + [1.] * 2
+        b = [0.] * 6 + [1.] * 6 + [0.] * 2
+        c = [0.] * 6 + cali_rate0[6:12] + [0.] * 2
+        return 3., a, s, b, c
+
+
+class SeparableGyroNet(GyroNet):
+    """GyroNet with depthwise-separable dilated convolutions.
+
+    Each convolution is a per-channel dilated convolution followed by a 1x1
+    convolution mixing channels, which divides parameters and FLOPs by about
+    the kernel size. The receptive field and head are those of GyroNet.
+    """
+
+    def conv(self, in_channels, out_channels, kernel_size, dilation):
+        return [torch.nn.Conv1d(in_channels, in_channels, kernel_size, dilation=dilation,
+                                groups=in_channels),
+                torch.nn.Conv1d(in_channels, out_channels, 1)]
+
+
+class InferenceNet(torch.nn.Module):
+    """Inference copy of a BaseNet.
+
+    Batch normalizations are folded into the preceding convolutions, dropouts
+    are removed and the head is one vectorized expression with precomputed
+    constants. The module is compatible with TorchScript. Outputs equal those
+    of the net in eval mode up to rounding, as folded convolutions round
+    differently: max |diff| below 2e-6 of the largest output with a float32
+    network (about 2e-5 on the benchmark sequences), 1e-14 with float64.
+    """
+
+    def __init__(self, net):
+        super().__init__()
+        net = copy.deepcopy(net).eval()
+        modules = []
+        for module in net.cnn:
+            if isinstance(module, torch.nn.BatchNorm1d):
+                modules[-1] = torch.nn.utils.fusion.fuse_conv_bn_eval(modules[-1], module)
+            elif isinstance(module, torch.nn.Dropout):
+                continue
+            elif isinstance(module, torch.nn.ReplicationPad1d) and module.padding == (0, 0):
+                continue
+            else:
+                modules.append(module)
+        self.cnn = torch.nn.Sequential(*modules)
+        self.lin = net.lin
+        self.p0 = net.p0
+        self.register_buffer('mean_u', net.mean_u.detach().clone())
+        self.register_buffer('std_u', net.std_u.detach().clone())
+        self.gain = net.gain
+        self.register_buffer('head_a', net.head_a.clone())
+        self.register_buffer('head_s', net.head_s.clone())
+        self.register_buffer('head_b', net.head_b.clone())
+        self.register_buffer('head_c', net.head_c.clone())
+
     def forward(self, us):
-        ys_temp = super().forward(us.float())
+        u = ((us.to(self.mean_u.dtype) - self.mean_u) / self.std_u).transpose(1, 2)
+        y = self.lin(self.cnn(u).transpose(1, 2))
+        return self.head(y)
+
+    def head(self, ys):
+        ys = self.gain * ys.to(self.head_a.dtype)
+        return self.head_a * torch.pow(10, self.head_s * ys) + self.head_b * ys + self.head_c
+
+
+class StreamingNet:
+    """Sample by sample evaluation of a BaseNet for online use.
+
+    Each convolution keeps a ring buffer of its (k-1)*d+1 last inputs, so that
+    a new IMU sample gives one network output in O(layers). The history
+    before the first sample is the replication padding of the batch forward.
+    The net is set in eval mode, as batch normalization cannot use batch
+    statistics online. Outputs equal those of the batch forward up to
+    rounding, which accumulates differently: max |diff| of about 2e-5 with a
+    float32 network, 1e-14 with float64, see benchmark_KITTI.py streaming.
+    """
+
+    def __init__(self, net):
+        self.net = net.eval()
+        # convolution followed by its pointwise modules (batch norm, GELU, ...)
+        self.layers = []
+        for module in net.cnn:
+            if isinstance(module, torch.nn.Conv1d):
+                self.layers.append((module, []))
+            elif not isinstance(module, torch.nn.ReplicationPad1d):
+                self.layers[-1][1].append(module)
+        self.sizes = [(conv.kernel_size[0] - 1) * conv.dilation[0] + 1
+                      for conv, _ in self.layers]
+        # position of the kernel taps relative to the newest input
+        self.offsets = [torch.arange(-size + 1, 1, conv.dilation[0])
+                        for (conv, _), size in zip(self.layers, self.sizes)]
+        self.reset()
+
+    def reset(self):
+        """start a new sequence"""
+        self.buffers = None
+        self.n = 0
+
+    @staticmethod
+    def apply(conv, post, taps):
+        """convolution output at the newest position of kernel taps"""
+        x = torch.nn.functional.conv1d(taps, conv.weight, conv.bias, groups=conv.groups)
+        for module in post:
+            x = module(x)
+        return x[:, :, 0]
+
+    def init_buffers(self, x):
+        """fill histories with the activations of the first sample repeated"""
+        self.buffers = []
+        for (conv, post), size in zip(self.layers, self.sizes):
+            buffer = x.unsqueeze(2).repeat(1, 1, size)
+            self.buffers.append(buffer)
+            x = self.apply(conv, post, buffer[:, :, :conv.kernel_size[0]])
+
+    def step(self, u):
+        """network output (batch x out_dim) for a new IMU sample u (batch x in_dim)"""
+        net = self.net
+        x = net.norm(net.precision.cast(u, 'net'))
+        if self.buffers is None:
+            self.init_buffers(x)
+        for (conv, post), buffer, size, offsets in zip(self.layers, self.buffers,
+                                                        self.sizes, self.offsets):
+            buffer[:, :, self.n % size] = x
+            x = self.apply(conv, post, buffer[:, :, (self.n + offsets) % size])
+        self.n += 1
+        y = net.lin(x)
+        return net.head(y.unsqueeze(1))[:, 0]
+
+    def forward(self, us):
+        """output of a whole sequence (batch x N x in_dim), one sample at a time"""
+        return torch.stack([self.step(us[:, i]) for i in range(us.shape[1])], 1)
+
+
+class ChunkedStreamingNet:
+    """Chunk by chunk evaluation of a network in eval mode on a sequence read
+    in chunks. The net.p0 last inputs of the previous chunk are kept as
+    context, so that the outputs are those of the network on the whole
+    sequence, as with chunked_forward.
+    """
+
+    def __init__(self, net):
+        self.net = net.eval()
+        self.reset()
 
-        # ys = 3 * ys_temp.transpose(1, 2).double()
-        ys = 3 * ys_temp.double()
+    def reset(self):
+        """start a new sequence"""
+        self.context = None
 
-        cali_rate0 = torch.Tensor([1, 1, 1,
-                                   1, 1, 1,
-                                   0, 0, 0,
-                                   0, 0, 0,
-                                   2, 20]).double()
-        cali_rate0 = cali_rate0.unsqueeze(0)
+    def __call__(self, us):
+        """outputs of the next chunk (batch x n x in_dim) of the sequence"""
+        p0 = self.net.p0
+        if self.context is None:  # replication padding as the network
+            self.context = us[:, :1].expand(-1, p0, -1)
+        us = torch.cat((self.context, us), 1)
+        self.context = us[:, us.shape[1] - p0:]
+        return self.net(us)[:, p0:]
 
-        cali_rate = torch.zeros(ys.shape[0], ys.shape[1], cali_rate0.shape[1])
-        cali_rate[:, :, :6] = cali_rate0[:, :6] * (10 ** (0.01*ys[:, :, :6]))
-        cali_rate[:, :, 6:12] = cali_rate0[:, 6:12] + 1e-0 * ys[:, :, 6:12]
-        cali_rate[:, :, 12:14] = (cali_rate0[:, 12:14] * (10 ** ys[:, :, 12:14]))
 
+def chunked_forward(net, us, chunk_size=4096, batch_chunks=8):
+    """Overlap-save evaluation of a network in eval mode on long sequences.
 
-        return cali_rate
+    The sequence (batch x N x in_dim) is cut into chunks of chunk_size outputs,
+    each chunk being fed with the net.p0 previous inputs so that its outputs
+    are those of net(us). Chunks are evaluated batch_chunks at a time, which
+    bounds activation memory whatever the sequence length, and the batched
+    convolutions run on all the CPU threads.
+    """
+    p0 = net.p0
+    N = us.shape[1]
+    n_chunks = -(-N // chunk_size)
+    # replication padding at start as the network, at end up to whole chunks
+    us = torch.cat((us[:, :1].expand(-1, p0, -1), us,
+                    us[:, -1:].expand(-1, n_chunks * chunk_size - N, -1)), 1)
+    chunks = us.unfold(1, chunk_size + p0, chunk_size)  # batch x chunks x in_dim x (p0 + chunk)
+    ys = []
+    for i in range(0, n_chunks, batch_chunks):
+        batch = chunks[:, i:i + batch_chunks]
+        y = net(batch.transpose(2, 3).flatten(0, 1))[:, p0:]
+        ys.append(y.reshape(batch.shape[0], -1, y.shape[-1]))
+    return torch.cat(ys, 1)[:, :N]
@@ -0,0 +1,71 @@
+import torch
+
+
+class PrecisionPolicy:
+    """Floating point precision of each processing stage.
+
+    Stages are the network (``net``), the calibration head of GyroNet
+    (``head``), the loss (``loss``), the IEKF (``filter``) and the SO(3) maps
+    applied to ground truth and filter outputs (``lie``). A tensor is cast once
+    when it enters a stage and keeps this dtype inside the stage.
+    """
+    STAGES = ('net', 'head', 'loss', 'filter', 'lie')
+    DTYPES = {
+        'float16': torch.float16,
+        'bfloat16': torch.bfloat16,
+        'float32': torch.float32,
+        'float64': torch.float64,
+    }
+    POLICIES = {
+        # network in single precision, everything else in double precision
+        'mixed': {'net': 'float32', 'head': 'float64', 'loss': 'float64',
+                  'filter': 'float64', 'lie': 'float64'},
+        'float64': {stage: 'float64' for stage in STAGES},
+        'float32': {stage: 'float32' for stage in STAGES},
+    }
+
+    def __init__(self, **stages):
+        unknown = set(stages) - set(self.STAGES)
+        if unknown:
+            raise ValueError("unknown precision stages: {}".format(sorted(unknown)))
+        dtypes = {**self.POLICIES['mixed'], **stages}
+        self.dtypes = {stage: self.to_dtype(dtype) for stage, dtype in dtypes.items()}
+
+    @classmethod
+    def from_params(cls, params=None):
+        """Build a policy from ``train_params['precision']``.
+
+        ``params`` is either the name of a policy in ``POLICIES`` or a dict of
+        stage dtypes, optionally starting from the policy given by ``'policy'``.
+        """
+        if params is None:
+            return cls()
+        if isinstance(params, cls):
+            return params
+        if isinstance(params, str):
+            params = {'policy': params}
+        params = dict(params)
+        policy = params.pop('policy', 'mixed')
+        if policy not in cls.POLICIES:
+            raise ValueError("unknown precision policy: {}".format(policy))
+        return cls(**{**cls.POLICIES[policy], **params})
+
+    @classmethod
+    def to_dtype(cls, dtype):
+        if isinstance(dtype, torch.dtype):
+            return dtype
+        return cls.DTYPES[dtype]
+
+    def __getitem__(self, stage):
+        return self.dtypes[stage]
+
+    def cast(self, x, stage):
+        """cast a tensor entering a stage, no copy if it is already in the stage dtype"""
+        return x.to(self.dtypes[stage])
+
+    def to_dict(self):
+        return {stage: str(dtype).replace('torch.', '') for stage, dtype in self.dtypes.items()}
+
+    def __repr__(self):
+        return "PrecisionPolicy({})".format(", ".join(
+            "{}={}".format(stage, dtype) for stage, dtype in self.to_dict().items()))
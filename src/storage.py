@@ -0,0 +1,343 @@
+import os
+import glob
+import json
+import zlib
+import struct
+import numpy as np
+import torch
+from src.utils import pdump, pload
+
+
+class PickleStore:
+    """Preprocessed sequences as one pickled dict per sequence"""
+    extension = '.p'
+    reserved = ('nf',)  # normalization factors
+    mapped = False  # whether loaded fields are memory-mapped files
+
+    def __init__(self, predata_dir):
+        self.predata_dir = predata_dir
+
+    def path(self, name):
+        return os.path.join(self.predata_dir, name + self.extension)
+
+    def names(self):
+        """names of the stored sequences"""
+        names = [os.path.basename(path)[:-len(self.extension)]
+                 for path in glob.glob(os.path.join(self.predata_dir, '*' + self.extension))]
+        return sorted(name for name in names if name not in self.reserved)
+
+    def exists(self, name):
+        return os.path.exists(self.path(name))
+
+    def stamp(self, name):
+        """modification time and size of the file written last for a
+        sequence, which change when it is saved again"""
+        stat = os.stat(self.path(name))
+        return stat.st_mtime_ns, stat.st_size
+
+    def load(self, name):
+        return pload(self.path(name))
+
+    def save(self, name, mondict):
+        pdump(mondict, self.path(name))
+
+    def chunks(self, name, chunk_size, length_field='xs'):
+        """yield (n0, fields of the rows n0 to n0 + chunk_size) of a sequence
+        of the length of length_field"""
+        mondict = self.load(name)
+        N_max = mondict[length_field].shape[0]
+        for n0 in range(0, N_max, chunk_size):
+            nend = min(n0 + chunk_size, N_max)
+            yield n0, {key: x[n0: nend] if isinstance(x, torch.Tensor) else x
+                       for key, x in mondict.items()}
+
+
+class ColumnarStore(PickleStore):
+    """Preprocessed sequences as one directory per sequence, holding a .npy
+    file per field and a JSON manifest of field shapes and dtypes and of the
+    other values (name, t0).
+
+    Fields are memory-mapped copy-on-write and wrapped without copy by
+    torch.from_numpy, so that a window only reads its own pages from disk and
+    writes never reach the files.
+    """
+    extension = '.columns'
+    manifest = 'manifest.json'
+    version = 1
+    mapped = True
+
+    def load(self, name):
+        path = self.path(name)
+        with open(os.path.join(path, self.manifest)) as f:
+            manifest = json.load(f)
+        mondict = dict(manifest['values'])
+        for field, info in manifest['fields'].items():
+            x = np.load(os.path.join(path, info['file']), mmap_mode='c')
+            mondict[field] = torch.from_numpy(x)
+        return mondict
+
+    def save(self, name, mondict):
+        path = self.path(name)
+        os.makedirs(path, exist_ok=True)
+        manifest = {'version': self.version, 'fields': {}, 'values': {}}
+        for field, x in mondict.items():
+            if isinstance(x, (torch.Tensor, np.ndarray)):
+                x = np.ascontiguousarray(torch.as_tensor(x).numpy())
+                np.save(os.path.join(path, field + '.npy'), x)
+                manifest['fields'][field] = {'file': field + '.npy', 'shape': list(x.shape),
+                                             'dtype': str(x.dtype)}
+            else:
+                manifest['values'][field] = x.item() if hasattr(x, 'item') else x
+        # the manifest is written last, a sequence without it is incomplete
+        with open(os.path.join(path, self.manifest), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def exists(self, name):
+        return os.path.exists(os.path.join(self.path(name), self.manifest))
+
+    def stamp(self, name):
+        stat = os.stat(os.path.join(self.path(name), self.manifest))
+        return stat.st_mtime_ns, stat.st_size
+
+    def writer(self, name):
+        """ColumnWriter appending rows to a new sequence"""
+        return ColumnWriter(self, name)
+
+
+class ColumnWriter:
+    """Sequence of a ColumnarStore written chunk by chunk, e.g. results of
+    recordings longer than memory.
+
+    Rows are appended to the .npy file of each field, whose header keeps room
+    for the final shape, written by close along with the manifest.
+    """
+    header_size = 128
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.path = store.path(name)
+        os.makedirs(self.path, exist_ok=True)
+        self.files = {}
+        self.fields = {}
+
+    def write_header(self, field):
+        info = self.fields[field]
+        header = repr({'descr': np.lib.format.dtype_to_descr(np.dtype(info['dtype'])),
+                       'fortran_order': False, 'shape': tuple(info['shape'])})
+        header = header.ljust(self.header_size - 11) + '\n'
+        f = self.files[field]
+        f.seek(0)
+        f.write(np.lib.format.magic(1, 0) + struct.pack('<H', len(header)) +
+                header.encode('latin1'))
+        f.seek(0, os.SEEK_END)
+
+    def append(self, **fields):
+        """append rows (first dimension) to fields"""
+        for field, x in fields.items():
+            x = np.ascontiguousarray(torch.as_tensor(x).detach().cpu().numpy())
+            if field not in self.files:
+                self.files[field] = open(os.path.join(self.path, field + '.npy'), 'wb')
+                self.fields[field] = {'file': field + '.npy', 'shape': [0, *x.shape[1:]],
+                                      'dtype': str(x.dtype)}
+                self.write_header(field)
+            self.files[field].write(x.tobytes())
+            self.fields[field]['shape'][0] += x.shape[0]
+
+    def close(self, **values):
+        """write final shapes and the manifest with the other values"""
+        for field, f in self.files.items():
+            self.write_header(field)
+            f.close()
+        manifest = {'version': self.store.version, 'fields': self.fields,
+                    'values': {field: x.item() if hasattr(x, 'item') else x
+                               for field, x in values.items()}}
+        with open(os.path.join(self.path, self.store.manifest), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+
+class CompressedStore(ColumnarStore):
+    """Preprocessed sequences as one directory per sequence, holding a file
+    per field of zlib compressed chunks of chunk_rows rows and a JSON
+    manifest of their offsets.
+
+    This is an archive format, smaller on disk but slower to load than the
+    pickle and columnar stores: the noisy low bytes of float64 samples leave
+    little to compress, and decompression costs more than the disk reads it
+    saves. Fields are stored losslessly, unless dtypes gives the dtype a
+    field is stored in, e.g. {'us': 'float32'}; they are loaded back in their
+    original dtype. Bytes are shuffled before compression, which groups the
+    exponents of floats. The rotations derived from ang_gt and xs are not
+    stored but recomputed at loading, see BaseDataset.add_rotations.
+    load_rows decompresses only the chunks of the rows it reads, and writer
+    compresses them as rows are appended.
+    """
+    extension = '.zcolumns'
+    derived = ('Rot_gt', 'Rot_xs')
+    mapped = False
+
+    def __init__(self, predata_dir, dtypes=None, chunk_rows=4096, level=6):
+        super().__init__(predata_dir)
+        self.dtypes = {} if dtypes is None else dtypes
+        self.chunk_rows = chunk_rows
+        self.level = level  # zlib compression level
+
+    @staticmethod
+    def shuffle(x):
+        return np.ascontiguousarray(x.view(np.uint8).reshape(-1, x.itemsize).T).tobytes()
+
+    @staticmethod
+    def unshuffle(data, dtype, shape):
+        dtype = np.dtype(dtype)
+        x = np.frombuffer(data, np.uint8).reshape(dtype.itemsize, -1).T
+        return np.ascontiguousarray(x).view(dtype).reshape(shape)
+
+    def save(self, name, mondict):
+        path = self.path(name)
+        os.makedirs(path, exist_ok=True)
+        manifest = {'version': self.version, 'fields': {}, 'values': {}}
+        for field, x in mondict.items():
+            if field in self.derived:
+                continue
+            if isinstance(x, (torch.Tensor, np.ndarray)):
+                x = np.ascontiguousarray(torch.as_tensor(x).numpy())
+                stored = x.astype(self.dtypes.get(field, x.dtype))
+                offsets = [0]
+                with open(os.path.join(path, field + '.z'), 'wb') as f:
+                    for n0 in range(0, max(len(x), 1), self.chunk_rows):
+                        f.write(zlib.compress(self.shuffle(stored[n0: n0 + self.chunk_rows]),
+                                              self.level))
+                        offsets.append(f.tell())
+                manifest['fields'][field] = {'file': field + '.z', 'shape': list(x.shape),
+                    'dtype': str(x.dtype), 'stored_dtype': str(stored.dtype),
+                    'chunk_rows': self.chunk_rows, 'offsets': offsets}
+            else:
+                manifest['values'][field] = x.item() if hasattr(x, 'item') else x
+        # the manifest is written last, a sequence without it is incomplete
+        with open(os.path.join(path, self.manifest), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+    def load_manifest(self, name):
+        with open(os.path.join(self.path(name), self.manifest)) as f:
+            return json.load(f)
+
+    def read_field(self, name, info, start, stop):
+        """rows start to stop of a field, decompressing only their chunks"""
+        chunk_rows = info['chunk_rows']
+        stop = min(stop, info['shape'][0])
+        start = min(start, stop)
+        first, last = start // chunk_rows, -(-stop // chunk_rows)
+        offsets = info['offsets']
+        xs = []
+        with open(os.path.join(self.path(name), info['file']), 'rb') as f:
+            f.seek(offsets[first])
+            for k in range(first, last):
+                data = zlib.decompress(f.read(offsets[k + 1] - offsets[k]))
+                n_rows = min(chunk_rows, info['shape'][0] - k * chunk_rows)
+                xs.append(self.unshuffle(data, info['stored_dtype'],
+                                         [n_rows] + info['shape'][1:]))
+        shape = [0] + info['shape'][1:]
+        x = np.concatenate(xs) if xs else np.zeros(shape, info['stored_dtype'])
+        x = x[start - first * chunk_rows: stop - first * chunk_rows]
+        return torch.from_numpy(x.astype(info['dtype']))
+
+    def load_rows(self, name, start, stop):
+        """rows start to stop of the fields of a sequence"""
+        manifest = self.load_manifest(name)
+        mondict = dict(manifest['values'])
+        for field, info in manifest['fields'].items():
+            mondict[field] = self.read_field(name, info, start, stop)
+        return mondict
+
+    def load(self, name):
+        return self.load_rows(name, 0, float('inf'))
+
+    def chunks(self, name, chunk_size, length_field='xs'):
+        N_max = self.load_manifest(name)['fields'][length_field]['shape'][0]
+        for n0 in range(0, N_max, chunk_size):
+            yield n0, self.load_rows(name, n0, min(n0 + chunk_size, N_max))
+
+    def writer(self, name):
+        """CompressedWriter appending rows to a new sequence"""
+        return CompressedWriter(self, name)
+
+
+class CompressedWriter:
+    """Sequence of a CompressedStore written chunk by chunk.
+
+    Rows of each field are buffered until they fill a chunk of chunk_rows
+    rows, which is compressed and appended to its file. close compresses the
+    last chunks and writes the manifest of their offsets.
+    """
+
+    def __init__(self, store, name):
+        self.store = store
+        self.name = name
+        self.path = store.path(name)
+        os.makedirs(self.path, exist_ok=True)
+        self.files = {}
+        self.fields = {}
+        self.buffers = {}
+
+    def write_chunk(self, field, x):
+        info = self.fields[field]
+        f = self.files[field]
+        f.write(zlib.compress(self.store.shuffle(x.astype(info['stored_dtype'])),
+                              self.store.level))
+        info['offsets'].append(f.tell())
+
+    def append(self, **fields):
+        """append rows (first dimension) to fields"""
+        chunk_rows = self.store.chunk_rows
+        for field, x in fields.items():
+            x = np.ascontiguousarray(torch.as_tensor(x).detach().cpu().numpy())
+            if field not in self.files:
+                self.files[field] = open(os.path.join(self.path, field + '.z'), 'wb')
+                self.fields[field] = {'file': field + '.z', 'shape': [0, *x.shape[1:]],
+                    'dtype': str(x.dtype),
+                    'stored_dtype': str(np.dtype(self.store.dtypes.get(field, x.dtype))),
+                    'chunk_rows': chunk_rows, 'offsets': [0]}
+                self.buffers[field] = x[:0]
+            rows = np.concatenate((self.buffers[field], x))
+            n_rows = len(rows) - len(rows) % chunk_rows
+            for n0 in range(0, n_rows, chunk_rows):
+                self.write_chunk(field, rows[n0: n0 + chunk_rows])
+            self.buffers[field] = rows[n_rows:]
+            self.fields[field]['shape'][0] += x.shape[0]
+
+    def close(self, **values):
+        """compress the last rows and write the manifest with the other values"""
+        for field, f in self.files.items():
+            # an empty field has one empty chunk, as written by save
+            if len(self.buffers[field]) or self.fields[field]['shape'][0] == 0:
+                self.write_chunk(field, self.buffers[field])
+            f.close()
+        manifest = {'version': self.store.version, 'fields': self.fields,
+                    'values': {field: x.item() if hasattr(x, 'item') else x
+                               for field, x in values.items()}}
+        with open(os.path.join(self.path, self.store.manifest), 'w') as f:
+            json.dump(manifest, f, indent=2)
+
+
+STORES = {
+    'pickle': PickleStore,
+    'columnar': ColumnarStore,
+    'compressed': CompressedStore,
+}
+
+
+def make_store(storage, predata_dir, **options):
+    """store of preprocessed sequences from its name in STORES, options
+    being given to its constructor"""
+    if storage not in STORES:
+        raise ValueError("unknown storage: {}".format(storage))
+    return STORES[storage](predata_dir, **options)
+
+
+def migrate(source, target, names=None):
+    """copy sequences between stores, e.g. from pickles to columns"""
+    names = source.names() if names is None else names
+    for name in names:
+        target.save(name, source.load(name))
+        print("migrated", name)
+    return names
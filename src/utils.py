@@ -1,7 +1,28 @@
 import torch
 import os
 import pickle
-import yaml
+import importlib
+
+
+class LazyModule:
+    """Module imported on first attribute access, setup(module) being called
+    once after import. Keeps plotting, logging and file format dependencies
+    out of the inference imports."""
+
+    def __init__(self, name, setup=None):
+        self._name = name
+        self._setup = setup
+        self._module = None
+
+    def __getattr__(self, attr):
+        if self._module is None:
+            self._module = importlib.import_module(self._name)
+            if self._setup is not None:
+                self._setup(self._module)
+        return getattr(self._module, attr)
+
+
+yaml = LazyModule('yaml')
 
 
 def pload(*f_names):
@@ -46,6 +46,9 @@ class IEKF:
 
         self.initprocesscov_net = InitProcessCovNet()
 
+        self.dtype = torch.float64
+        """dtype of the filter state and covariance"""
+
         self.g = torch.Tensor([0, 0, -9.80665])
         """gravity vector"""
         self.P_dim = 21
@@ -90,6 +93,18 @@ class IEKF:
                             )
         self.cov0_measurement = torch.Tensor([self.cov_lat, self.cov_up])
 
+    def set_precision(self, precision):
+        """run the filter in the filter dtype of the precision policy"""
+        self.dtype = precision['filter']
+
+    @staticmethod
+    def correct_imu(ys, us):
+        """IMU inputs corrected by the gains and biases of the network outputs,
+        and measurement covariances"""
+        us_fix = ys[:, :, :6] * us[:, :, :6] - ys[:, :, 6:12]
+        measurements_covs = ys[:, :, 12:14]
+        return us_fix, measurements_covs
+
     def set_Q(self):
         """
         Update the process noise covariance
@@ -108,7 +123,7 @@ class IEKF:
 
         beta = self.initprocesscov_net.init_processcov()
         beta = beta
-        self.Q = torch.zeros(self.Q.shape[0], self.Q.shape[0]).double()
+        self.Q = torch.zeros(self.Q.shape[0], self.Q.shape[0], dtype=self.dtype)
 
         self.Q = self.Q
 
@@ -123,17 +138,15 @@ class IEKF:
         self.Q[15:18, 15:18] = self.cov_t_c_i*beta[5]*self.Id3
 
     def run(self, t, u, measurements_covs, v_mes, p_mes, N, ang0):
-
-
-        dt = t[:,1:] - t[:,:-1] # (s)
+        # inputs enter the filter precision once, time is differenced before
+        dt = (t[:,1:] - t[:,:-1]).to(self.dtype) # (s)
+        u = u.to(self.dtype)
+        measurements_covs = measurements_covs.to(self.dtype)
+        v_mes = v_mes.to(self.dtype)
+        ang0 = ang0.to(self.dtype)
         Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i, P = self.init_run(dt, u, p_mes, v_mes,
                                                                      N, ang0)
-        Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i, P \
-            = Rot.double(), v.double(), p.double(), b_omega.double(), b_acc.double(), \
-              Rot_c_i.double(), t_c_i.double(), P.double()
 
-
-        dt = dt.double()
         for i in range(1, N):
 
             Rot_i, v_i, p_i, b_omega_i, b_acc_i, Rot_c_i_i, t_c_i_i, P_i = \
@@ -147,19 +160,64 @@ class IEKF:
 
         return Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i
 
+    def init_state(self, t0, v0, ang0):
+        """State of the filter at the first sample of sequences, of time t0
+        (batch), velocity v0 and roll, pitch and yaw ang0 (batch x 3), as in
+        run. A state is the estimate and covariance at its last sample"""
+        N0 = ang0.shape[0]
+        ang0 = ang0.to(self.dtype)
+        state = {
+            'Rot': SO3.from_rpy(ang0[:, 0], ang0[:, 1], ang0[:, 2]),
+            'v': v0.to(self.dtype),
+            'p': ang0.new_zeros(N0, 3),
+            'b_omega': ang0.new_zeros(N0, 3),
+            'b_acc': ang0.new_zeros(N0, 3),
+            'Rot_c_i': self.Id3.to(self.dtype).expand(N0, 3, 3).clone(),
+            't_c_i': ang0.new_zeros(N0, 3),
+            'P': self.init_covariance(N0),
+            't': t0,
+        }
+        return state
+
+    def run_chunk(self, state, t, u, measurements_covs):
+        """Filter the next samples (batch x n) of sequences from a state.
+        Returns Rot, v, p, b_omega, b_acc, Rot_c_i and t_c_i of these samples,
+        and the state at the last one, so that running chunk after chunk
+        gives the estimates of run with the memory of a chunk"""
+        dt = (t - torch.cat((state['t'].unsqueeze(1), t[:, :-1]), 1)).to(self.dtype)
+        u = u.to(self.dtype)
+        measurements_covs = measurements_covs.to(self.dtype)
+        N0, n = u.shape[:2]
+        Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i = self.init_saved_state(dt, n, N0, None)
+        Rot_i, v_i, p_i, b_omega_i, b_acc_i, Rot_c_i_i, t_c_i_i, P = \
+            [state[key] for key in ('Rot', 'v', 'p', 'b_omega', 'b_acc', 'Rot_c_i', 't_c_i',
+                                    'P')]
+        for i in range(n):
+            Rot_i, v_i, p_i, b_omega_i, b_acc_i, Rot_c_i_i, t_c_i_i, P = \
+                self.propagate(Rot_i, v_i, p_i, b_omega_i, b_acc_i, Rot_c_i_i, t_c_i_i, P,
+                               u[:, i], dt[:, i])
+            Rot_i, v_i, p_i, b_omega_i, b_acc_i, Rot_c_i_i, t_c_i_i, P = \
+                self.update(Rot_i, v_i, p_i, b_omega_i, b_acc_i, Rot_c_i_i, t_c_i_i, P,
+                            u[:, i], i, measurements_covs[:, i, :])
+            Rot[:, i], v[:, i], p[:, i], b_omega[:, i], b_acc[:, i], Rot_c_i[:, i], \
+                t_c_i[:, i] = Rot_i, v_i, p_i, b_omega_i, b_acc_i, Rot_c_i_i, t_c_i_i
+        state = {'Rot': Rot_i, 'v': v_i, 'p': p_i, 'b_omega': b_omega_i, 'b_acc': b_acc_i,
+                 'Rot_c_i': Rot_c_i_i, 't_c_i': t_c_i_i, 'P': P, 't': t[:, -1]}
+        return (Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i), state
+
     def init_run(self, dt, u, p_mes, v_mes, N, ang0):
         N0 = u.size(0)
 
         Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i = \
             self.init_saved_state(dt, N, N0, ang0)
         Rot[:, 0] = SO3.from_rpy(ang0[:, 0], ang0[:, 1], ang0[:, 2])
-        v[:, 0, :] = v_mes[:, 0, :].double()
+        v[:, 0, :] = v_mes[:, 0, :]
         P = self.init_covariance(N0)
         return Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i, P
 
     def init_covariance(self, N0):
         beta = self.initprocesscov_net.init_cov()
-        P = torch.zeros(N0, self.P_dim, self.P_dim).double()
+        P = torch.zeros(N0, self.P_dim, self.P_dim, dtype=self.dtype)
         P[:, :2, :2] = self.cov_Rot0*beta[0]*self.Id2  # no yaw error
         P[:, 3:5, 3:5] = self.cov_v0*beta[1]*self.Id2
         P[:, 9:12, 9:12] = self.cov_b_omega0*beta[2]*self.Id3
@@ -169,37 +227,37 @@ class IEKF:
         return P
 
     def init_saved_state(self, dt, N, N0, ang0):
-        Rot = dt.new_zeros(N0, N, 3, 3).double()
-        v = dt.new_zeros(N0, N, 3).double()
-        p = dt.new_zeros(N0, N, 3).double()
-        b_omega = dt.new_zeros(N0, N, 3).double()
-        b_acc = dt.new_zeros(N0, N, 3).double()
-        Rot_c_i = dt.new_zeros(N0, N, 3, 3).double()
-        t_c_i = dt.new_zeros(N0, N, 3).double()
+        Rot = dt.new_zeros(N0, N, 3, 3)
+        v = dt.new_zeros(N0, N, 3)
+        p = dt.new_zeros(N0, N, 3)
+        b_omega = dt.new_zeros(N0, N, 3)
+        b_acc = dt.new_zeros(N0, N, 3)
+        Rot_c_i = dt.new_zeros(N0, N, 3, 3)
+        t_c_i = dt.new_zeros(N0, N, 3)
         Rot_c_i[:, 0] = self.Id3
         return Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i
 
     def propagate(self, Rot_prev, v_prev, p_prev, b_omega_prev, b_acc_prev, Rot_c_i_prev, t_c_i_prev,
                   P_prev, u, dt):
-        Rot_prev = Rot_prev.clone().double()
-        dt = dt.clone().double()
+        Rot_prev = Rot_prev.clone()
+        dt = dt.clone()
         acc_b = u[:, 3:6].clone() - b_acc_prev.clone()
         # acc = Rot_prev.mv(acc_b) + self.g
-        acc = (bmv(Rot_prev, acc_b) + self.g).double()
-        v = v_prev.clone() + torch.einsum('ij, i -> ij', acc, dt).double()
+        acc = bmv(Rot_prev, acc_b) + self.g.to(Rot_prev.dtype)
+        v = v_prev.clone() + torch.einsum('ij, i -> ij', acc, dt)
 
         p = p_prev.clone() \
             + torch.einsum('ij, i -> ij', v_prev.clone(), dt) \
-            + 1 / 2 * torch.einsum('ij, i -> ij', acc, dt ** 2).double()
+            + 1 / 2 * torch.einsum('ij, i -> ij', acc, dt ** 2)
 
-        omega = torch.einsum('ij, i -> ij', (u[:, :3].clone() - b_omega_prev.clone()), dt).double()
-        Omega = SO3.exp(omega).double()
-        Rot = Rot_prev.bmm(Omega).double()
+        omega = torch.einsum('ij, i -> ij', (u[:, :3].clone() - b_omega_prev.clone()), dt)
+        Omega = SO3.exp(omega)
+        Rot = Rot_prev.bmm(Omega)
 
-        b_omega = b_omega_prev.clone().double()
-        b_acc = b_acc_prev.clone().double()
-        Rot_c_i = Rot_c_i_prev.clone().double()
-        t_c_i = t_c_i_prev.clone().double()
+        b_omega = b_omega_prev.clone()
+        b_acc = b_acc_prev.clone()
+        Rot_c_i = Rot_c_i_prev.clone()
+        t_c_i = t_c_i_prev.clone()
 
         P = self.propagate_cov(P_prev, Rot_prev, v_prev, p_prev, b_omega_prev, b_acc_prev,
                                u, dt)
@@ -208,9 +266,9 @@ class IEKF:
     def propagate_cov(self, P, Rot_prev, v_prev, p_prev, b_omega_prev, b_acc_prev, u,
                       dt):
         N0 = u.size(0)
-        F = P.new_zeros(N0, self.P_dim, self.P_dim).double()
-        G = P.new_zeros(N0, self.P_dim, self.Q.shape[0]).double()
-        Q = self.Q.clone().double()
+        F = P.new_zeros(N0, self.P_dim, self.P_dim)
+        G = P.new_zeros(N0, self.P_dim, self.Q.shape[0])
+        Q = self.Q.to(P.dtype)
         F[:, 3:6, :3] = self.skew(self.g)
         F[:, 6:9, 3:6] = self.Id3
         G[:, 3:6, 3:6] = Rot_prev
@@ -232,7 +290,7 @@ class IEKF:
         G = torch.einsum('bij, b -> bij', G, dt)
         F_square = F.bmm(F)
         F_cube = F_square.bmm(F)
-        Phi = self.IdP + F + 1 / 2 * F_square + 1 / 6 * F_cube
+        Phi = self.IdP.to(P.dtype) + F + 1 / 2 * F_square + 1 / 6 * F_cube
         mm_GQ = torch.einsum('bij, jk -> bik', G, Q)
         P_GQGT = P + bmmt(mm_GQ, G)
         P_new = bmmt(Phi.bmm(P_GQGT), Phi)
@@ -240,20 +298,20 @@ class IEKF:
 
     def update(self, Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i, P, u, i, measurement_cov):
         # orientation of body frame
-        Rot_body = Rot.bmm(Rot_c_i).double()
+        Rot_body = Rot.bmm(Rot_c_i)
         # velocity in imu frame
-        v_imu = bmtv(Rot, v).double()
-        omega = (u[:, :3] - b_omega).double()
+        v_imu = bmtv(Rot, v)
+        omega = u[:, :3] - b_omega
         # velocity in body frame
-        v_body = bmtv(Rot_c_i, v_imu).double() + bmv(self.bskew(t_c_i), omega).double()
+        v_body = bmtv(Rot_c_i, v_imu) + bmv(self.bskew(t_c_i), omega)
         # v_body = Rot_c_i.t().mv(v_imu) + self.bskew(t_c_i).mv(omega)
-        Omega = self.bskew(omega).double()
+        Omega = self.bskew(omega)
         # Jacobian in car frame
-        H_v_imu = bmtm(Rot_c_i, self.bskew(v_imu)).double()
-        H_t_c_i = self.bskew(t_c_i).double()
+        H_v_imu = bmtm(Rot_c_i, self.bskew(v_imu))
+        H_t_c_i = self.bskew(t_c_i)
 
         N0 = u.shape[0]
-        H = P.new_zeros(N0, 2, self.P_dim).double()
+        H = P.new_zeros(N0, 2, self.P_dim)
         H[:, :, 3:6] = Rot_body.transpose(1, 2)[:, 1:]
         H[:, :, 15:18] = H_v_imu[:, 1:]
         H[:, :, 9:12] = H_t_c_i[:, 1:]
@@ -267,33 +325,33 @@ class IEKF:
 
     @staticmethod
     def state_and_cov_update(Rot, v, p, b_omega, b_acc, Rot_c_i, t_c_i, P, H, r, R):
-        H_t = H.transpose(1, 2).double()
-        S = (H.bmm(P).bmm(H_t) + R).double()
+        H_t = H.transpose(1, 2)
+        S = H.bmm(P).bmm(H_t) + R
 
-        Kt = torch.linalg.solve(S, P.bmm(H_t).transpose(1, 2)).double()
-        K = Kt.transpose(1, 2).double()
-        dx = bmv(K, r).double()
+        Kt = torch.linalg.solve(S, P.bmm(H_t).transpose(1, 2))
+        K = Kt.transpose(1, 2)
+        dx = bmv(K, r)
 
-        dR = torch.zeros(v.shape[0], 3, 3).double()
-        dxi = torch.zeros(v.shape[0], 3, 2).double()
+        dR = v.new_zeros(v.shape[0], 3, 3)
+        dxi = v.new_zeros(v.shape[0], 3, 2)
         for i in range(0, v.shape[0]):
             dR[i], dxi[i] = IEKF.sen3exp(dx[i, :9])
-        dv = dxi[:, :, 0].double()
-        dp = dxi[:, :, 1].double()
-        Rot_up = dR.bmm(Rot).double()
-        v_up = (bmv(dR, v) + dv).double()
-        p_up = (bmv(dR, p) + dp).double()
+        dv = dxi[:, :, 0]
+        dp = dxi[:, :, 1]
+        Rot_up = dR.bmm(Rot)
+        v_up = bmv(dR, v) + dv
+        p_up = bmv(dR, p) + dp
 
         b_omega_up = b_omega + dx[:, 9:12]
         b_acc_up = b_acc + dx[:, 12:15]
 
-        dR = SO3.exp(dx[:, 15:18]).double()
-        Rot_c_i_up = dR.bmm(Rot_c_i).double()
+        dR = SO3.exp(dx[:, 15:18])
+        Rot_c_i_up = dR.bmm(Rot_c_i)
         t_c_i_up = t_c_i + dx[:, 18:21]
 
-        I_KH = IEKF.IdP.double() - K.bmm(H).double()
-        P_upprev = I_KH.bmm(P).bmm(I_KH.transpose(1, 2)) + K.bmm(R).bmm(Kt).double()
-        P_up = (P_upprev + P_upprev.transpose(1, 2)).double() / 2
+        I_KH = IEKF.IdP.to(P.dtype) - K.bmm(H)
+        P_upprev = I_KH.bmm(P).bmm(I_KH.transpose(1, 2)) + K.bmm(R).bmm(Kt)
+        P_up = (P_upprev + P_upprev.transpose(1, 2)) / 2
         return Rot_up, v_up, p_up, b_omega_up, b_acc_up, Rot_c_i_up, t_c_i_up, P_up
 
     @staticmethod
@@ -305,44 +363,32 @@ class IEKF:
 
     @staticmethod
     def bskew(bx):
-        X = torch.zeros(bx.shape[0], 3, 3).double()
-        for i in range(0, bx.shape[0]):
-            x = bx[i]
-            X[i] = torch.Tensor([[0, -x[2], x[1]],
-                              [x[2], 0, -x[0]],
-                              [-x[1], x[0], 0]])
-        return X
+        # skew matrices are built from values, without gradient, in the dtype of bx
+        return SO3.wedge(bx.detach())
 
     @staticmethod
     def bdiag(bx):
-        X = torch.zeros(bx.shape[0], bx.shape[1], bx.shape[1]).double()
-        for i in range(0, bx.shape[0]):
-            x = bx[i].double()
-            X[i] = torch.diag(x).double()
-        return X
+        return torch.diag_embed(bx)
     @staticmethod
     def sen3exp(xi):
         phi = xi[:3]
         angle = torch.norm(phi)
 
         # Near |phi|==0, use first order Taylor expansion
+        Id3 = IEKF.Id3.to(xi.dtype)
         if isclose(angle, 0.):
-            skew_phi = torch.Tensor([[0, -phi[2], phi[1]],
-                          [phi[2], 0, -phi[0]],
-                          [-phi[1], phi[0], 0]]).double()
-            J = IEKF.Id3 + 0.5 * skew_phi
-            Rot = IEKF.Id3 + skew_phi
+            skew_phi = IEKF.bskew(phi.unsqueeze(0))[0]
+            J = Id3 + 0.5 * skew_phi
+            Rot = Id3 + skew_phi
         else:
             axis = phi / angle
-            skew_axis = torch.Tensor([[0, -axis[2], axis[1]],
-                              [axis[2], 0, -axis[0]],
-                              [-axis[1], axis[0], 0]]).double()
+            skew_axis = IEKF.bskew(axis.unsqueeze(0))[0]
             s = torch.sin(angle)
             c = torch.cos(angle)
 
-            J = (s / angle) * IEKF.Id3 + (1 - s / angle) * IEKF.outer(axis, axis)\
+            J = (s / angle) * Id3 + (1 - s / angle) * IEKF.outer(axis, axis)\
                    + ((1 - c) / angle) * skew_axis
-            Rot = c * IEKF.Id3 + (1 - c) * IEKF.outer(axis, axis) \
+            Rot = c * Id3 + (1 - c) * IEKF.outer(axis, axis) \
                  + s * skew_axis
 
         x = J.mm(xi[3:].view(-1, 3).t())
@@ -351,23 +397,20 @@ class IEKF:
     @staticmethod
     def so3exp(phi):
         angle = phi.norm()
+        Id3 = IEKF.Id3.to(phi.dtype)
 
         # Near phi==0, use first order Taylor expansion
         if isclose(angle, 0.):
-            skew_phi = torch.Tensor([[0, -phi[2], phi[1]],
-                          [phi[2], 0, -phi[0]],
-                          [-phi[1], phi[0], 0]])
-            Xi = IEKF.Id3 + skew_phi
+            skew_phi = IEKF.bskew(phi.unsqueeze(0))[0]
+            Xi = Id3 + skew_phi
             return Xi
         axis = phi / angle
-        skew_axis = torch.Tensor([[0, -axis[2], axis[1]],
-                          [axis[2], 0, -axis[0]],
-                          [-axis[1], axis[0], 0]])
+        skew_axis = IEKF.bskew(axis.unsqueeze(0))[0]
         c = angle.cos()
         s = angle.sin()
-        Xi = c * IEKF.Id3 + (1 - c) * IEKF.outer(axis, axis) \
+        Xi = c * Id3 + (1 - c) * IEKF.outer(axis, axis) \
              + s * skew_axis
-        return Xi.double()
+        return Xi
 
     @staticmethod
     def outer(a, b):
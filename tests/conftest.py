@@ -0,0 +1,43 @@
+import os
+import sys
+import pytest
+import torch
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.realpath(__file__))))
+
+import benchmark_KITTI as bench
+import src.losses as sl
+
+sequences = ['seq_{}'.format(i) for i in range(4)]
+
+
+@pytest.fixture
+def dataset_params(tmp_path):
+    """parameters of a dataset of random preprocessed sequences"""
+    predata_dir = os.path.join(tmp_path, 'predata')
+    os.mkdir(predata_dir)
+    bench.make_synthetic_predata(predata_dir, sequences, 400)
+    return {'data_dir': os.path.join(tmp_path, 'raw'), 'predata_dir': predata_dir,
+            'train_seqs': sequences, 'val_seqs': sequences[:1], 'test_seqs': sequences[:2],
+            'N': 200}
+
+
+@pytest.fixture
+def train_params(tmp_path):
+    """parameters of a short training on CPU"""
+    return {
+        'optimizer_class': torch.optim.Adam,
+        'optimizer': {'lr': 1e-3},
+        'loss_class': sl.GyroLoss,
+        'loss': bench.loss_params,
+        'scheduler_class': torch.optim.lr_scheduler.CosineAnnealingWarmRestarts,
+        'scheduler': {'T_0': 100},
+        'dataloader': {'batch_size': 2, 'shuffle': False},
+        # the filter is fine-tuned on cached network outputs, without the
+        # pre-training epochs
+        'output_cache': {'max_items': 8, 'noise_seeds': 1},
+        'freq_val': 1,
+        'n_epochs': 1,
+        'res_dir': os.path.join(tmp_path, 'results'),
+        'tb_dir': os.path.join(tmp_path, 'runs'),
+    }
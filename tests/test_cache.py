@@ -0,0 +1,26 @@
+import os
+import pytest
+
+import src.dataset as ds
+from src.storage import make_store, migrate
+
+
+@pytest.mark.parametrize('storage', ['pickle', 'columnar'])
+def test_sequence_cache_counts_owned_memory(dataset_params, storage):
+    """memory-mapped fields do not count in the budget of the sequence cache"""
+    if storage != 'pickle':
+        predata_dir = os.path.join(dataset_params['predata_dir'], storage)
+        migrate(make_store('pickle', dataset_params['predata_dir']),
+                make_store(storage, predata_dir))
+        dataset_params = dict(dataset_params, predata_dir=predata_dir, storage=storage)
+    cache = ds.BaseDataset.sequence_cache
+    cache.clear()
+    dataset = ds.KITTIDataset(**dataset_params, mode='train')
+    mondicts = [dataset.load_seq(i) for i in range(len(dataset))]
+    assert len(cache.items) == len(dataset)
+    if storage == 'pickle':
+        assert cache.n_bytes == sum(cache.size(mondict) for mondict in mondicts)
+    else:  # only the rotations added at loading take memory
+        assert cache.n_bytes == sum(cache.size({'Rot_gt': mondict['Rot_gt'],
+            'Rot_xs': mondict['Rot_xs']}) for mondict in mondicts)
+    cache.clear()
@@ -0,0 +1,128 @@
+import os
+import glob
+import datetime
+import numpy as np
+import torch
+from torch.utils.data import DataLoader
+
+import src.dataset as ds
+
+
+def test_prefetched_noise_is_deterministic(dataset_params):
+    """noise added by the prefetch thread from its generator does not depend
+    on the draws of the training loop running meanwhile"""
+    dataset = ds.KITTIDataset(**dataset_params, mode='train')
+    dataset.init_train()
+    dataset.augment = True
+
+    def epoch():
+        np.random.seed(0)
+        torch.manual_seed(0)
+        dataset.noise_generator = torch.Generator().manual_seed(0)
+        us = []
+        for batch in ds.Prefetcher(DataLoader(dataset, batch_size=1), 2):
+            torch.randn(1000)  # e.g. dropout of the training loop
+            us.append(batch[1])
+        return us
+
+    for us, other in zip(epoch(), epoch()):
+        assert torch.equal(us, other)
+
+
+def load_oxts_serial(oxts_files):
+    """packets, rotations and positions of OXTS files, read line by line and
+    posed packet by packet as KITTIDataset did before load_oxts and
+    poses_from_oxts"""
+    er = 6378137.  # earth radius (approx.) in meters
+    scale, origin = None, None
+    packets, Rots, ps = [], [], []
+    for filename in oxts_files:
+        with open(filename, 'r') as f:
+            for line in f.readlines():
+                line = line.split()
+                # last five entries are flags and counts
+                line[:-5] = [float(x) for x in line[:-5]]
+                line[-5:] = [int(float(x)) for x in line[-5:]]
+                packet = ds.KITTIDataset.OxtsPacket(*line)
+                if scale is None:
+                    scale = np.cos(packet.lat * np.pi / 180.)
+                p = np.array([scale * packet.lon * np.pi * er / 180.,
+                              scale * er * np.log(np.tan((90. + packet.lat) * np.pi / 360.)),
+                              packet.alt])
+                if origin is None:
+                    origin = p
+                Rots.append(rotz(packet.yaw).dot(roty(packet.pitch).dot(rotx(packet.roll))))
+                ps.append(p - origin)
+                packets.append(line)
+    return np.array(packets), np.array(Rots), np.array(ps)
+
+
+def rotx(t):
+    c, s = np.cos(t), np.sin(t)
+    return np.array([[1, 0, 0], [0, c, -s], [0, s, c]])
+
+
+def roty(t):
+    c, s = np.cos(t), np.sin(t)
+    return np.array([[c, 0, s], [0, 1, 0], [-s, 0, c]])
+
+
+def rotz(t):
+    c, s = np.cos(t), np.sin(t)
+    return np.array([[c, -s, 0], [s, c, 0], [0, 0, 1]])
+
+
+def to_rpy(Rot):
+    pitch = np.arctan2(-Rot[2, 0], np.sqrt(Rot[0, 0]**2 + Rot[1, 0]**2))
+    if np.isclose(pitch, np.pi / 2.):
+        return np.arctan2(Rot[0, 1], Rot[1, 1]), pitch, 0.
+    if np.isclose(pitch, -np.pi / 2.):
+        return -np.arctan2(Rot[0, 1], Rot[1, 1]), pitch, 0.
+    sec_pitch = 1. / np.cos(pitch)
+    return (np.arctan2(Rot[2, 1] * sec_pitch, Rot[2, 2] * sec_pitch), pitch,
+            np.arctan2(Rot[1, 0] * sec_pitch, Rot[0, 0] * sec_pitch))
+
+
+def write_oxts(path, n_files, seed=0):
+    """random OXTS files of a raw drive, one packet per file as in KITTI"""
+    rng = np.random.RandomState(seed)
+    os.makedirs(os.path.join(path, 'oxts', 'data'))
+    for k in range(n_files):
+        packet = rng.randn(25)
+        packet[:3] += [49., 8.4, 110.]  # lat, lon, alt
+        packet[5] = rng.uniform(-np.pi, np.pi)  # yaw
+        flags = rng.randint(0, 10, 5)
+        with open(os.path.join(path, 'oxts', 'data', '{:010d}.txt'.format(k)), 'w') as f:
+            f.write(' '.join([repr(float(x)) for x in packet] + [str(x) for x in flags]) + '\n')
+    with open(os.path.join(path, 'oxts', 'timestamps.txt'), 'w') as f:
+        for k in range(n_files):
+            f.write('2011-09-26 13:02:{:02d}.{:09d}\n'.format(k // 100, 10**7 * (k % 100) + k))
+    return sorted(glob.glob(os.path.join(path, 'oxts', 'data', '*.txt')))
+
+
+def test_vectorized_oxts_match_serial(tmp_path):
+    """load_oxts, poses_from_oxts and to_rpy_batch against the packet by
+    packet reading they replaced"""
+    oxts_files = write_oxts(str(tmp_path), 300)
+    packets, Rots, ps = load_oxts_serial(oxts_files)
+    oxts = ds.KITTIDataset.load_oxts(oxts_files)
+    np.testing.assert_array_equal(oxts, packets)
+    Rot, p = ds.KITTIDataset.poses_from_oxts(oxts)
+    np.testing.assert_allclose(Rot, Rots, rtol=0, atol=1e-15)
+    np.testing.assert_array_equal(p, ps)
+    # gimbal lock at pitch +-pi/2
+    Rots[:2] = [roty(np.pi / 2).dot(rotx(0.3)), roty(-np.pi / 2).dot(rotx(0.3))]
+    np.testing.assert_allclose(ds.KITTIDataset.to_rpy_batch(Rots),
+                               [to_rpy(Rot) for Rot in Rots], rtol=0, atol=1e-15)
+
+
+def test_timestamps_match_datetime(tmp_path):
+    """timestamps in ns against their datetime parsing, in microseconds"""
+    write_oxts(str(tmp_path), 300)
+    with open(os.path.join(tmp_path, 'oxts', 'timestamps.txt')) as f:
+        expected = [datetime.datetime.strptime(line[:-4], '%Y-%m-%d %H:%M:%S.%f')
+                    for line in f.readlines()]
+    t_ns = ds.KITTIDataset.load_timestamps_ns(str(tmp_path))
+    epoch = datetime.datetime(1970, 1, 1)
+    assert (t_ns // 1000).tolist() == [(t - epoch) // datetime.timedelta(microseconds=1)
+                                       for t in expected]
@@ -0,0 +1,27 @@
+import os
+import pytest
+import torch
+
+import benchmark_KITTI as bench
+import src.dataset as ds
+import src.learning as lr
+import src.networks as sn
+
+
+@pytest.mark.parametrize('world_size', [None, 1])
+def test_train_then_test(dataset_params, train_params, world_size):
+    """a process tests with the weights it trained, also when it trained in
+    distributed processes"""
+    if world_size is not None:
+        train_params['distributed'] = {'world_size': world_size, 'port': bench.free_port()}
+    os.makedirs(train_params['res_dir'])
+    torch.manual_seed(0)
+    learning_process = lr.GyroLearningBasedProcessing(train_params['res_dir'],
+        train_params['tb_dir'], sn.GyroNet, bench.net_params, None, 0.01)
+    learning_process.train(ds.KITTIDataset, dataset_params, train_params)
+    weights = torch.load(learning_process.path_weights)['net_state_dict']
+    for key, x in learning_process.net.state_dict().items():
+        assert torch.equal(x, weights[key])
+    learning_process.test(ds.KITTIDataset, dataset_params, ['test'])
+    for seq in dataset_params['test_seqs']:
+        assert torch.isfinite(learning_process.load_test_result(seq)['p']).all()
@@ -0,0 +1,57 @@
+import pytest
+import torch
+
+import benchmark_KITTI as bench
+import src.dataset as ds
+import src.networks as sn
+from src.precision import PrecisionPolicy
+
+# largest |diff| of the outputs of a network copy, relative to the largest
+# output, for a float32 ('mixed') and a float64 network
+tolerances = {'mixed': 2e-6, 'float64': 1e-14}
+
+
+def eval_net(policy, seed=0):
+    """GyroNet in eval mode, with batch norm statistics of random inputs"""
+    torch.manual_seed(seed)
+    net = sn.GyroNet(**bench.net_params)
+    net.set_precision(PrecisionPolicy.from_params(policy))
+    with torch.no_grad():
+        for _ in range(5):
+            net(torch.randn(4, 1000, 6).double())
+    return net.eval()
+
+
+def max_diff(ys, other):
+    return ((ys - other).abs().max() / ys.abs().max()).item()
+
+
+@pytest.mark.parametrize('policy', tolerances)
+def test_inference_net_matches_eval(policy):
+    """the folded batch norms of InferenceNet only change the rounding"""
+    net = eval_net(policy)
+    us = torch.randn(2, 3000, 6).double()
+    with torch.no_grad():
+        ys = net(us)
+        ys_inference = net.export_for_inference()(us)
+        ys_scripted = torch.jit.script(net.export_for_inference())(us)
+    assert torch.equal(net.head(ys), net.export_for_inference().head(ys))
+    assert max_diff(ys, ys_inference) < tolerances[policy]
+    assert max_diff(ys, ys_scripted) < tolerances[policy]
+
+
+@pytest.mark.parametrize('policy, tolerance', [('mixed', 2e-5), ('float64', 1e-14)])
+def test_streaming_net_matches_batch(dataset_params, policy, tolerance):
+    """StreamingNet gives the batch outputs up to the rounding documented on
+    the class, on the random sequences of benchmark_KITTI.py streaming"""
+    torch.manual_seed(0)
+    net = sn.GyroNet(**bench.net_params)
+    net.set_precision(PrecisionPolicy.from_params(policy))
+    net.eval()
+    dataset = ds.KITTIDataset(**dataset_params, mode='test')
+    for i in range(len(dataset)):
+        us = dataset[i][1].unsqueeze(0)
+        with torch.no_grad():
+            ys = net(us)
+            ys_stream = sn.StreamingNet(net).forward(us)
+        assert (ys - ys_stream).abs().max().item() < tolerance
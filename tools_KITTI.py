@@ -0,0 +1,71 @@
+"""Tools for trained networks and data.
+
+    python tools_KITTI.py export --address results/KITTI/<date> --output gyro_iekf.pt
+    python tools_KITTI.py migrate --predata_dir data/KITTI --to columnar
+    python tools_KITTI.py migrate --predata_dir data/KITTI --to compressed --dtypes us=float32
+    python tools_KITTI.py ingest --data_dir <raw KITTI> --predata_dir data/KITTI --n_workers 8
+"""
+import os
+import argparse
+
+base_dir = os.path.dirname(os.path.realpath(__file__))
+
+
+def export(args):
+    """write the trained network and filter parameters in one file, run by src/deploy.py"""
+    import src.learning as lr
+    import src.networks as sn
+    from src.deploy import export_pipeline
+    learning_process = lr.GyroLearningBasedProcessing(os.path.join(base_dir, "results/KITTI"),
+        os.path.join(base_dir, "results/runs/KITTI"), getattr(sn, args.net_class), None,
+        args.address, 0.01)
+    export_pipeline(learning_process, args.output)
+    print("exported", learning_process.address, "to", args.output)
+
+
+def migrate(args):
+    """convert preprocessed sequences to another storage format"""
+    from src.storage import make_store, migrate
+    options = {}
+    if args.dtypes is not None:  # stored dtype of fields, compressed storage
+        options['dtypes'] = dict(dtype.split('=') for dtype in args.dtypes)
+    names = migrate(make_store(args.source, args.predata_dir),
+                    make_store(args.to, args.predata_dir, **options))
+    print("migrated {} sequences from {} to {}".format(len(names), args.source, args.to))
+
+
+def ingest(args):
+    """preprocess the new or changed raw KITTI drives in parallel"""
+    import src.dataset as ds
+    from src.storage import make_store
+    failures = ds.KITTIDataset.ingest(args.data_dir, make_store(args.storage, args.predata_dir),
+                                      args.n_workers, args.force)
+    if failures:
+        raise SystemExit(1)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description=__doc__,
+        formatter_class=argparse.RawDescriptionHelpFormatter)
+    subparsers = parser.add_subparsers(dest='tool', required=True)
+    parser_export = subparsers.add_parser('export', help=export.__doc__)
+    parser_export.add_argument('--address', default='last',
+                               help="results directory of the trained network, or 'last'")
+    parser_export.add_argument('--net_class', default='GyroNet',
+                               help='network class of src/networks.py')
+    parser_export.add_argument('--output', default='gyro_iekf.pt')
+    parser_migrate = subparsers.add_parser('migrate', help=migrate.__doc__)
+    parser_migrate.add_argument('--predata_dir', default=os.path.join(base_dir, 'data/KITTI'))
+    parser_migrate.add_argument('--source', default='pickle')
+    parser_migrate.add_argument('--to', default='columnar')
+    parser_migrate.add_argument('--dtypes', nargs='*', default=None,
+                                help='field=dtype stored by the compressed storage')
+    parser_ingest = subparsers.add_parser('ingest', help=ingest.__doc__)
+    parser_ingest.add_argument('--data_dir', required=True, help='raw KITTI data')
+    parser_ingest.add_argument('--predata_dir', default=os.path.join(base_dir, 'data/KITTI'))
+    parser_ingest.add_argument('--storage', default='pickle')
+    parser_ingest.add_argument('--n_workers', type=int, default=os.cpu_count())
+    parser_ingest.add_argument('--force', action='store_true',
+                               help='also preprocess the up-to-date drives')
+    args = parser.parse_args()
+    globals()[args.tool](args)